@@ -0,0 +1,159 @@
+import asyncio
+import concurrent.futures
+import threading
+import typing as ty
+from datetime import datetime
+
+import aiohttp
+
+import task_metrics
+import tlog
+from http_client import (DEFAULT_BACKOFF, DEFAULT_CONNECT_TIMEOUT,
+                         DEFAULT_MAX_ATTEMPTS, DEFAULT_READ_TIMEOUT,
+                         DEFAULT_WAITING_TIME, RETRY_STATUS_CODES)
+
+DEFAULT_CONCURRENCY = 500
+
+
+class AsyncFetchEngine:
+    """Runs tfl fetches as coroutines on a single event loop.
+
+    The loop lives in its own daemon thread. At most `concurrency` requests
+    are in flight at once, tasks over the limit wait on a semaphore instead of
+    holding a thread. Tasks for a url that is already being fetched await the
+    same fetch rather than starting another one.
+
+    Store writes are blocking, so they are run in the loop's default executor.
+    """
+
+    def __init__(self,
+                 concurrency: int = DEFAULT_CONCURRENCY,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 waiting_time: float = DEFAULT_WAITING_TIME,
+                 backoff: float = DEFAULT_BACKOFF):
+        tlog.info(f"Initialising async engine, concurrency = {concurrency}")
+        self.concurrency = concurrency
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout,
+                                             sock_read=read_timeout)
+        self.max_attempts = max_attempts
+        self.waiting_time = waiting_time
+        self.backoff = backoff
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever,
+                                        name="tfl-async-engine",
+                                        daemon=True)
+        self._session: ty.Optional[aiohttp.ClientSession] = None
+        self._semaphore: ty.Optional[asyncio.Semaphore] = None
+        self._in_flight_urls: ty.Dict[str, asyncio.Future] = dict()
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.coalesced_tasks = 0
+
+    def start(self):
+        self._thread.start()
+        self.run(self._open())
+        return self
+
+    async def _open(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=self.timeout,
+            headers={"Accept": "application/json"})
+
+    def run(self, coro) -> ty.Any:
+        """Run coro on the engine's loop and wait for the result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def submit(self, url: str, id: str, store) -> concurrent.futures.Future:
+        """Schedule get_from_tfl on the engine's loop, from any thread"""
+        return asyncio.run_coroutine_threadsafe(
+            self.get_from_tfl(url, id, store), self.loop)
+
+    async def _get_json(self, url: str) -> ty.Any:
+        waiting_time = self.waiting_time
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                async with self._session.get(url) as resp:
+                    if resp.status not in RETRY_STATUS_CODES:
+                        return await resp.json(content_type=None)
+                    error = aiohttp.ClientResponseError(
+                        resp.request_info, resp.history, status=resp.status)
+            except (aiohttp.ClientConnectionError,
+                    asyncio.TimeoutError) as e:
+                error = e
+            if attempts >= self.max_attempts:
+                raise error
+            tlog.warn(f"retrying after attempt {attempts}", err=error)
+            self.retries += 1
+            await asyncio.sleep(waiting_time)
+            waiting_time *= self.backoff
+
+    async def fetch(self, url: str) -> ty.Any:
+        in_flight = self._in_flight_urls.get(url)
+        if in_flight is not None:
+            self.coalesced_tasks += 1
+            return await asyncio.shield(in_flight)
+
+        future = self.loop.create_future()
+        self._in_flight_urls[url] = future
+        self.requests += 1
+        try:
+            async with self._semaphore:
+                self.in_flight += 1
+                try:
+                    with task_metrics.stage(task_metrics.FETCH).time():
+                        response = await self._get_json(url)
+                finally:
+                    self.in_flight -= 1
+            future.set_result(response)
+            return response
+        except Exception as e:
+            self.failures += 1
+            tlog.error(f"giving up on {url}", err=e)
+            future.set_exception(e)
+            # mark it retrieved, in case no other task was waiting on it
+            future.exception()
+            raise e
+        finally:
+            del self._in_flight_urls[url]
+
+    async def get_from_tfl(self, url: str, id: str, store,
+                           due: datetime = None):
+        if due is not None:
+            task_metrics.observe_lag(due)
+        try:
+            response = await self.fetch(url)
+        except Exception:
+            task_metrics.FAILED.inc()
+            raise
+        with task_metrics.stage(task_metrics.STORE_WRITE).time():
+            await self.loop.run_in_executor(None, store.add_response, id,
+                                            response)
+            await self.loop.run_in_executor(None,
+                                            store.remove_pending_task_id, id)
+
+    def shutdown(self):
+        if not self._thread.is_alive():
+            return
+        if self._session is not None:
+            self.run(self._session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    def stats(self) -> ty.Dict[str, int]:
+        return {
+            "concurrency": self.concurrency,
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            "in_flight": self.in_flight,
+            "coalesced_tasks": self.coalesced_tasks,
+        }
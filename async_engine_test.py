@@ -0,0 +1,82 @@
+import concurrent.futures
+import time
+import unittest
+
+import async_engine as module
+import tfl_scheduler
+from store import InMemoryStore
+from tfl_stub import TflStubServer
+
+
+class AsyncEngineTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.stub = TflStubServer(latency=0.05).start()
+        self.engine = module.AsyncFetchEngine(concurrency=20,
+                                              waiting_time=0.01).start()
+        self.store = InMemoryStore()
+
+    def tearDown(self) -> None:
+        self.engine.shutdown()
+        self.stub.stop()
+
+    def url(self, line):
+        return f"{self.stub.url}/Line/{line}/Disruption"
+
+    def test_fetches_run_concurrently(self):
+        n_tasks = 100
+        start = time.monotonic()
+        futures = [
+            self.engine.submit(self.url(f"line{i}"), f"task_{i}", self.store)
+            for i in range(n_tasks)
+        ]
+        concurrent.futures.wait(futures)
+        elapsed = time.monotonic() - start
+
+        for i in range(n_tasks):
+            response = self.store.get_task_id_response(f"task_{i}")
+            self.assertTrue(response[0]["description"].startswith(
+                f"Line{i} Line"))
+        # sequentially this would take n_tasks * latency = 5s
+        self.assertLess(elapsed, n_tasks * self.stub.latency / 2)
+        self.assertEqual(self.engine.stats()["in_flight"], 0)
+
+    def test_same_url_shares_fetch(self):
+        futures = [
+            self.engine.submit(self.url("bakerloo"), f"task_{i}", self.store)
+            for i in range(10)
+        ]
+        concurrent.futures.wait(futures)
+        self.assertEqual(self.stub.requests, 1)
+        self.assertEqual(self.engine.stats()["coalesced_tasks"], 9)
+        self.assertIsNotNone(self.store.get_task_id_response("task_9"))
+
+    def test_retries_server_errors(self):
+        self.stub.fail_next(2)
+        self.engine.submit(self.url("victoria"), "task", self.store).result()
+        self.assertIsNotNone(self.store.get_task_id_response("task"))
+        self.assertEqual(self.engine.stats()["retries"], 2)
+
+
+class AsyncSchedulerTest(unittest.TestCase):
+
+    def test_schedule_tfl_call(self):
+        store = InMemoryStore()
+        with TflStubServer() as stub:
+            scheduler = tfl_scheduler.TflScheduler(
+                store=store,
+                executor=tfl_scheduler.EXECUTOR_ASYNCIO,
+                concurrency=5)
+            url = f"{stub.url}/Line/victoria/Disruption"
+            scheduler.schedule_tfl_call(url=url, dt=None, id="Test")
+            for _ in range(50):
+                if not store.is_pending_task_id("Test"):
+                    break
+                time.sleep(0.05)
+            scheduler.shutdown()
+        response = store.get_task_id_response("Test")
+        self.assertEqual(response[0]["closureText"], "serviceClosed")
+
+
+if __name__ == '__main__':
+    unittest.main()
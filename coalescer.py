@@ -0,0 +1,159 @@
+import heapq
+import itertools
+import threading
+import time
+import typing as ty
+from concurrent.futures import ThreadPoolExecutor
+
+import task_metrics
+import tlog
+from http_client import DEFAULT_POOL_SIZE
+
+DEFAULT_COALESCE_WINDOW = 0.5  # seconds
+
+_global_coalescer = None
+
+
+def get_coalescer(window: float = DEFAULT_COALESCE_WINDOW,
+                  max_workers: int = DEFAULT_POOL_SIZE):
+    # one per process, so tasks of every scheduler in it share fetches, and
+    # its pool bounds the fetches of them all
+    global _global_coalescer
+    if _global_coalescer is None:
+        _global_coalescer = RequestCoalescer(window=window,
+                                             max_workers=max_workers)
+    return _global_coalescer
+
+
+class RequestCoalescer:
+    """Shares a single upstream fetch between tasks that target the same url.
+
+    The first task to fire for a url opens a batch, due `window` seconds
+    later. Tasks with the same url that fire before then (or while its fetch
+    is in flight) join the batch. Every task returns straight away, so none
+    of them holds on to a scheduler thread while the batch is open.
+
+    One dispatcher thread waits for the earliest due batch, and hands due
+    batches to a pool of `max_workers` threads. Each does one fetch and
+    writes the result to the store for every task id in its batch. However
+    many urls have open batches, there are at most max_workers fetches at
+    once, as many as the shared http client has connections.
+
+    The app shares one coalescer and one store between all schedulers, so
+    every task in a batch is written with the leader's store and fetch.
+    """
+
+    def __init__(self,
+                 window: float = DEFAULT_COALESCE_WINDOW,
+                 max_workers: int = DEFAULT_POOL_SIZE):
+        self.window = window
+        self._lock = threading.Lock()
+        # notified when a batch is due sooner, or a batch is done
+        self._changed = threading.Condition(self._lock)
+        self._batches: ty.Dict[str, ty.List[str]] = dict()
+        # (due_at, n, url, store, fetch) of the batches not yet fetched,
+        # soonest first. n keeps batches due at the same time in order
+        self._due: ty.List[tuple] = []
+        self._counter = itertools.count()
+        # batches opened and not yet written
+        self._open = 0
+        self._pool = ThreadPoolExecutor(max_workers=max_workers,
+                                        thread_name_prefix="tfl-coalesce")
+        self._dispatcher = None
+        self.upstream_calls = 0
+        self.coalesced_tasks = 0
+
+    def submit(self, url: str, task_id: str, store,
+               fetch: ty.Callable[[str], ty.Any]) -> bool:
+        """Run or join the batch for url.
+
+        Returns: True if this call opened the batch, which is fetched on the
+            coalescer's pool once the window has passed, or right away in
+            this thread if the window is 0
+        """
+        with self._lock:
+            batch = self._batches.get(url)
+            if batch is not None:
+                batch.append(task_id)
+                self.coalesced_tasks += 1
+                tlog.debug("coalesced task into in-flight fetch",
+                           task_id=task_id,
+                           url=url)
+                return False
+            self._batches[url] = [task_id]
+            self.upstream_calls += 1
+            self._open += 1
+            if self.window > 0:
+                heapq.heappush(self._due,
+                               (time.monotonic() + self.window,
+                                next(self._counter), url, store, fetch))
+                if self._dispatcher is None:
+                    self._dispatcher = threading.Thread(
+                        target=self._dispatch,
+                        name="tfl-coalesce-dispatch",
+                        daemon=True)
+                    self._dispatcher.start()
+                self._changed.notify_all()
+                return True
+        self._run_batch(url, store, fetch)
+        return True
+
+    def _dispatch(self):
+        with self._lock:
+            while True:
+                if not self._due:
+                    self._changed.wait()
+                    continue
+                wait = self._due[0][0] - time.monotonic()
+                if wait > 0:
+                    self._changed.wait(wait)
+                    continue
+                _, _, url, store, fetch = heapq.heappop(self._due)
+                self._pool.submit(self._run_batch, url, store, fetch, False)
+
+    def _run_batch(self, url: str, store, fetch: ty.Callable[[str], ty.Any],
+                   reraise: bool = True):
+        try:
+            self._fetch_and_write(url, store, fetch)
+        except Exception:
+            if reraise:
+                raise
+            # nothing above the pool thread to raise to
+            tlog.exception("coalesced batch failed", url=url)
+        finally:
+            with self._lock:
+                self._open -= 1
+                self._changed.notify_all()
+
+    def _fetch_and_write(self, url: str, store,
+                         fetch: ty.Callable[[str], ty.Any]):
+        try:
+            response = fetch(url)
+        except Exception as e:
+            with self._lock:
+                task_ids = self._batches.pop(url)
+            task_metrics.FAILED.inc(len(task_ids))
+            tlog.error(f"fetch failed for {len(task_ids)} tasks",
+                       url=url, err=e)
+            raise e
+
+        with self._lock:
+            task_ids = self._batches.pop(url)
+        tlog.debug("fanning out response", tasks=len(task_ids), url=url)
+        with task_metrics.stage(task_metrics.STORE_WRITE).time():
+            store.add_responses_bulk([(id, response) for id in task_ids])
+
+    def join(self, timeout: float = None) -> bool:
+        """Wait for the open batches to be fetched and written
+
+        Returns: False if some were still open after timeout seconds
+        """
+        with self._lock:
+            return self._changed.wait_for(lambda: self._open == 0, timeout)
+
+    def stats(self) -> ty.Dict[str, int]:
+        return {
+            "upstream_calls": self.upstream_calls,
+            "coalesced_tasks": self.coalesced_tasks,
+            "in_flight": len(self._batches),
+        }
@@ -0,0 +1,116 @@
+import threading
+import time
+import unittest
+
+import coalescer as module
+from store import InMemoryStore
+
+
+class CoalescerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.url = "https://api.tfl.gov.uk/Line/bakerloo,jubilee/Disruption"
+        self.calls = []
+
+    def fetch(self, url):
+        self.calls.append(url)
+        time.sleep(0.1)
+        return [{'url': url}]
+
+    def test_concurrent_tasks_share_one_fetch(self):
+        store = InMemoryStore()
+        coalescer = module.RequestCoalescer(window=0.2)
+        ids = [f"task_{i}" for i in range(20)]
+        threads = [
+            threading.Thread(target=coalescer.submit,
+                             args=(self.url, id, store, self.fetch))
+            for id in ids
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        coalescer.join()
+
+        self.assertEqual(self.calls, [self.url])
+        for id in ids:
+            self.assertEqual(store.get_task_id_response(id),
+                             [{'url': self.url}])
+        self.assertEqual(coalescer.stats()["coalesced_tasks"], 19)
+        self.assertEqual(coalescer.stats()["in_flight"], 0)
+
+    def test_submit_does_not_wait_for_the_window(self):
+        store = InMemoryStore()
+        coalescer = module.RequestCoalescer(window=0.3)
+        began = time.monotonic()
+        self.assertTrue(coalescer.submit(self.url, 'a', store, self.fetch))
+        self.assertFalse(coalescer.submit(self.url, 'b', store, self.fetch))
+        self.assertLess(time.monotonic() - began, 0.1)
+        self.assertEqual(coalescer.stats()["in_flight"], 1)
+        coalescer.join()
+        self.assertEqual(self.calls, [self.url])
+        self.assertEqual(store.get_task_id_response('b'), [{'url': self.url}])
+        self.assertEqual(coalescer.stats()["in_flight"], 0)
+
+    def test_many_urls_share_a_bounded_pool(self):
+        store = InMemoryStore()
+        coalescer = module.RequestCoalescer(window=0.1, max_workers=4)
+        lock = threading.Lock()
+        running = [0, 0]  # now, most at once
+
+        def fetch(url):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return [url]
+
+        threads = threading.active_count()
+        for i in range(200):
+            coalescer.submit(f"{self.url}?{i}", f"task_{i}", store, fetch)
+        # the dispatcher only
+        self.assertLessEqual(threading.active_count(), threads + 1)
+        self.assertTrue(coalescer.join(timeout=10))
+        self.assertLessEqual(running[1], 4)
+        self.assertEqual(store.get_task_id_response('task_199'),
+                         [f"{self.url}?199"])
+
+    def test_failed_background_fetch_closes_batch(self):
+        store = InMemoryStore()
+
+        def failing_fetch(url):
+            raise ConnectionError("tfl is down")
+
+        coalescer = module.RequestCoalescer(window=0.05)
+        coalescer.submit(self.url, 'a', store, failing_fetch)
+        coalescer.join()
+        self.assertEqual(coalescer.stats()["in_flight"], 0)
+        self.assertRaises(ValueError, store.get_task_id_response, 'a')
+
+    def test_different_urls_are_not_coalesced(self):
+        store = InMemoryStore()
+        coalescer = module.RequestCoalescer(window=0)
+        other_url = "https://api.tfl.gov.uk/Line/victoria/Disruption"
+        coalescer.submit(self.url, 'a', store, self.fetch)
+        coalescer.submit(other_url, 'b', store, self.fetch)
+        self.assertCountEqual(self.calls, [self.url, other_url])
+        self.assertEqual(store.get_task_id_response('b'),
+                         [{'url': other_url}])
+
+    def test_failed_fetch_closes_batch(self):
+        store = InMemoryStore()
+
+        def failing_fetch(url):
+            raise ConnectionError("tfl is down")
+
+        coalescer = module.RequestCoalescer(window=0)
+        with self.assertRaises(ConnectionError):
+            coalescer.submit(self.url, 'a', store, failing_fetch)
+        self.assertEqual(coalescer.stats()["in_flight"], 0)
+        with self.assertRaises(ValueError):
+            store.get_task_id_response('a')
+
+
+if __name__ == '__main__':
+    unittest.main()
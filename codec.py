@@ -0,0 +1,102 @@
+"""Serialisation of tfl responses for stores that keep them as bytes.
+
+Every encoded value starts with a one byte tag naming its codec, so values
+written with different codecs can live side by side and the codec of a store
+can be changed without rewriting old rows. Values without a known tag are
+assumed to be the `str(response)` the stores used to write, and are decoded
+with `ast.literal_eval`.
+"""
+import ast
+import hashlib
+import json
+import typing as ty
+import zlib
+
+import msgpack
+
+DEFAULT_CODEC = "msgpack"
+DEFAULT_COMPRESSION_LEVEL = 6
+
+
+class Codec:
+    name: str
+    tag: bytes
+
+    def dumps(self, value) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data: bytes):
+        raise NotImplementedError
+
+    def encode(self, value) -> bytes:
+        return self.tag + self.dumps(value)
+
+    def decode(self, data: bytes):
+        return self.loads(data[1:])
+
+
+class JsonCodec(Codec):
+    name = "json"
+    tag = b"\x01"
+
+    def dumps(self, value) -> bytes:
+        return json.dumps(value, separators=(',', ':'),
+                          ensure_ascii=False).encode("utf-8")
+
+    def loads(self, data: bytes):
+        return json.loads(data)
+
+
+class CompressedJsonCodec(JsonCodec):
+    name = "json+zlib"
+    tag = b"\x02"
+
+    def __init__(self, level: int = DEFAULT_COMPRESSION_LEVEL):
+        self.level = level
+
+    def dumps(self, value) -> bytes:
+        return zlib.compress(super().dumps(value), self.level)
+
+    def loads(self, data: bytes):
+        return super().loads(zlib.decompress(data))
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+    tag = b"\x03"
+
+    def dumps(self, value) -> bytes:
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data: bytes):
+        return msgpack.unpackb(data, raw=False)
+
+
+CODECS: ty.Dict[str, Codec] = {
+    codec.name: codec
+    for codec in [JsonCodec(), CompressedJsonCodec(), MsgpackCodec()]
+}
+_TAG2CODEC = {codec.tag: codec for codec in CODECS.values()}
+
+
+def get_codec(name: str = DEFAULT_CODEC) -> Codec:
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec {name}, expected one of "
+                         f"{sorted(CODECS)}")
+    return CODECS[name]
+
+
+def decode(data: ty.Union[bytes, str]):
+    """Decode a value written by any codec, or a legacy str(response)"""
+    if isinstance(data, str):
+        return ast.literal_eval(data)
+    codec = _TAG2CODEC.get(data[:1])
+    if codec is None:
+        return ast.literal_eval(data.decode("utf-8"))
+    return codec.decode(data)
+
+
+def content_hash(value) -> str:
+    """Hash of a response's content, equal for equal responses"""
+    packed = msgpack.packb(value, use_bin_type=True, default=str)
+    return hashlib.sha256(packed).hexdigest()
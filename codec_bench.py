@@ -0,0 +1,63 @@
+"""Compares the response codecs on tfl shaped disruption payloads.
+
+    python codec_bench.py
+
+For every payload size this prints the time to encode and decode one
+response, and its encoded size, for each codec in codec.py and for the
+str()/ast.literal_eval pair the SQL store used before.
+"""
+import ast
+import timeit
+
+import codec
+from tfl_stub import MODE2LINES, make_disruption
+
+PAYLOADS = {
+    # 2 lines, the example in the readme
+    "small": dict(lines=2, disruptions=1, stops=0),
+    # every tube line, a few disruptions each
+    "medium": dict(lines=11, disruptions=3, stops=5),
+    # a bad day, lots of disruptions with their affected stops
+    "large": dict(lines=11, disruptions=10, stops=30),
+}
+
+
+def make_payload(lines: int, disruptions: int, stops: int) -> list:
+    return [
+        make_disruption(line_id, i, stops=stops)
+        for line_id in MODE2LINES["tube"][:lines]
+        for i in range(disruptions)
+    ]
+
+
+def time_per_call(f, value) -> float:
+    """Best of 5 runs, in microseconds"""
+    timer = timeit.Timer(lambda: f(value))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e6
+
+
+def bench(payload: list):
+    encoders = {"str/literal_eval": (str, ast.literal_eval)}
+    for name, c in codec.CODECS.items():
+        encoders[name] = (c.encode, codec.decode)
+
+    for name, (encode, decode) in encoders.items():
+        encoded = encode(payload)
+        assert decode(encoded) == payload
+        yield (name, time_per_call(encode, payload),
+               time_per_call(decode, encoded), len(encoded))
+
+
+def main():
+    print(f"{'payload':<8} {'codec':<18} {'encode us':>10} "
+          f"{'decode us':>10} {'bytes':>9}")
+    for payload_name, kwargs in PAYLOADS.items():
+        payload = make_payload(**kwargs)
+        for name, encode_us, decode_us, size in bench(payload):
+            print(f"{payload_name:<8} {name:<18} {encode_us:>10.1f} "
+                  f"{decode_us:>10.1f} {size:>9}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+import unittest
+
+import codec as module
+from tfl_stub import make_disruption
+
+
+class CodecTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.response = [make_disruption('bakerloo', i, stops=2)
+                         for i in range(3)]
+
+    def test_round_trip(self):
+        for name, codec in module.CODECS.items():
+            with self.subTest(codec=name):
+                encoded = codec.encode(self.response)
+                self.assertIsInstance(encoded, bytes)
+                self.assertEqual(module.decode(encoded), self.response)
+
+    def test_decodes_legacy_values(self):
+        legacy = str(self.response)
+        self.assertEqual(module.decode(legacy), self.response)
+        self.assertEqual(module.decode(legacy.encode()), self.response)
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            module.get_codec('pickle')
+
+
+if __name__ == '__main__':
+    unittest.main()
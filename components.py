@@ -0,0 +1,125 @@
+import atexit
+import threading
+from functools import partial
+
+import constants as c
+import task_metrics
+import tlog
+from coalescer import DEFAULT_COALESCE_WINDOW
+from http_client import get_http_client
+from line_index import get_line_index
+from notifier import CompletionNotifier, get_notifier
+from read_cache import CachingStore
+from response_cache import get_response_cache
+from store import STORE_SQLITE, AbstractMemoryStore, SQLStore, get_store
+from subscriptions import SubscriptionManager
+from tfl_scheduler import EXECUTOR_QUEUE, TflScheduler, fetch_from_tfl
+from url_helper import TflUrlHelper
+
+_global_components = None
+_global_components_lock = threading.Lock()
+
+
+def get_components():
+    """The app's components, created on first use and shut down at exit.
+
+    FlaskView builds a view per request, so anything the view creates itself
+    would be created per request. Views take their components from here.
+    """
+    global _global_components
+    with _global_components_lock:
+        if _global_components is None:
+            _global_components = AppComponents.create()
+            atexit.register(_global_components.shutdown)
+    return _global_components
+
+
+def set_components(components: "AppComponents"):
+    """Make get_components return these, e.g. to run the app on another
+    store. Whatever was there before is left running"""
+    global _global_components
+    with _global_components_lock:
+        _global_components = components
+
+
+def create_store() -> AbstractMemoryStore:
+    """The app's own store, of the backend set by TFL_STORE_BACKEND"""
+    if c.STORE_BACKEND == STORE_SQLITE:
+        kwargs = dict(path=c.STORE_SQLITE_PATH)
+        if c.STORE_SQLITE_COMMIT_INTERVAL is not None:
+            kwargs["commit_interval"] = c.STORE_SQLITE_COMMIT_INTERVAL
+        return get_store(in_memory_store=True, backend=STORE_SQLITE, **kwargs)
+    return get_store(in_memory_store=True,
+                     backend=c.STORE_BACKEND,
+                     max_entries=c.STORE_MAX_ENTRIES,
+                     max_bytes=c.STORE_MAX_BYTES,
+                     ttl=c.STORE_TTL,
+                     eviction_policy=c.STORE_EVICTION_POLICY,
+                     spill_dir=c.STORE_SPILL_DIR,
+                     max_spilled=c.STORE_MAX_SPILLED)
+
+
+class AppComponents:
+    """Long lived parts of the app, shared by every request"""
+
+    def __init__(self, store: AbstractMemoryStore, tfl_scheduler: TflScheduler,
+                 url_helper: TflUrlHelper,
+                 notifier: CompletionNotifier,
+                 subscriptions: SubscriptionManager = None):
+        self.store = store
+        self.tfl_scheduler = tfl_scheduler
+        self.url_helper = url_helper
+        self.notifier = notifier
+        # None when tasks are queued for workers, there is no scheduler to
+        # run subscriptions on
+        self.subscriptions = subscriptions
+        self._shut_down = False
+
+    @classmethod
+    def create(cls, store: AbstractMemoryStore = None):
+        """
+        Args:
+            store: store to run the app's own scheduler on. By default the
+                store is picked from the settings in constants.py
+        """
+        tlog.info("Creating app components")
+        subscriptions = None
+        if store is None and c.QUEUE_DATABASE_URL:
+            # dashboards read the same tasks over and over
+            store = CachingStore(SQLStore(database_url=c.QUEUE_DATABASE_URL))
+            tfl_scheduler = TflScheduler(store=store, executor=EXECUTOR_QUEUE)
+        else:
+            if store is None:
+                store = create_store()
+            tfl_scheduler = TflScheduler(
+                store=store,
+                coalesce_window=DEFAULT_COALESCE_WINDOW,
+                response_cache=get_response_cache())
+            # not through the response cache, which would repeat one
+            # response for feeds more frequent than its ttl
+            subscriptions = SubscriptionManager(
+                scheduler=tfl_scheduler.scheduler,
+                fetch=partial(fetch_from_tfl,
+                              client=tfl_scheduler.http_client))
+        url_helper = TflUrlHelper(line_index=get_line_index())
+        notifier = get_notifier()
+        store.add_completion_listener(notifier.notify)
+        task_metrics.watch_store(store)
+        return cls(store=store,
+                   tfl_scheduler=tfl_scheduler,
+                   url_helper=url_helper,
+                   notifier=notifier,
+                   subscriptions=subscriptions)
+
+    def shutdown(self):
+        if self._shut_down:
+            return
+        self._shut_down = True
+        tlog.info("Shutting down app components")
+        # running fetches are left to finish, they may still write responses
+        self.tfl_scheduler.shutdown(wait=True)
+        self.url_helper.line_index.close()
+        close = getattr(self.store, "close", None)
+        if close is not None:
+            close()
+        get_http_client().close()
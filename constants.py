@@ -1 +1,51 @@
-DT_STR = "%Y-%m-%dT%H:%M:%S"
\ No newline at end of file
+import os
+import tempfile
+
+
+def _getenv_number(name: str, cast=int, default=None):
+    """The number in env var name, or default if it is not set. 0 is kept"""
+    value = os.getenv(name)
+    return cast(value) if value else default
+
+
+DT_STR = "%Y-%m-%dT%H:%M:%S"
+TFL_API_URL = os.getenv("TFL_API_URL", "https://api.tfl.gov.uk")
+
+# retention of the in memory store, unbounded when not set
+STORE_MAX_ENTRIES = _getenv_number("TFL_STORE_MAX_ENTRIES")
+STORE_MAX_BYTES = _getenv_number("TFL_STORE_MAX_BYTES")
+STORE_TTL = _getenv_number("TFL_STORE_TTL", float)  # seconds
+STORE_EVICTION_POLICY = os.getenv("TFL_STORE_EVICTION_POLICY", "lru")
+STORE_SPILL_DIR = os.getenv("TFL_STORE_SPILL_DIR")
+STORE_MAX_SPILLED = _getenv_number("TFL_STORE_MAX_SPILLED", default=100000)
+
+# "memory", "concurrent" for a memory store with a lock per shard of tasks, or
+# "sqlite" to keep tasks in an embedded sqlite file that survives restarts.
+# Retention settings above only apply to the memory stores
+STORE_BACKEND = os.getenv("TFL_STORE_BACKEND", "memory")
+STORE_SQLITE_PATH = os.getenv("TFL_STORE_SQLITE_PATH", "tfl_store.db")
+# seconds sqlite writes wait to be committed together, 0 commits each one
+STORE_SQLITE_COMMIT_INTERVAL = _getenv_number(
+    "TFL_STORE_SQLITE_COMMIT_INTERVAL", float)
+
+# valid line ids, shared by every request and refreshed in the background
+LINE_INDEX_MODES = os.getenv("TFL_LINE_INDEX_MODES",
+                             "tube,dlr,overground,bus").split(',')
+LINE_INDEX_TTL = _getenv_number("TFL_LINE_INDEX_TTL", float,
+                                default=3600)  # secs
+LINE_INDEX_SNAPSHOT = os.getenv(
+    "TFL_LINE_INDEX_SNAPSHOT",
+    os.path.join(tempfile.gettempdir(), "tfl_line_index.json"))
+
+# if set, tasks are queued in this database for worker.py processes to run,
+# rather than run by the app's own scheduler
+QUEUE_DATABASE_URL = os.getenv("TFL_QUEUE_DATABASE_URL")
+
+# connection pool of the sql store, used by the app and its workers
+SQL_POOL_SIZE = _getenv_number("TFL_SQL_POOL_SIZE", default=5)
+SQL_MAX_OVERFLOW = _getenv_number("TFL_SQL_MAX_OVERFLOW", default=10)
+SQL_POOL_TIMEOUT = _getenv_number("TFL_SQL_POOL_TIMEOUT", float,
+                                  default=30)  # secs
+# seconds before a connection is replaced, as servers and proxies drop idle ones
+SQL_POOL_RECYCLE = _getenv_number("TFL_SQL_POOL_RECYCLE", default=1800)
+SQL_POOL_PRE_PING = os.getenv("TFL_SQL_POOL_PRE_PING", "1") != "0"
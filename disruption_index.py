@@ -0,0 +1,63 @@
+"""Keys of a tfl disruption response that stores index finished tasks by, so
+they can be queried without reading their responses.
+
+A response is the list of disruptions tfl returns for a task's lines. Each
+disruption gives keys for:
+    line: the line ids in its affectedRoutes, and the line named at the start
+        of its description, e.g. "Hammersmith & City Line: ..."
+    category, type, closureText: its fields of the same name
+"""
+import re
+import typing as ty
+
+LINE = "line"
+CATEGORY = "category"
+TYPE = "type"
+CLOSURE_TEXT = "closureText"
+FIELDS = (LINE, CATEGORY, TYPE, CLOSURE_TEXT)
+
+_LINE_NAME = re.compile(r"^\s*([\w&' .-]{1,40}?)\s+line\s*:", re.IGNORECASE)
+
+
+def line_id(name: str) -> str:
+    """tfl's id of a line name, e.g. hammersmith-city for Hammersmith & City"""
+    return "-".join(name.replace("&", " ").lower().split())
+
+
+def _disruption_keys(disruption: dict) -> ty.Iterator[ty.Tuple[str, str]]:
+    for field in (CATEGORY, TYPE, CLOSURE_TEXT):
+        value = disruption.get(field)
+        if isinstance(value, str) and value:
+            yield field, value
+    description = disruption.get("description")
+    if isinstance(description, str):
+        match = _LINE_NAME.match(description)
+        if match:
+            yield LINE, line_id(match.group(1))
+    for route in disruption.get("affectedRoutes") or ():
+        if isinstance(route, dict) and isinstance(route.get("lineId"), str):
+            yield LINE, route["lineId"].lower()
+
+
+def index_keys(response) -> ty.List[ty.Tuple[str, str]]:
+    """Sorted (field, value) keys of a response. Anything that is not a list
+    of disruptions has none"""
+    if not isinstance(response, list):
+        return []
+    keys = set()
+    for disruption in response:
+        if isinstance(disruption, dict):
+            keys.update(_disruption_keys(disruption))
+    return sorted(keys)
+
+
+def parse_filters(values: ty.Mapping[str, ty.Any]) -> ty.Dict[str, str]:
+    """{field: value} of the FIELDS in values, e.g. a request's arguments.
+    Line ids are matched lower case"""
+    filters = {
+        field: values[field]
+        for field in FIELDS if values.get(field)
+    }
+    if LINE in filters:
+        filters[LINE] = filters[LINE].lower()
+    return filters
@@ -0,0 +1,46 @@
+import unittest
+
+import disruption_index as module
+from tfl_stub import make_disruption
+
+
+class IndexKeysTest(unittest.TestCase):
+
+    def test_index_keys(self):
+        disruption = make_disruption('hammersmith-city', 0)
+        self.assertEqual(module.index_keys([disruption]), [
+            ('category', 'RealTime'),
+            ('closureText', 'serviceClosed'),
+            ('line', 'hammersmith-city'),
+            ('type', 'lineInfo'),
+        ])
+
+    def test_line_ids(self):
+        disruption = dict(description="Hammersmith & City Line: No service.",
+                          affectedRoutes=[{'lineId': 'Circle'}])
+        self.assertEqual(module.index_keys([disruption]),
+                         [('line', 'circle'), ('line', 'hammersmith-city')])
+        self.assertEqual(
+            module.index_keys([dict(description="Minor delays on buses.")]),
+            [])
+
+    def test_not_disruptions(self):
+        self.assertEqual(module.index_keys(None), [])
+        self.assertEqual(module.index_keys({'category': 'RealTime'}), [])
+        self.assertEqual(module.index_keys(['text', 1]), [])
+
+    def test_parse_filters(self):
+        self.assertEqual(
+            module.parse_filters({
+                'line': 'Central',
+                'closureText': 'minorDelays',
+                'category': '',
+                'other': 'x'
+            }), {
+                'line': 'central',
+                'closureText': 'minorDelays'
+            })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,252 @@
+"""End to end throughput and latency of the app, against a local tfl stub.
+
+    python e2e_bench.py --tasks 2000 --rate 500 --latency 0.02 --error-rate 0.01
+
+For each store backend this runs the app's components on the store, and
+    - schedules tasks straight through TflScheduler at --rate per second
+    - posts tasks to TflAppServer at --rate per second, then reads each back
+    - times store writes and reads on their own
+and prints tasks/sec, p50/p99 latency from scheduling to completion, and the
+store's write and read latencies. Tasks whose fetch kept failing are counted
+as errors once the run has drained for --drain seconds.
+
+The sqlite backend is SQLiteStore on a file. The sql backend is SQLStore on a
+sqlite file, or --database-url, e.g. a local postgres.
+With --no-cache tasks are not coalesced or served from the response cache,
+so every task is a request to the stub.
+"""
+import argparse
+import contextlib
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import typing as ty
+
+import constants as c
+import tlog
+from components import AppComponents, set_components
+from line_index import get_line_index
+from notifier import get_notifier
+from sqlite_store import SQLiteStore
+from store import AbstractMemoryStore, InMemoryStore, SQLStore
+from tfl_scheduler import TflScheduler
+from tfl_stub import MODE2LINES, TflStubServer, make_disruption
+from url_helper import TflUrlHelper, url_from_lines
+
+BACKENDS = ["memory", "sqlite", "sql"]
+LINES = MODE2LINES["tube"]
+STORE_OPS = 1000
+
+
+def lines_for(i: int) -> ty.List[str]:
+    # one or two tube lines, so tasks spread over 66 different urls
+    return sorted({LINES[i % len(LINES)], LINES[i // len(LINES) % len(LINES)]})
+
+
+def percentile(values: ty.List[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class CompletionTimes:
+    """Time each task completed at, from the store's completion listener"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.times: ty.Dict[str, float] = dict()
+
+    def __call__(self, task_ids: ty.List[str]):
+        now = time.perf_counter()
+        with self._lock:
+            for task_id in task_ids:
+                self.times.setdefault(task_id, now)
+
+
+def paced(count: int, rate: float) -> ty.Iterator[int]:
+    """range(count), sleeping so items come at most rate per second"""
+    start = time.perf_counter()
+    for i in range(count):
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        yield i
+
+
+def drain(task_ids: ty.Iterable[str], completions: CompletionTimes,
+          timeout: float):
+    """Wait up to timeout seconds for every task to complete"""
+    task_ids = list(task_ids)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(task_id in completions.times for task_id in task_ids):
+            return
+        time.sleep(0.01)
+
+
+def summarise(name: str, submitted: ty.Dict[str, float],
+              completions: CompletionTimes) -> ty.Dict[str, ty.Any]:
+    latencies = [
+        completions.times[task_id] - at
+        for task_id, at in submitted.items() if task_id in completions.times
+    ]
+    seconds = max(completions.times.get(task_id, 0)
+                  for task_id in submitted) - min(submitted.values())
+    return {
+        "phase": name,
+        "tasks": len(submitted),
+        "errors": len(submitted) - len(latencies),
+        "tasks/s": len(latencies) / seconds if seconds > 0 else float("nan"),
+        "p50 ms": percentile(latencies, 50) * 1e3,
+        "p99 ms": percentile(latencies, 99) * 1e3,
+    }
+
+
+def bench_scheduler(components: AppComponents, completions: CompletionTimes,
+                    args) -> ty.Dict[str, ty.Any]:
+    submitted = dict()
+    for i in paced(args.tasks, args.rate):
+        at = time.perf_counter()
+        task_id = components.tfl_scheduler.schedule_tfl_call(
+            url=url_from_lines(lines_for(i)), dt=None)
+        submitted[task_id] = at
+    drain(submitted, completions, args.drain)
+    return summarise("scheduler", submitted, completions)
+
+
+def bench_app(client, completions: CompletionTimes,
+              args) -> ty.Dict[str, ty.Any]:
+    submitted = dict()
+    for i in paced(args.tasks, args.rate):
+        at = time.perf_counter()
+        resp = client.post("/tasks", data={"lines": ",".join(lines_for(i))})
+        submitted[resp.data.decode().split()[-1]] = at
+    drain(submitted, completions, args.drain)
+    summary = summarise("app", submitted, completions)
+
+    reads = []
+    # the view prints every task id it is asked for
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for task_id in submitted:
+            start = time.perf_counter()
+            client.get(f"/tasks/{task_id}")
+            reads.append(time.perf_counter() - start)
+    summary["get p50 ms"] = percentile(reads, 50) * 1e3
+    summary["get p99 ms"] = percentile(reads, 99) * 1e3
+    return summary
+
+
+def bench_store(store: AbstractMemoryStore) -> ty.Dict[str, ty.Any]:
+    response = [make_disruption("central")]
+    writes, reads = [], []
+    for i in range(STORE_OPS):
+        start = time.perf_counter()
+        store.add_response(f"store-bench-{i}", response)
+        writes.append(time.perf_counter() - start)
+    for i in range(STORE_OPS):
+        start = time.perf_counter()
+        store.get_task_id_response(f"store-bench-{i}")
+        reads.append(time.perf_counter() - start)
+    return {
+        "phase": "store",
+        "write p50 ms": percentile(writes, 50) * 1e3,
+        "write p99 ms": percentile(writes, 99) * 1e3,
+        "read p50 ms": percentile(reads, 50) * 1e3,
+        "read p99 ms": percentile(reads, 99) * 1e3,
+    }
+
+
+def make_store(backend: str, args, tmp_dir: str) -> AbstractMemoryStore:
+    if backend == "memory":
+        return InMemoryStore()
+    if backend == "sqlite":
+        return SQLiteStore(os.path.join(tmp_dir, "e2e_bench_embedded.db"))
+    return SQLStore(database_url=args.database_url or
+                    f"sqlite:///{os.path.join(tmp_dir, 'e2e_bench.db')}")
+
+
+def make_components(store: AbstractMemoryStore, args) -> AppComponents:
+    if not args.no_cache:
+        return AppComponents.create(store=store)
+    tfl_scheduler = TflScheduler(store=store)
+    notifier = get_notifier()
+    store.add_completion_listener(notifier.notify)
+    return AppComponents(store=store,
+                         tfl_scheduler=tfl_scheduler,
+                         url_helper=TflUrlHelper(line_index=get_line_index()),
+                         notifier=notifier)
+
+
+def run_backend(backend: str, args, tfl_api_url: str, tmp_dir: str):
+    tlog.configure("error")
+    c.TFL_API_URL = tfl_api_url
+    store = make_store(backend, args, tmp_dir)
+    components = make_components(store, args)
+    completions = CompletionTimes()
+    store.add_completion_listener(completions)
+    set_components(components)
+    import run
+    client = run.app.test_client()
+
+    print(f"{backend} store, {type(store).__name__}")
+    print_rows([
+        bench_scheduler(components, completions, args),
+        bench_app(client, completions, args),
+        bench_store(store),
+    ])
+    components.shutdown()
+
+
+def print_rows(rows: ty.List[ty.Dict[str, ty.Any]]):
+    for row in rows:
+        print("  ".join(
+            f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}"
+            for k, v in row.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS,
+                        default=BACKENDS)
+    parser.add_argument("--tasks", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=500,
+                        help="tasks submitted per second")
+    parser.add_argument("--latency", type=float, default=0.01,
+                        help="seconds the stub takes per request")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of stub requests answered with a 503")
+    parser.add_argument("--disruptions", type=int, default=3,
+                        help="disruptions per line in each response")
+    parser.add_argument("--padding", type=int, default=0,
+                        help="extra characters per disruption")
+    parser.add_argument("--database-url")
+    parser.add_argument("--drain", type=float, default=30,
+                        help="seconds to wait for tasks to complete")
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args()
+
+    stub = TflStubServer(latency=args.latency,
+                         error_rate=args.error_rate,
+                         disruptions_per_line=args.disruptions,
+                         padding=args.padding).start()
+    # a process per backend, as the app's view takes its components when the
+    # view is registered, on import
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for backend in args.backends:
+            requests_before = stub.requests
+            process = context.Process(target=run_backend,
+                                      args=(backend, args, stub.url, tmp_dir))
+            process.start()
+            process.join()
+            print(f"  stub requests={stub.requests - requests_before}")
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import threading
+import typing as ty
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import tlog
+from misc_utils import retry_func
+
+DEFAULT_POOL_SIZE = 10  # apscheduler's default thread pool size
+DEFAULT_CONNECT_TIMEOUT = 3.05  # seconds
+DEFAULT_READ_TIMEOUT = 10  # seconds
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_WAITING_TIME = 0.5  # seconds, before the first retry
+DEFAULT_BACKOFF = 2
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+_global_http_client = None
+
+
+def get_http_client(pool_size: int = DEFAULT_POOL_SIZE):
+    """Process wide client, so every caller shares the same connection pool.
+
+    pool_size is only used the first time the client is created.
+    """
+    global _global_http_client
+    if _global_http_client is None:
+        _global_http_client = TflHttpClient(pool_size=pool_size)
+    return _global_http_client
+
+
+class RetryableStatusError(requests.HTTPError):
+    pass
+
+
+class TflHttpClient:
+    """Keep-alive http client with a bounded connection pool.
+
+    Connection errors, timeouts and 429/5xx responses are retried with
+    exponential backoff. Other responses, including 4xx errors, are returned
+    as they are.
+    """
+
+    def __init__(self,
+                 pool_size: int = DEFAULT_POOL_SIZE,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 waiting_time: float = DEFAULT_WAITING_TIME,
+                 backoff: float = DEFAULT_BACKOFF):
+        tlog.info(f"Initialising http client, pool_size = {pool_size}")
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_attempts = max_attempts
+        self.waiting_time = waiting_time
+        self.backoff = backoff
+
+        # retries are done by us, not urllib3, so they show up in the stats
+        self.adapter = HTTPAdapter(pool_connections=pool_size,
+                                   pool_maxsize=pool_size,
+                                   max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.session.headers.update({
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive",
+        })
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.in_flight = 0
+
+    def _get(self, url: str) -> requests.Response:
+        resp = self.session.get(url, timeout=self.timeout)
+        if resp.status_code in RETRY_STATUS_CODES:
+            raise RetryableStatusError(
+                f"{resp.status_code} from {url}", response=resp)
+        return resp
+
+    def _on_retry(self, e: Exception, attempts: int):
+        tlog.warn(f"retrying after attempt {attempts}", err=e)
+        with self._lock:
+            self.retries += 1
+
+    def get(self, url: str) -> requests.Response:
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+        try:
+            resp, _ = retry_func(self._get,
+                                 url,
+                                 max_attempts=self.max_attempts,
+                                 waiting_time=self.waiting_time,
+                                 backoff=self.backoff,
+                                 only_exception_type=(
+                                     requests.ConnectionError,
+                                     requests.Timeout,
+                                     RetryableStatusError,
+                                 ),
+                                 on_retry=self._on_retry)
+            return resp
+        except Exception as e:
+            with self._lock:
+                self.failures += 1
+            tlog.error(f"giving up on {url}", err=e)
+            raise e
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def get_json(self, url: str) -> ty.Any:
+        return self.get(url).json()
+
+    def close(self):
+        self.session.close()
+
+    def stats(self) -> ty.Dict[str, int]:
+        pools = self.adapter.poolmanager.pools
+        connections = 0
+        pool_requests = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            pool_requests += pool.num_requests
+        return {
+            "pool_size": self.pool_size,
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            "in_flight": self.in_flight,
+            "connections_opened": connections,
+            "connections_reused": max(pool_requests - connections, 0),
+        }
@@ -0,0 +1,51 @@
+import unittest
+
+import http_client as module
+from tfl_stub import TflStubServer
+
+
+class HttpClientTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.stub = TflStubServer().start()
+        self.client = module.TflHttpClient(pool_size=2, waiting_time=0.01)
+        self.url = f"{self.stub.url}/Line/bakerloo,jubilee/Disruption"
+
+    def tearDown(self) -> None:
+        self.client.close()
+        self.stub.stop()
+
+    def test_connections_are_reused(self):
+        for _ in range(10):
+            response = self.client.get_json(self.url)
+        self.assertEqual(len(response), 2)
+        self.assertEqual(self.stub.connections, 1)
+        stats = self.client.stats()
+        self.assertEqual(stats["connections_opened"], 1)
+        self.assertEqual(stats["connections_reused"], 9)
+
+    def test_gzip_is_negotiated(self):
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(resp.json()[0]["type"], "lineInfo")
+
+    def test_retries_server_errors(self):
+        self.stub.fail_next(2)
+        response = self.client.get_json(self.url)
+        self.assertEqual(len(response), 2)
+        self.assertEqual(self.client.stats()["retries"], 2)
+
+    def test_gives_up_after_max_attempts(self):
+        self.stub.fail_next(module.DEFAULT_MAX_ATTEMPTS)
+        with self.assertRaises(module.RetryableStatusError):
+            self.client.get(self.url)
+        self.assertEqual(self.client.stats()["failures"], 1)
+
+    def test_client_errors_are_not_retried(self):
+        resp = self.client.get(f"{self.stub.url}/Line/nowhere")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(self.stub.requests, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import json
+import os
+import threading
+import time
+import typing as ty
+
+import constants as c
+import tlog
+from http_client import get_http_client
+
+_global_line_index = None
+_global_line_index_lock = threading.Lock()
+
+
+def get_line_index():
+    """Process wide line index, loaded on first use.
+
+    One per process, so the index is loaded once and refreshed by one
+    thread, for every TflUrlHelper in the process.
+    """
+    global _global_line_index
+    with _global_line_index_lock:
+        if _global_line_index is None:
+            _global_line_index = LineIndex(modes=c.LINE_INDEX_MODES,
+                                           ttl=c.LINE_INDEX_TTL,
+                                           snapshot_path=c.LINE_INDEX_SNAPSHOT)
+            _global_line_index.start()
+    return _global_line_index
+
+
+def fetch_line2mode(modes: ty.List[str]) -> ty.Dict[str, str]:
+    url = f"{c.TFL_API_URL}/Line/Mode/{','.join(modes)}"
+    return {r['id']: r['modeName'] for r in get_http_client().get_json(url)}
+
+
+class LineIndex:
+    """Valid line ids of the given modes, with the mode of each line.
+
+    The index is loaded from `snapshot_path` if there is a snapshot of the
+    same modes and api, and from tfl otherwise. After that it is refreshed in a
+    background thread every `ttl` seconds, and saved back to the snapshot. If
+    a refresh fails the index keeps the lines it had.
+
+    Args:
+        modes: tfl modes whose lines are valid, e.g. ["tube", "bus"]
+        ttl: seconds between refreshes
+        snapshot_path: json file the index is saved to, or None not to save
+        fetch: returns a line id -> mode dict for the modes
+    """
+
+    def __init__(self,
+                 modes: ty.List[str],
+                 ttl: float = c.LINE_INDEX_TTL,
+                 snapshot_path: ty.Optional[str] = None,
+                 fetch: ty.Callable[[ty.List[str]], ty.Dict[str, str]] = (
+                     fetch_line2mode)):
+        self.modes = sorted(modes)
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self.fetch = fetch
+        # replaced as a whole on refresh, so readers never need a lock
+        self.line2mode: ty.Dict[str, str] = dict()
+        self.loaded_at: ty.Optional[float] = None
+        self.refreshes = 0
+        self.failed_refreshes = 0
+        self._closed = threading.Event()
+        self._thread = None
+
+    def __contains__(self, line_id: str) -> bool:
+        return line_id in self.line2mode
+
+    def __len__(self):
+        return len(self.line2mode)
+
+    def mode_of(self, line_id: str) -> ty.Optional[str]:
+        return self.line2mode.get(line_id)
+
+    def valid_ids(self) -> ty.KeysView:
+        return self.line2mode.keys()
+
+    def start(self):
+        """Load the index, then keep it fresh in the background"""
+        if not self.load_snapshot():
+            self.refresh(raise_errors=True)
+        self._thread = threading.Thread(target=self._refresh_periodically,
+                                        name="tfl-line-index",
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _refresh_periodically(self):
+        # a snapshot may already be due a refresh when it is loaded
+        wait = max(0.0, self.loaded_at + self.ttl - time.time())
+        while not self._closed.wait(wait):
+            self.refresh()
+            wait = self.ttl
+
+    def refresh(self, raise_errors: bool = False):
+        try:
+            line2mode = self.fetch(self.modes)
+        except Exception as e:
+            self.failed_refreshes += 1
+            tlog.error("could not refresh line index", err=e)
+            if raise_errors:
+                raise
+            return
+        self.line2mode = line2mode
+        self.loaded_at = time.time()
+        self.refreshes += 1
+        tlog.info("refreshed line index", lines=len(line2mode))
+        self.save_snapshot()
+
+    def _snapshot_key(self) -> dict:
+        return {"api": c.TFL_API_URL, "modes": self.modes}
+
+    def load_snapshot(self) -> bool:
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            if snapshot["key"] != self._snapshot_key():
+                return False
+            self.line2mode = snapshot["line2mode"]
+            self.loaded_at = snapshot["loaded_at"]
+        except (OSError, ValueError, KeyError) as e:
+            tlog.error("ignoring unreadable line index snapshot",
+                       path=self.snapshot_path,
+                       err=e)
+            return False
+        tlog.info("loaded line index snapshot",
+                  path=self.snapshot_path,
+                  lines=len(self.line2mode))
+        return True
+
+    def save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        snapshot = {
+            "key": self._snapshot_key(),
+            "loaded_at": self.loaded_at,
+            "line2mode": self.line2mode,
+        }
+        # written aside and renamed, so a crash never leaves half a snapshot
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            tlog.error("could not save line index snapshot",
+                       path=self.snapshot_path,
+                       err=e)
+
+    def stats(self) -> ty.Dict[str, ty.Any]:
+        return {
+            "lines": len(self.line2mode),
+            "loaded_at": self.loaded_at,
+            "refreshes": self.refreshes,
+            "failed_refreshes": self.failed_refreshes,
+        }
@@ -0,0 +1,96 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+import constants as c
+import line_index as module
+from tfl_stub import MODE2LINES, TflStubServer
+from url_helper import TflUrlHelper
+
+
+class LineIndexTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.stub = TflStubServer().start()
+        cls._tfl_api_url = c.TFL_API_URL
+        c.TFL_API_URL = cls.stub.url
+
+    @classmethod
+    def tearDownClass(cls):
+        c.TFL_API_URL = cls._tfl_api_url
+        cls.stub.stop()
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.snapshot_path = os.path.join(self.tmp_dir.name, 'index.json')
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def make_index(self, **kwargs):
+        kwargs.setdefault('modes', ['tube', 'bus'])
+        kwargs.setdefault('snapshot_path', self.snapshot_path)
+        index = module.LineIndex(**kwargs).start()
+        self.addCleanup(index.close)
+        return index
+
+    def test_loads_every_mode(self):
+        index = self.make_index()
+        self.assertIn('bakerloo', index)
+        self.assertEqual(index.mode_of('bakerloo'), 'tube')
+        self.assertEqual(index.mode_of('1'), 'bus')
+        self.assertNotIn('dlr', index)
+        self.assertEqual(len(index),
+                         len(MODE2LINES['tube']) + len(MODE2LINES['bus']))
+
+    def test_cold_start_from_snapshot(self):
+        self.make_index().close()
+        requests = self.stub.requests
+        index = self.make_index()
+        self.assertEqual(self.stub.requests, requests)
+        self.assertIn('victoria', index)
+
+        # a snapshot of other modes is not used
+        index = self.make_index(modes=['dlr'])
+        self.assertEqual(self.stub.requests, requests + 1)
+        self.assertEqual(list(index.valid_ids()), ['dlr'])
+
+    def test_unreadable_snapshot_is_ignored(self):
+        with open(self.snapshot_path, 'w') as f:
+            f.write('{not json')
+        self.assertIn('victoria', self.make_index())
+        with open(self.snapshot_path) as f:
+            self.assertIn('victoria', json.load(f)['line2mode'])
+
+    def test_background_refresh_keeps_lines_on_failure(self):
+        line2modes = [{'a': 'tube'}, {'a': 'tube', 'b': 'tube'}]
+
+        def fetch(modes):
+            if not line2modes:
+                raise ValueError('tfl is down')
+            return line2modes.pop(0)
+
+        index = self.make_index(ttl=0.05, fetch=fetch, snapshot_path=None)
+        self.assertEqual(set(index.valid_ids()), {'a'})
+        deadline = time.time() + 5
+        while index.failed_refreshes == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(set(index.valid_ids()), {'a', 'b'})
+        self.assertGreater(index.failed_refreshes, 0)
+
+    def test_url_helper_uses_index(self):
+        url_helper = TflUrlHelper(line_index=self.make_index())
+        requests = self.stub.requests
+        self.assertTrue(url_helper.is_valid_lines(['bakerloo', '1']))
+        self.assertFalse(url_helper.is_valid_lines(['bakerloo', 'juBilee']))
+        self.assertEqual(
+            url_helper.construct_url_from_lines('jubilee,bakerloo'),
+            f"{self.stub.url}/Line/bakerloo,jubilee/Disruption")
+        self.assertEqual(self.stub.requests, requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
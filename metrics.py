@@ -0,0 +1,244 @@
+import bisect
+import math
+import threading
+import time
+import typing as ty
+from functools import wraps
+
+import tlog
+
+# seconds, from a cached single row lookup to a slow bulk write
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10)
+
+PROMETHEUS_MIMETYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_global_metrics = None
+_global_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    global _global_metrics
+    with _global_metrics_lock:
+        if _global_metrics is None:
+            _global_metrics = MetricsRegistry()
+    return _global_metrics
+
+
+class Counter:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self) -> float:
+        return self.value
+
+
+class Gauge:
+    """A value that goes up and down, or is read from func when exported"""
+
+    def __init__(self, func: ty.Callable[[], float] = None):
+        self.func = func
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def snapshot(self) -> float:
+        if self.func is None:
+            return self.value
+        try:
+            return self.func()
+        except Exception as e:
+            tlog.error("could not read gauge", err=e)
+            return math.nan
+
+
+class Histogram:
+    """Counts of observed values per bucket, with their count and sum.
+
+    Buckets are upper bounds, values above the last one are only in the count.
+    """
+
+    def __init__(self, buckets: ty.Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if i < len(self._counts):
+                self._counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self) -> "_Timer":
+        """Context manager observing the seconds the block takes, even if it
+        raises"""
+        return _Timer(self)
+
+    def snapshot(self) -> ty.Dict[str, ty.Any]:
+        """count, sum, and the cumulative count of each bucket"""
+        with self._lock:
+            counts = list(self._counts)
+            count, total = self.count, self.sum
+        cumulative, buckets = 0, []
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            buckets.append((bound, cumulative))
+        return {"count": count, "sum": total, "buckets": buckets}
+
+
+class _Timer:
+    # a class rather than a contextmanager generator, which costs 3 times as
+    # much, as timers run on every task
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class MetricsRegistry:
+    """Named metrics of this process, each name with any number of label
+    sets. Asking for a metric again returns the same one, so callers can look
+    them up where they are used."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (kind, help, {labels: metric})
+        self._metrics: ty.Dict[str, ty.Tuple[str, str, dict]] = dict()
+
+    def _get(self, kind: str, name: str, help: str, factory, labels: dict):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = (kind, help, dict())
+            registered_kind, _, series = self._metrics[name]
+            if registered_kind != kind:
+                raise ValueError(f"{name} is a {registered_kind}, not a {kind}")
+            if key not in series:
+                series[key] = factory()
+            return series[key]
+
+    def counter(self, name: str, help: str = "", **labels) -> Counter:
+        return self._get("counter", name, help, Counter, labels)
+
+    def gauge(self,
+              name: str,
+              help: str = "",
+              func: ty.Callable[[], float] = None,
+              **labels) -> Gauge:
+        """func, if given, replaces the func of a gauge already there"""
+        gauge = self._get("gauge", name, help, Gauge, labels)
+        if func is not None:
+            gauge.func = func
+        return gauge
+
+    def histogram(self,
+                  name: str,
+                  help: str = "",
+                  buckets: ty.Sequence[float] = DEFAULT_BUCKETS,
+                  **labels) -> Histogram:
+        return self._get("histogram", name, help, lambda: Histogram(buckets),
+                         labels)
+
+    def snapshot(self) -> ty.Dict[str, ty.Dict[str, ty.Any]]:
+        """{name: {"kind", "help", "series": [(labels, value)]}}"""
+        with self._lock:
+            metrics = {
+                name: (kind, help, list(series.items()))
+                for name, (kind, help, series) in self._metrics.items()
+            }
+        return {
+            name: {
+                "kind": kind,
+                "help": help,
+                "series": [(dict(key), metric.snapshot())
+                           for key, metric in series],
+            } for name, (kind, help, series) in metrics.items()
+        }
+
+
+def _prometheus_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+def _prometheus_labels(labels: ty.Dict[str, ty.Any]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n") for value in labels.values())
+    return "{" + ",".join(
+        f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def prometheus_text(registry: MetricsRegistry = None) -> str:
+    """The registry's metrics, get_metrics() by default, in the prometheus
+    text exposition format"""
+    lines = []
+    snapshot = (registry or get_metrics()).snapshot()
+    for name, metric in sorted(snapshot.items()):
+        if metric["help"]:
+            lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for labels, value in metric["series"]:
+            if metric["kind"] != "histogram":
+                lines.append(f"{name}{_prometheus_labels(labels)} "
+                             f"{_prometheus_value(value)}")
+                continue
+            for bound, count in value["buckets"] + [(math.inf, value["count"])]:
+                bucket_labels = dict(labels, le=_prometheus_value(bound))
+                lines.append(
+                    f"{name}_bucket{_prometheus_labels(bucket_labels)} {count}")
+            lines.append(f"{name}_sum{_prometheus_labels(labels)} "
+                         f"{_prometheus_value(value['sum'])}")
+            lines.append(f"{name}_count{_prometheus_labels(labels)} "
+                         f"{value['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def timed(name: str, help: str = "", **labels):
+    """Decorator observing the seconds each call takes in the `name`
+    histogram, labelled with the function's name"""
+
+    def decorator(func):
+        histogram = get_metrics().histogram(name,
+                                            help=help,
+                                            method=func.__name__,
+                                            **labels)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time():
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,89 @@
+import threading
+import unittest
+
+import metrics as module
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_buckets_are_cumulative(self):
+        histogram = module.Histogram(buckets=[0.1, 1])
+        for value in [0.05, 0.1, 0.5, 5]:
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["buckets"], [(0.1, 2), (1, 3)])
+        self.assertEqual(snapshot["count"], 4)
+        self.assertAlmostEqual(snapshot["sum"], 5.65)
+
+    def test_time(self):
+        histogram = module.Histogram()
+        with self.assertRaises(KeyError):
+            with histogram.time():
+                raise KeyError()
+        self.assertEqual(histogram.count, 1)
+
+
+class MetricsRegistryTest(unittest.TestCase):
+
+    def test_same_name_and_labels_is_same_metric(self):
+        registry = module.MetricsRegistry()
+        registry.counter("calls", outcome="ok").inc()
+        registry.counter("calls", outcome="ok").inc(2)
+        registry.counter("calls", outcome="failed").inc()
+        series = dict((labels["outcome"], value) for labels, value in
+                      registry.snapshot()["calls"]["series"])
+        self.assertEqual(series, {"ok": 3, "failed": 1})
+        with self.assertRaises(ValueError):
+            registry.histogram("calls")
+
+    def test_counter_is_thread_safe(self):
+        counter = module.MetricsRegistry().counter("calls")
+
+        def inc():
+            for _ in range(10000):
+                counter.inc()
+
+        threads = [threading.Thread(target=inc) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.value, 40000)
+
+    def test_prometheus_text(self):
+        registry = module.MetricsRegistry()
+        registry.counter("calls_total", help="Calls", path='a"b').inc(2)
+        registry.gauge("queued", func=lambda: 7)
+        histogram = registry.histogram("call_seconds", buckets=[0.1, 1])
+        histogram.observe(0.5)
+        histogram.observe(5)
+        lines = module.prometheus_text(registry).splitlines()
+        self.assertIn("# HELP calls_total Calls", lines)
+        self.assertIn("# TYPE calls_total counter", lines)
+        self.assertIn('calls_total{path="a\\"b"} 2', lines)
+        self.assertIn("queued 7", lines)
+        self.assertIn('call_seconds_bucket{le="0.1"} 0', lines)
+        self.assertIn('call_seconds_bucket{le="1"} 1', lines)
+        self.assertIn('call_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn("call_seconds_sum 5.5", lines)
+        self.assertIn("call_seconds_count 2", lines)
+
+    def test_broken_gauge_is_nan(self):
+        registry = module.MetricsRegistry()
+        registry.gauge("broken", func=lambda: 1 / 0)
+        self.assertIn("broken NaN", module.prometheus_text(registry))
+
+    def test_timed(self):
+
+        @module.timed("timed_test_seconds")
+        def work(x):
+            return x * 2
+
+        self.assertEqual(work(2), 4)
+        histogram = module.get_metrics().histogram("timed_test_seconds",
+                                                   method="work")
+        self.assertEqual(histogram.count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,11 @@
+import json
 import typing as ty
 import time
 
 DEFAULT_MAX_ATTEMPTS = 10
 DEFAULT_WAITING_TIME = 1  # seconds
 DEFAULT_EXCEPTION = Exception
+DEFAULT_BACKOFF = 1  # no backoff, wait the same time between attempts
 
 
 def retry_func(
@@ -12,6 +14,8 @@ def retry_func(
     max_attempts: int = DEFAULT_MAX_ATTEMPTS,
     waiting_time: float = DEFAULT_WAITING_TIME,
     only_exception_type=DEFAULT_EXCEPTION,
+    backoff: float = DEFAULT_BACKOFF,
+    on_retry: ty.Optional[ty.Callable[[Exception, int], None]] = None,
     **kwargs,
 ) -> ty.Tuple[ty.Any, int]:
     """Wrapper that, when applied, retries running the function
@@ -21,6 +25,9 @@ def retry_func(
         max_attempts: max attempts
         waiting_time: time in seconds between attempts
         only_exception_type: if specified, we only retry for this exception
+        backoff: the waiting time is multiplied by this after every attempt
+        on_retry: if specified, called with the exception and the number of
+            attempts so far before every retry
 
     Returns: the result of the function and the number of times it was called
     """
@@ -35,5 +42,13 @@ def retry_func(
         except only_exception_type as e:
             if times_called >= max_attempts:
                 raise e
+            if on_retry is not None:
+                on_retry(e, times_called)
             time.sleep(waiting_time)
-    return result, times_called
\ No newline at end of file
+            waiting_time *= backoff
+    return result, times_called
+
+
+def approx_size(value) -> int:
+    """Approximate size of a json-like value, in bytes"""
+    return len(json.dumps(value, default=str))
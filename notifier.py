@@ -0,0 +1,100 @@
+import threading
+import time
+import typing as ty
+from contextlib import contextmanager
+
+from store import AbstractMemoryStore
+
+DEFAULT_POLL_INTERVAL = 1  # seconds, see wait_for_response
+
+MISSING = object()
+
+_global_notifier = None
+_global_notifier_lock = threading.Lock()
+
+
+def get_notifier():
+    global _global_notifier
+    with _global_notifier_lock:
+        if _global_notifier is None:
+            _global_notifier = CompletionNotifier()
+    return _global_notifier
+
+
+class CompletionNotifier:
+    """Wakes threads waiting for tasks to complete.
+
+    Register it with `store.add_completion_listener(notifier.notify)`. Only
+    tasks that are being waited for cost anything.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # task_id -> (event, number of waiters)
+        self._waiters: ty.Dict[str, ty.Tuple[threading.Event, int]] = dict()
+        self.notified = 0
+
+    @contextmanager
+    def watch(self, task_id: str) -> ty.Iterator[threading.Event]:
+        """Event set when task_id completes. Check the store after entering,
+        so a completion just before then is not missed"""
+        with self._lock:
+            event, waiters = self._waiters.get(task_id,
+                                               (threading.Event(), 0))
+            self._waiters[task_id] = (event, waiters + 1)
+        try:
+            yield event
+        finally:
+            with self._lock:
+                event, waiters = self._waiters[task_id]
+                if waiters == 1:
+                    del self._waiters[task_id]
+                else:
+                    self._waiters[task_id] = (event, waiters - 1)
+
+    def notify(self, task_ids: ty.Iterable[str]):
+        if not self._waiters:
+            return
+        with self._lock:
+            for task_id in task_ids:
+                waiter = self._waiters.get(task_id)
+                if waiter is not None:
+                    waiter[0].set()
+                    self.notified += 1
+
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+
+def _get_response(store: AbstractMemoryStore, task_id: str):
+    try:
+        response = store.get_task_id_response(task_id)
+    except ValueError:
+        return MISSING
+    # the sql store returns None for unknown tasks
+    return MISSING if response is None else response
+
+
+def wait_for_response(store: AbstractMemoryStore,
+                      notifier: CompletionNotifier,
+                      task_id: str,
+                      timeout: float,
+                      poll_interval: float = DEFAULT_POLL_INTERVAL):
+    """The task's response, waiting up to timeout seconds for it.
+
+    Wakes as soon as the task completes in this process. Tasks completed by
+    other processes, e.g. queue workers, are picked up by looking at the store
+    every poll_interval seconds.
+
+    Returns: the response, or MISSING if the task did not complete in time
+    """
+    deadline = time.monotonic() + timeout
+    with notifier.watch(task_id) as completed:
+        while True:
+            response = _get_response(store, task_id)
+            if response is not MISSING:
+                return response
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return MISSING
+            completed.wait(min(remaining, poll_interval))
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import notifier as module
+from store import InMemoryStore, SQLStore
+from write_buffer import WriteBehindStore
+
+
+class NotifierTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.notifier = module.CompletionNotifier()
+
+    def wait_in_thread(self, store, task_id, timeout=5, poll_interval=60):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            module.wait_for_response(store, self.notifier, task_id, timeout,
+                                     poll_interval)))
+        thread.start()
+        deadline = time.time() + 5
+        while self.notifier.waiting() == 0 and time.time() < deadline:
+            time.sleep(0.001)
+        return thread, results
+
+    def test_woken_by_each_store(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        # a file, as each thread gets its own in-memory sqlite database
+        db_path = os.path.join(tmp_dir.name, 'tasks.db')
+        stores = {
+            'memory': InMemoryStore(),
+            'sqlite': SQLStore(database_url=f'sqlite:///{db_path}'),
+            'write behind': WriteBehindStore(InMemoryStore(), max_delay=60),
+        }
+        for name, store in stores.items():
+            with self.subTest(store=name):
+                store.add_completion_listener(self.notifier.notify)
+                thread, results = self.wait_in_thread(store, 'task')
+                start = time.monotonic()
+                store.add_responses_bulk([('task', ['response'])])
+                thread.join()
+                # woken, rather than waiting for the 60s poll
+                self.assertLess(time.monotonic() - start, 5)
+                self.assertEqual(results, [['response']])
+                self.assertEqual(self.notifier.waiting(), 0)
+
+    def test_completed_before_waiting(self):
+        store = InMemoryStore()
+        store.add_response('task', ['response'])
+        self.assertEqual(
+            module.wait_for_response(store, self.notifier, 'task', 0),
+            ['response'])
+
+    def test_timeout(self):
+        start = time.monotonic()
+        self.assertIs(
+            module.wait_for_response(InMemoryStore(), self.notifier, 'task',
+                                     0.1), module.MISSING)
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+    def test_picks_up_other_processes_completions(self):
+        # the listener is not registered, as for a task completed by a worker
+        store = InMemoryStore()
+        thread, results = self.wait_in_thread(store,
+                                              'task',
+                                              poll_interval=0.01)
+        store.add_response('task', ['response'])
+        thread.join()
+        self.assertEqual(results, [['response']])
+
+
+if __name__ == '__main__':
+    unittest.main()
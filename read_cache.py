@@ -0,0 +1,194 @@
+import threading
+import typing as ty
+from datetime import datetime
+
+from response_cache import MISSING, LRUCache
+from store import DEFAULT_BATCH_SIZE, DEFAULT_PAGE_SIZE, AbstractMemoryStore
+
+DEFAULT_MAX_ENTRIES = 100_000
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_NEGATIVE_TTL = 1  # seconds
+
+# cached misses, for stores that raise on unknown tasks or return None
+_RAISED = object()
+_NONE = object()
+
+
+class CachingStore(AbstractMemoryStore):
+    """Read-through cache in front of another store.
+
+    A finished task's response does not change, so it is cached until it is
+    evicted by the memory budget, or the task is removed through this store.
+    Lookups of tasks that are not finished, and whether a task is pending,
+    are cached for `negative_ttl` seconds, so a task completed by another
+    process is seen at most that late. Writes through this store update the
+    cache straight away. Completions `store` notifies of clear their cached
+    misses before this store's own completion listeners are called, so the
+    listeners read the responses. Everything else is passed to `store`.
+
+    Args:
+        store: the store being cached
+        cache: cache of responses, pass one to share it between stores.
+            Keys are task ids
+        max_entries: max responses cached, if cache is not given
+        max_bytes: max approximate size of the cached responses, as json, if
+            cache is not given
+        negative_ttl: seconds misses and pending states are cached for
+    """
+
+    def __init__(self,
+                 store: AbstractMemoryStore,
+                 cache: LRUCache = None,
+                 max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_bytes: int = DEFAULT_MAX_BYTES,
+                 negative_ttl: float = DEFAULT_NEGATIVE_TTL):
+        self.store = store
+        if cache is None:
+            cache = LRUCache(max_entries=max_entries,
+                             max_bytes=max_bytes,
+                             ttl=None)
+        self.cache = cache
+        self.negative_ttl = negative_ttl
+        # (kind, task_id) -> miss marker or pending state
+        self.short_cache = LRUCache(max_entries=max_entries,
+                                    ttl=negative_ttl,
+                                    size_of=lambda _: 1)
+        # bumped by every write, so a read that raced with a write does not
+        # cache what it read from before the write
+        self._generation = 0
+        # the same for responses, which only change when they are removed
+        self._removals = 0
+        self._lock = threading.Lock()
+        # set here, so it is not looked up on store by __getattr__
+        self._completion_listeners = []
+        store.add_completion_listener(self._completed)
+
+    def __getattr__(self, name):
+        # store specific methods, e.g. the sql store's claims
+        if name == "store":
+            raise AttributeError(name)
+        return getattr(self.store, name)
+
+    def _written(self, task_ids: ty.Iterable[str]):
+        with self._lock:
+            self._generation += 1
+        for task_id in task_ids:
+            self.short_cache.invalidate(("response", task_id))
+            self.short_cache.invalidate(("pending", task_id))
+
+    def _completed(self, task_ids: ty.List[str]):
+        self._written(task_ids)
+        self._notify_completed(task_ids)
+
+    def get_task_id_response(self, task_id):
+        response = self.cache.get(task_id)
+        if response is not MISSING:
+            return response
+        miss = self.short_cache.get(("response", task_id))
+        if miss is _NONE:
+            return None
+        if miss is _RAISED:
+            raise ValueError(f"Store does not have {task_id}")
+
+        generation, removals = self._generation, self._removals
+        try:
+            response = self.store.get_task_id_response(task_id)
+        except ValueError:
+            if generation == self._generation:
+                self.short_cache.set(("response", task_id), _RAISED)
+            raise
+        if response is None:
+            if generation == self._generation:
+                self.short_cache.set(("response", task_id), _NONE)
+        elif removals == self._removals:
+            self.cache.set(task_id, response)
+        return response
+
+    def is_pending_task_id(self, task_id):
+        if self.cache.get(task_id) is not MISSING:
+            return False
+        pending = self.short_cache.get(("pending", task_id))
+        if pending is not MISSING:
+            return pending
+        generation = self._generation
+        pending = self.store.is_pending_task_id(task_id)
+        if generation == self._generation:
+            self.short_cache.set(("pending", task_id), pending)
+        return pending
+
+    def add_response(self, task_id, response):
+        self.add_responses_bulk([(task_id, response)])
+
+    def add_responses_bulk(self, items: ty.Iterable[ty.Tuple[str, ty.Any]]):
+        items = list(items)
+        self.store.add_responses_bulk(items)
+        self._written(task_id for task_id, _ in items)
+        for task_id, response in items:
+            self.cache.set(task_id, response)
+
+    def add_pending_task_id(self, task_id, dt_str: str, url: str):
+        self.store.add_pending_task_id(task_id, dt_str, url)
+        self._written([task_id])
+
+    def add_pending_tasks_bulk(self,
+                               items: ty.Iterable[ty.Tuple[str, str, str]]):
+        items = list(items)
+        self.store.add_pending_tasks_bulk(items)
+        self._written(task_id for task_id, _, _ in items)
+
+    def remove_pending_task_id(self, task_id):
+        self.store.remove_pending_task_id(task_id)
+        self._written([task_id])
+
+    def complete_tasks_bulk(self, task_ids: ty.Iterable[str]):
+        task_ids = list(task_ids)
+        self.store.complete_tasks_bulk(task_ids)
+        self._written(task_ids)
+
+    def remove_finished_task(self, task_id):
+        self.store.remove_finished_task(task_id)
+        with self._lock:
+            self._removals += 1
+        self.cache.invalidate(task_id)
+        self._written([task_id])
+
+    def get_all_pending_tasks(self):
+        return self.store.get_all_pending_tasks()
+
+    def count_pending_tasks(self):
+        return self.store.count_pending_tasks()
+
+    def get_all_finished_tasks(self):
+        return self.store.get_all_finished_tasks()
+
+    def iter_pending_tasks(self, batch_size: int = DEFAULT_BATCH_SIZE):
+        return self.store.iter_pending_tasks(batch_size=batch_size)
+
+    def get_due_tasks(self,
+                      until: datetime = None,
+                      limit: int = DEFAULT_PAGE_SIZE):
+        return self.store.get_due_tasks(until=until, limit=limit)
+
+    def get_finished_tasks_page(self,
+                                limit: int = DEFAULT_PAGE_SIZE,
+                                cursor: str = None):
+        return self.store.get_finished_tasks_page(limit=limit, cursor=cursor)
+
+    def iter_finished_tasks(self, batch_size: int = DEFAULT_BATCH_SIZE):
+        return self.store.iter_finished_tasks(batch_size=batch_size)
+
+    def find_finished_tasks(self,
+                            filters: ty.Dict[str, str],
+                            since: datetime = None,
+                            limit: int = DEFAULT_PAGE_SIZE,
+                            cursor: str = None):
+        return self.store.find_finished_tasks(filters,
+                                              since=since,
+                                              limit=limit,
+                                              cursor=cursor)
+
+    def stats(self) -> ty.Dict[str, ty.Any]:
+        return {
+            "responses": self.cache.stats(),
+            "misses": self.short_cache.stats(),
+        }
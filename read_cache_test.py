@@ -0,0 +1,105 @@
+import os
+import tempfile
+import time
+import unittest
+
+import read_cache as module
+from store import InMemoryStore, SQLStore
+from tfl_scheduler import EXECUTOR_QUEUE, TflScheduler
+
+
+class CountingStore(InMemoryStore):
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    def get_task_id_response(self, task_id):
+        self.reads += 1
+        return super().get_task_id_response(task_id)
+
+    def is_pending_task_id(self, task_id):
+        self.reads += 1
+        return super().is_pending_task_id(task_id)
+
+
+class CachingStoreTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.inner = CountingStore()
+        self.store = module.CachingStore(self.inner, negative_ttl=0.1)
+
+    def test_finished_responses_are_cached(self):
+        self.inner.add_response('task', ['response'])
+        for _ in range(10):
+            self.assertEqual(self.store.get_task_id_response('task'),
+                             ['response'])
+            self.assertFalse(self.store.is_pending_task_id('task'))
+        self.assertEqual(self.inner.reads, 1)
+
+    def test_misses_are_cached_briefly(self):
+        for _ in range(10):
+            with self.assertRaises(ValueError):
+                self.store.get_task_id_response('task')
+        self.assertEqual(self.inner.reads, 1)
+
+        # completed by another process, which this one is not notified of
+        self.inner._completion_listeners = []
+        self.inner.add_response('task', ['response'])
+        with self.assertRaises(ValueError):
+            self.store.get_task_id_response('task')
+        time.sleep(0.15)
+        self.assertEqual(self.store.get_task_id_response('task'),
+                         ['response'])
+
+    def test_writes_invalidate(self):
+        self.store.add_pending_task_id('task', '2021-11-14T13:43:15', 'url')
+        self.assertTrue(self.store.is_pending_task_id('task'))
+        with self.assertRaises(ValueError):
+            self.store.get_task_id_response('task')
+
+        self.store.add_response('task', ['response'])
+        reads = self.inner.reads
+        self.assertFalse(self.store.is_pending_task_id('task'))
+        self.assertEqual(self.store.get_task_id_response('task'),
+                         ['response'])
+        self.assertEqual(self.inner.reads, reads)
+
+    def test_listeners_read_completed_responses(self):
+        with self.assertRaises(ValueError):
+            self.store.get_task_id_response('task')
+        read = []
+        self.store.add_completion_listener(lambda task_ids: read.extend(
+            self.store.get_task_id_response(id) for id in task_ids))
+        self.store.add_response('task', ['response'])
+        # completed by a write to the inner store, e.g. a worker's claims
+        self.inner.add_response('other', ['other'])
+        self.assertEqual(read, [['response'], ['other']])
+
+    def test_memory_budget(self):
+        store = module.CachingStore(self.inner, max_entries=2)
+        for i in range(3):
+            store.add_response(f'task_{i}', [i])
+        self.assertEqual(store.stats()['responses']['entries'], 2)
+        self.assertEqual(store.get_task_id_response('task_0'), [0])
+
+    def test_sql_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sql_store = SQLStore(
+                database_url=f"sqlite:///{os.path.join(tmp_dir, 'tasks.db')}")
+            store = module.CachingStore(sql_store)
+            self.assertIsNone(store.get_task_id_response('task'))
+            self.assertIsNone(store.get_task_id_response('task'))
+            store.add_response('task', ['response'])
+            self.assertEqual(store.get_task_id_response('task'), ['response'])
+            store.remove_finished_task('task')
+            self.assertIsNone(store.get_task_id_response('task'))
+
+            # sql specific methods are passed through
+            tfl_scheduler = TflScheduler(store, executor=EXECUTOR_QUEUE)
+            id = tfl_scheduler.schedule_tfl_call(url='url', dt=None)
+            self.assertEqual(store.claim_due_tasks('w')[1][0][0], id)
+            sql_store.engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
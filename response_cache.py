@@ -0,0 +1,192 @@
+import threading
+import time
+import typing as ty
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import codec
+import tlog
+from misc_utils import approx_size
+from url_helper import lines_from_url, url_from_lines
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TTL = 30  # seconds
+DEFAULT_FETCH_WORKERS = 8  # missing lines fetched at once, per process
+
+MISSING = object()
+
+_global_response_cache = None
+
+
+def get_response_cache(ttl: float = DEFAULT_TTL):
+    # one per process, so every scheduler in it serves lines fetched by the
+    # others, and the cache's memory budget bounds them all
+    global _global_response_cache
+    if _global_response_cache is None:
+        _global_response_cache = LineResponseCache(ttl=ttl)
+    return _global_response_cache
+
+
+class LRUCache:
+    """Thread safe LRU cache, bounded by entry count and approximate bytes.
+
+    Entries older than `ttl` seconds are treated as misses and dropped. With
+    `ttl=None` entries only leave the cache by eviction or invalidation.
+    """
+
+    def __init__(self,
+                 max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_bytes: int = DEFAULT_MAX_BYTES,
+                 ttl: ty.Optional[float] = DEFAULT_TTL,
+                 size_of: ty.Callable[[ty.Any], int] = approx_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_of = size_of
+        self._lock = threading.Lock()
+        # key -> (expires_at, size, value)
+        self._entries: OrderedDict = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, size, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: ty.Optional[float] = MISSING):
+        ttl = self.ttl if ttl is MISSING else ttl
+        size = self.size_of(value)
+        if size > self.max_bytes:
+            tlog.debug("not caching, over budget", key=key, size=size)
+            return
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, size, value)
+            self.current_bytes += size
+            while (len(self._entries) > self.max_entries
+                   or self.current_bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> ty.Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class LineResponseCache:
+    """Caches disruption responses per line id.
+
+    A disruption url for several lines is answered from the cached entries of
+    each line, and only the lines that are missing are fetched upstream, one
+    call per missing line so each can be cached on its own. The calls run at
+    once, the first in the caller's thread and the rest on a pool of
+    `fetch_workers` threads. Urls that are not disruption urls are passed
+    straight through to `fetch`.
+
+    The response for several lines is the responses of each line, in the
+    order of the url's lines, with a disruption that several of them share
+    kept once, where its first line has it. It may differ from tfl's own
+    response for the url in the order of the disruptions, and each line's
+    part may have been fetched at a different time, up to `ttl` ago.
+    """
+
+    def __init__(self,
+                 max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_bytes: int = DEFAULT_MAX_BYTES,
+                 ttl: float = DEFAULT_TTL,
+                 fetch_workers: int = DEFAULT_FETCH_WORKERS):
+        self.cache = LRUCache(max_entries=max_entries,
+                              max_bytes=max_bytes,
+                              ttl=ttl)
+        self._pool = ThreadPoolExecutor(max_workers=fetch_workers,
+                                        thread_name_prefix="tfl-line-fetch")
+
+    def _fetch_line(self, line: str, fetch: ty.Callable[[str], ty.Any]):
+        line_response = fetch(url_from_lines([line]))
+        # errors from tfl come back as a dict, don't cache them
+        if isinstance(line_response, list):
+            self.cache.set(line, line_response)
+        return line_response
+
+    def fetch(self, url: str, fetch: ty.Callable[[str], ty.Any]) -> ty.Any:
+        lines = lines_from_url(url)
+        if lines is None:
+            return fetch(url)
+
+        line2response = {line: self.cache.get(line) for line in lines}
+        missing = [
+            line for line, line_response in line2response.items()
+            if line_response is MISSING
+        ]
+        if missing:
+            futures = {
+                line: self._pool.submit(self._fetch_line, line, fetch)
+                for line in missing[1:]
+            }
+            line2response[missing[0]] = self._fetch_line(missing[0], fetch)
+            for line, future in futures.items():
+                line2response[line] = future.result()
+        for line_response in line2response.values():
+            if not isinstance(line_response, list):
+                return line_response
+        if len(line2response) == 1:
+            return list(next(iter(line2response.values())))
+        return _merge(line2response.values())
+
+    def stats(self) -> ty.Dict[str, int]:
+        return self.cache.stats()
+
+
+def _merge(responses: ty.Iterable[list]) -> list:
+    """The disruptions of every response, each distinct disruption once"""
+    merged = []
+    seen = set()
+    for response in responses:
+        for disruption in response:
+            key = codec.content_hash(disruption)
+            if key not in seen:
+                seen.add(key)
+                merged.append(disruption)
+    return merged
@@ -0,0 +1,110 @@
+import time
+import unittest
+
+import response_cache as module
+from url_helper import url_from_lines
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = module.LRUCache(max_entries=2, ttl=None)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIs(cache.get('b'), module.MISSING)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_evicts_over_byte_budget(self):
+        cache = module.LRUCache(max_bytes=10, ttl=None)
+        cache.set('a', 'x' * 6)
+        cache.set('b', 'y' * 6)
+        self.assertEqual(len(cache), 1)
+        self.assertLessEqual(cache.stats()['bytes'], 10)
+
+    def test_expires_after_ttl(self):
+        cache = module.LRUCache(ttl=0.05)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.1)
+        self.assertIs(cache.get('a'), module.MISSING)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['expirations'], 1)
+
+
+class LineResponseCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.calls = []
+
+    def fetch(self, url):
+        self.calls.append(url)
+        return [{'url': url}]
+
+    def test_only_missing_lines_are_fetched(self):
+        cache = module.LineResponseCache()
+        cache.fetch(url_from_lines(['bakerloo']), fetch=self.fetch)
+        response = cache.fetch(url_from_lines(['bakerloo', 'jubilee']),
+                               fetch=self.fetch)
+
+        self.assertEqual(self.calls, [
+            url_from_lines(['bakerloo']),
+            url_from_lines(['jubilee']),
+        ])
+        self.assertEqual(response, [{
+            'url': url_from_lines(['bakerloo'])
+        }, {
+            'url': url_from_lines(['jubilee'])
+        }])
+
+    def test_missing_lines_are_fetched_at_once(self):
+        cache = module.LineResponseCache()
+
+        def slow_fetch(url):
+            time.sleep(0.2)
+            return self.fetch(url)
+
+        lines = ['bakerloo', 'central', 'jubilee', 'victoria']
+        began = time.monotonic()
+        response = cache.fetch(url_from_lines(lines), fetch=slow_fetch)
+        self.assertLess(time.monotonic() - began, 0.6)
+        self.assertCountEqual(self.calls,
+                              [url_from_lines([line]) for line in lines])
+        self.assertEqual(response,
+                         [{'url': url_from_lines([line])} for line in lines])
+
+    def test_shared_disruptions_are_kept_once(self):
+        cache = module.LineResponseCache()
+        shared = {'description': 'Central and Victoria Lines: closed'}
+
+        def fetch(url):
+            return [{'url': url}, dict(shared)]
+
+        response = cache.fetch(url_from_lines(['central', 'victoria']),
+                               fetch=fetch)
+        self.assertEqual(response, [
+            {'url': url_from_lines(['central'])},
+            shared,
+            {'url': url_from_lines(['victoria'])},
+        ])
+
+    def test_errors_are_not_cached(self):
+        cache = module.LineResponseCache()
+        error = {'httpStatusCode': 404}
+        response = cache.fetch(url_from_lines(['bakerlo']),
+                               fetch=lambda url: error)
+        self.assertEqual(response, error)
+        self.assertEqual(len(cache.cache), 0)
+
+    def test_other_urls_pass_through(self):
+        cache = module.LineResponseCache()
+        url = "https://api.tfl.gov.uk/Line/victoria/"
+        cache.fetch(url, fetch=self.fetch)
+        cache.fetch(url, fetch=self.fetch)
+        self.assertEqual(self.calls, [url, url])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,42 +1,132 @@
+import json
 import os
+import time
 from datetime import datetime
 
-from flask import Flask
+from flask import Flask, Response, stream_with_context
 from flask_classful import FlaskView, request, route
 
 import constants as c
+import task_metrics
 import tlog
-from store import get_store
-from tfl_scheduler import TflScheduler
-from url_helper import TflUrlHelper
+from components import get_components
+from disruption_index import parse_filters
+from metrics import PROMETHEUS_MIMETYPE, prometheus_text
+from notifier import MISSING, wait_for_response
+from store import DEFAULT_PAGE_SIZE
+from subscriptions import DEFAULT_WINDOW
 
 app = Flask(__name__)
 
+MAX_PAGE_SIZE = 1000
+NDJSON_MIMETYPE = "application/x-ndjson"
+SSE_MIMETYPE = "text/event-stream"
+MAX_WAIT = 60  # seconds a long poll or event stream waits for a task
+SSE_KEEP_ALIVE = 15  # seconds between keep-alive comments
+MAX_BATCH_SIZE = 10000
+
+
+def parse_wait(wait: str, default: float = None) -> float:
+    if not wait:
+        return default
+    wait = float(wait)
+    if not 0 <= wait <= MAX_WAIT:
+        raise ValueError(f"wait must be between 0 and {MAX_WAIT} seconds")
+    return wait
+
+
+def parse_limit(limit: str) -> int:
+    limit = int(limit) if limit else DEFAULT_PAGE_SIZE
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return limit
+
 
 class TflAppServer(FlaskView):
 
     def __init__(self):
-        tlog.info("Initialising tfl app server")
-        self.store = get_store(in_memory_store=True)
-        self.tfl_scheduler = TflScheduler(store=self.store)
-        self.url_helper = TflUrlHelper()
+        # built per request by FlaskView, so only picks up shared components
+        components = get_components()
+        self.store = components.store
+        self.tfl_scheduler = components.tfl_scheduler
+        self.url_helper = components.url_helper
+        self.subscriptions = components.subscriptions
+        self.notifier = components.notifier
 
     def tasks_post(self, raw_lines: str, schedule_time: str):
-        tlog.info(f"schedule_time = {schedule_time}")
-        if schedule_time:
-            dt = datetime.strptime(schedule_time, c.DT_STR)
-            if dt < datetime.now():
-                return "Please post a date that is in the future"
-        else:
-            dt = None
-        url = self.url_helper.construct_url_from_lines(raw_lines)
+        tlog.debug("posting task", schedule_time=schedule_time)
+        with task_metrics.stage(task_metrics.VALIDATION).time():
+            if schedule_time:
+                dt = datetime.strptime(schedule_time, c.DT_STR)
+                if dt < datetime.now():
+                    return "Please post a date that is in the future"
+            else:
+                dt = None
+            url = self.url_helper.construct_url_from_lines(raw_lines)
         id = self.tfl_scheduler.schedule_tfl_call(url=url, dt=dt)
         return f"Successfully posted. Task id is {id}"
 
+    def tasks_post_batch(self, entries):
+        """Validate every {lines, schedule_time} entry, then schedule them all
+        in bulk. Nothing is scheduled if any entry is invalid"""
+        if not isinstance(entries, list) or not entries:
+            return "Expected a non-empty json array of tasks", 400
+        if len(entries) > MAX_BATCH_SIZE:
+            return f"At most {MAX_BATCH_SIZE} tasks per batch", 400
+        now = datetime.now()
+        calls = []
+        errors = []
+        with task_metrics.stage(task_metrics.VALIDATION).time():
+            for i, entry in enumerate(entries):
+                try:
+                    calls.append(self._validate_batch_entry(entry, now))
+                except (TypeError, ValueError) as e:
+                    errors.append({"index": i, "error": str(e)})
+        if errors:
+            return {"errors": errors}, 400
+        ids = self.tfl_scheduler.schedule_tfl_calls_bulk(calls)
+        return {"task_ids": ids}
+
+    def _validate_batch_entry(self, entry, now: datetime):
+        """(url, dt) of a batch entry, ValueError if it is invalid"""
+        if not isinstance(entry, dict):
+            raise ValueError("Expected an object")
+        raw_lines = entry.get('lines')
+        if isinstance(raw_lines, list):
+            raw_lines = ','.join(map(str, raw_lines))
+        if not isinstance(raw_lines, str):
+            raise ValueError("Lines are invalid")
+        url = self.url_helper.construct_url_from_lines(raw_lines)
+        dt = None
+        if entry.get('schedule_time'):
+            dt = datetime.strptime(entry['schedule_time'], c.DT_STR)
+            if dt < now:
+                raise ValueError("Please post a date that is in the future")
+        return url, dt
+
+    @route('/tasks/batch', methods=['POST'])
+    def tasks_batch(self):
+        return self.tasks_post_batch(request.get_json(force=True, silent=True))
 
-    def tasks_get_all(self):
-        all_tasks = self.store.get_all_finished_tasks()
-        return all_tasks
+    def tasks_get_all(self, limit: str, cursor: str):
+        try:
+            tasks, next_cursor = self.store.get_finished_tasks_page(
+                limit=parse_limit(limit), cursor=cursor or None)
+        except ValueError as e:
+            tlog.error("in run. bad page request", err=e)
+            return str(e), 400
+        return {"tasks": tasks, "next_cursor": next_cursor}
+
+    def tasks_stream_all(self):
+        def generate():
+            for task_id, response in self.store.iter_finished_tasks():
+                yield json.dumps({
+                    "task_id": task_id,
+                    "response": response
+                }) + "\n"
+
+        return Response(stream_with_context(generate()),
+                        mimetype=NDJSON_MIMETYPE)
 
     @route('/tasks', methods=['GET', 'POST'])
     def tasks(self):
@@ -45,11 +135,46 @@ class TflAppServer(FlaskView):
             schedule_time = request.values.get('schedule_time')
             return self.tasks_post(lines, schedule_time)
         elif request.method == 'GET':
-            return self.tasks_get_all()
+            if (request.values.get('format') == 'ndjson'
+                    or request.accept_mimetypes.best == NDJSON_MIMETYPE):
+                return self.tasks_stream_all()
+            limit = request.values.get('limit')
+            cursor = request.values.get('cursor')
+            return self.tasks_get_all(limit, cursor)
+
+    @route('/disruptions', methods=['GET'])
+    def disruptions(self):
+        """Finished tasks with disruptions matching every one of line,
+        category, type and closureText given, that completed at or after
+        since. Answered from the store's indexes, a page at a time"""
+        since = request.values.get('since')
+        try:
+            tasks, next_cursor = self.store.find_finished_tasks(
+                parse_filters(request.values),
+                since=datetime.strptime(since, c.DT_STR) if since else None,
+                limit=parse_limit(request.values.get('limit')),
+                cursor=request.values.get('cursor') or None)
+        except ValueError as e:
+            tlog.error("in run. bad disruptions query", err=e)
+            return str(e), 400
+        return {"tasks": tasks, "next_cursor": next_cursor}
 
     @route('/tasks/<task_id>', methods=['GET'])
     def task_id(self, task_id):
         print(f'task_id is = {task_id}')
+        wait = request.values.get('wait')
+        if wait:
+            # long poll, answered as soon as the task completes
+            try:
+                timeout = parse_wait(wait)
+            except ValueError as e:
+                return str(e), 400
+            to_ret = wait_for_response(self.store, self.notifier, task_id,
+                                       timeout)
+            if to_ret is MISSING:
+                return ("Task id has either not been scheduled, "
+                        "or not been completed")
+            return f"response from api is {to_ret}"
         try:
             to_ret = self.store.get_task_id_response(task_id)
         except ValueError as e:
@@ -59,10 +184,94 @@ class TflAppServer(FlaskView):
 
         return f"response from api is {to_ret}"
 
+    @route('/tasks/<task_id>/events', methods=['GET'])
+    def task_id_events(self, task_id):
+        """Server sent events: a result event when the task completes, or a
+        timeout event. Comments are sent in between to keep the connection
+        open"""
+        try:
+            timeout = parse_wait(request.values.get('timeout'),
+                                 default=MAX_WAIT)
+        except ValueError as e:
+            return str(e), 400
+        store, notifier = self.store, self.notifier
+
+        def generate():
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                response = wait_for_response(
+                    store, notifier, task_id,
+                    max(0, min(remaining, SSE_KEEP_ALIVE)))
+                if response is not MISSING:
+                    data = json.dumps({"task_id": task_id,
+                                       "response": response})
+                    yield f"event: result\ndata: {data}\n\n"
+                    return
+                if remaining <= SSE_KEEP_ALIVE:
+                    yield f"event: timeout\ndata: {json.dumps(task_id)}\n\n"
+                    return
+                yield ": keep-alive\n\n"
+
+        return Response(stream_with_context(generate()),
+                        mimetype=SSE_MIMETYPE,
+                        headers={"Cache-Control": "no-cache"})
+
+    def subscriptions_post(self, raw_lines: str, interval: str, cron: str,
+                           window: str):
+        if self.subscriptions is None:
+            return "Subscriptions are not available in queue mode", 501
+        try:
+            lines = self.url_helper.construct_lines_from_raw_lines(raw_lines)
+            if not self.url_helper.is_valid_lines(lines):
+                raise ValueError("Lines are invalid")
+            id = self.subscriptions.subscribe(
+                lines,
+                interval=float(interval) if interval else None,
+                cron=cron or None,
+                window=int(window) if window else DEFAULT_WINDOW)
+        except (TypeError, ValueError) as e:
+            tlog.error("in run. bad subscription", err=e)
+            return str(e), 400
+        return f"Successfully subscribed. Subscription id is {id}"
+
+    @route('/subscriptions', methods=['POST'])
+    def subscriptions_route(self):
+        return self.subscriptions_post(request.values.get('lines'),
+                                       request.values.get('interval'),
+                                       request.values.get('cron'),
+                                       request.values.get('window'))
+
+    @route('/subscriptions/<subscription_id>', methods=['GET', 'DELETE'])
+    def subscription_id(self, subscription_id):
+        if self.subscriptions is None:
+            return "Subscriptions are not available in queue mode", 501
+        try:
+            if request.method == 'DELETE':
+                self.subscriptions.unsubscribe(subscription_id)
+                return f"Unsubscribed {subscription_id}"
+            results = self.subscriptions.get_results(subscription_id)
+        except ValueError as e:
+            return str(e), 404
+        subscription = self.subscriptions.subscriptions[subscription_id]
+        return {
+            "subscription": subscription._asdict(),
+            "results": [{
+                "fetched_at": fetched_at,
+                "response": response
+            } for fetched_at, response in results],
+        }
+
+    @route('/metrics', methods=['GET'])
+    def metrics(self):
+        """Prometheus scrape endpoint"""
+        return Response(prometheus_text(), content_type=PROMETHEUS_MIMETYPE)
+
 
 TflAppServer.register(app, route_base="/")
 
 if __name__ == '__main__':
     # need to run with FLASK_DEBUG=1
+    get_components()  # so the first request does not pay for start up
     port = os.getenv('FLASK_PORT', 5000)
     app.run(host = '0.0.0.0', debug=True, port=port)
@@ -0,0 +1,221 @@
+import importlib
+import json
+import statistics
+import threading
+import time
+import unittest
+
+import constants as c
+from tfl_scheduler import DEFAULT_MAX_WORKERS
+from tfl_stub import TflStubServer, make_disruption
+
+
+class TflAppServerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.stub = TflStubServer().start()
+        cls._tfl_api_url = c.TFL_API_URL
+        c.TFL_API_URL = cls.stub.url
+        cls.module = importlib.import_module('run')
+        cls.client = cls.module.app.test_client()
+        cls.store = cls.module.get_components().store
+
+    @classmethod
+    def tearDownClass(cls):
+        # before the stub stops, so scheduled fetches can finish
+        cls.module.get_components().shutdown()
+        c.TFL_API_URL = cls._tfl_api_url
+        cls.stub.stop()
+
+    def test_tasks_get_is_paginated(self):
+        for i in range(5):
+            self.store.add_response(f'page_{i}', [i])
+        task_ids = []
+        cursor = ''
+        while cursor is not None:
+            resp = self.client.get(f'/tasks?limit=2&cursor={cursor}')
+            self.assertEqual(resp.status_code, 200)
+            body = resp.get_json()
+            self.assertLessEqual(len(body['tasks']), 2)
+            task_ids.extend(body['tasks'])
+            cursor = body['next_cursor']
+        self.assertEqual([id for id in task_ids if id.startswith('page_')],
+                         [f'page_{i}' for i in range(5)])
+
+    def test_tasks_get_bad_page(self):
+        self.assertEqual(self.client.get('/tasks?limit=0').status_code, 400)
+        self.assertEqual(
+            self.client.get('/tasks?cursor=garbage').status_code, 400)
+
+    def test_tasks_get_ndjson(self):
+        self.store.add_response('ndjson', ['response'])
+        resp = self.client.get('/tasks?format=ndjson')
+        self.assertEqual(resp.mimetype, self.module.NDJSON_MIMETYPE)
+        rows = [json.loads(line) for line in resp.data.decode().splitlines()]
+        self.assertIn({'task_id': 'ndjson', 'response': ['response']}, rows)
+
+    def test_disruptions(self):
+        self.store.add_response('elizabeth_closed', [
+            make_disruption('elizabeth', 0),
+            make_disruption('jubilee', 1)
+        ])
+        self.store.add_response('elizabeth_delays',
+                                [make_disruption('elizabeth', 1)])
+        resp = self.client.get(
+            '/disruptions?line=Elizabeth&closureText=serviceClosed')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(list(resp.get_json()['tasks']), ['elizabeth_closed'])
+        # the keys of a task are those of all its disruptions
+        query = ('/disruptions?line=elizabeth&category=PlannedWork'
+                 '&since=2021-11-14T13:00:00&limit=1')
+        body = self.client.get(query).get_json()
+        self.assertEqual(list(body['tasks']), ['elizabeth_closed'])
+        body = self.client.get(
+            f"{query}&cursor={body['next_cursor']}").get_json()
+        self.assertEqual(list(body['tasks']), ['elizabeth_delays'])
+        self.assertEqual(
+            self.client.get('/disruptions?since=yesterday').status_code, 400)
+        self.assertEqual(
+            self.client.get('/disruptions?limit=0').status_code, 400)
+
+    def test_long_poll(self):
+        resp = self.client.post('/tasks', data={'lines': 'northern'})
+        id = resp.data.decode().split()[-1]
+        resp = self.client.get(f'/tasks/{id}?wait=10')
+        self.assertTrue(resp.data.decode().startswith('response from api is'))
+
+        start = time.monotonic()
+        resp = self.client.get('/tasks/unknown?wait=0.2')
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertIn('not been completed', resp.data.decode())
+        self.assertEqual(
+            self.client.get('/tasks/unknown?wait=3600').status_code, 400)
+
+    def test_metrics(self):
+        resp = self.client.post('/tasks', data={'lines': 'victoria'})
+        id = resp.data.decode().split()[-1]
+        self.client.get(f'/tasks/{id}?wait=10')
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        lines = resp.data.decode().splitlines()
+        samples = dict(line.rsplit(' ', 1) for line in lines
+                       if not line.startswith('#'))
+        for stage in ['validation', 'enqueue', 'schedule_lag', 'fetch',
+                      'store_write']:
+            self.assertGreaterEqual(
+                float(samples[f'tfl_task_stage_seconds_count'
+                              f'{{stage="{stage}"}}']), 1)
+        self.assertGreaterEqual(float(samples['tfl_tasks_scheduled_total']),
+                                1)
+        self.assertGreaterEqual(float(samples['tfl_tasks_finished_total']), 1)
+        self.assertIn('tfl_tasks_pending', samples)
+
+    def test_events(self):
+        resp = self.client.post('/tasks', data={'lines': 'central'})
+        id = resp.data.decode().split()[-1]
+        resp = self.client.get(f'/tasks/{id}/events?timeout=10')
+        self.assertEqual(resp.mimetype, self.module.SSE_MIMETYPE)
+        event, data = resp.data.decode().strip().split('\n')
+        self.assertEqual(event, 'event: result')
+        body = json.loads(data[len('data: '):])
+        self.assertEqual(body['task_id'], id)
+        self.assertEqual(body['response'][0]['description'][:7], 'Central')
+
+        resp = self.client.get('/tasks/unknown/events?timeout=0.1')
+        self.assertTrue(resp.data.decode().startswith('event: timeout'))
+
+    def test_batch(self):
+        resp = self.client.post('/tasks/batch',
+                                json=[{'lines': 'bakerloo,jubilee'}] * 1000 +
+                                [{'lines': ['victoria']}])
+        self.assertEqual(resp.status_code, 200)
+        ids = resp.get_json()['task_ids']
+        self.assertEqual(len(set(ids)), 1001)
+        resp = self.client.get(f'/tasks/{ids[-1]}?wait=10')
+        self.assertTrue(resp.data.decode().startswith('response from api is'))
+
+    def test_bad_batch(self):
+        pending = len(self.store.get_all_pending_tasks())
+        resp = self.client.post('/tasks/batch',
+                                json=[{'lines': 'victoria'},
+                                      {'lines': 'not-a-line'},
+                                      {'lines': 'victoria',
+                                       'schedule_time': '2001-01-01T00:00:00'},
+                                      {'lines': 'victoria',
+                                       'schedule_time': 'tomorrow'},
+                                      'victoria'])
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual([error['index'] for error in resp.get_json()['errors']],
+                         [1, 2, 3, 4])
+        # other tests' tasks may complete meanwhile, but none were added
+        self.assertLessEqual(len(self.store.get_all_pending_tasks()), pending)
+        self.assertEqual(
+            self.client.post('/tasks/batch', data='not json').status_code, 400)
+
+    def test_subscriptions(self):
+        resp = self.client.post('/subscriptions',
+                                data={'lines': 'jubilee,bakerloo',
+                                      'interval': '60',
+                                      'window': '2'})
+        self.assertEqual(resp.status_code, 200)
+        id = resp.data.decode().split()[-1]
+        subscriptions = self.module.get_components().subscriptions
+        key = subscriptions.subscriptions[id].feed_key
+        requests = self.stub.requests
+        for _ in range(3):
+            subscriptions.run_feed(key)
+        # every run is a fetch, not served from the response cache
+        self.assertGreaterEqual(self.stub.requests - requests, 3)
+
+        body = self.client.get(f'/subscriptions/{id}').get_json()
+        self.assertEqual(body['subscription']['lines'],
+                         ['bakerloo', 'jubilee'])
+        self.assertEqual(len(body['results']), 2)
+        self.assertEqual(body['results'][0]['response'][0]['$type'],
+                         'Tfl.Api.Presentation.Entities.Disruption, '
+                         'Tfl.Api.Presentation.Entities')
+
+        self.assertEqual(
+            self.client.delete(f'/subscriptions/{id}').status_code, 200)
+        self.assertEqual(
+            self.client.get(f'/subscriptions/{id}').status_code, 404)
+
+    def test_bad_subscriptions(self):
+        for data in [{'lines': 'victoria'},
+                     {'lines': 'not-a-line', 'interval': '60'},
+                     {'lines': 'victoria', 'interval': 'soon'},
+                     {'lines': 'victoria', 'interval': '1'}]:
+            with self.subTest(data=data):
+                self.assertEqual(
+                    self.client.post('/subscriptions', data=data).status_code,
+                    400)
+
+    def post_and_time(self, n: int):
+        latencies = []
+        for i in range(n):
+            lines = 'bakerloo,jubilee' if i % 2 else 'victoria'
+            start = time.perf_counter()
+            resp = self.client.post('/tasks', data={'lines': lines})
+            latencies.append(time.perf_counter() - start)
+            self.assertEqual(resp.status_code, 200)
+        return latencies
+
+    def test_threads_and_latency_stay_flat_under_load(self):
+        self.post_and_time(200)
+        time.sleep(1)
+        threads = threading.active_count()
+
+        latencies = self.post_and_time(3000)
+        # the scheduler's thread pool may still grow to its size, but not by
+        # a thread per request
+        self.assertLessEqual(threading.active_count(),
+                             threads + DEFAULT_MAX_WORKERS)
+        first = statistics.median(latencies[:500])
+        last = statistics.median(latencies[-500:])
+        self.assertLess(last, 3 * first + 0.005)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,369 @@
+import contextlib
+import sqlite3
+import threading
+import time
+import typing as ty
+from datetime import datetime
+
+import codec
+import constants as c
+import tlog
+from disruption_index import index_keys
+from store import (DEFAULT_BATCH_SIZE, DEFAULT_PAGE_SIZE, SQLITE_BUSY_TIMEOUT,
+                   AbstractMemoryStore, decode_cursor, encode_cursor)
+
+DEFAULT_COMMIT_INTERVAL = 0.01  # seconds writes wait to be committed together
+DEFAULT_MAX_UNCOMMITTED = 1000  # writes that are committed straight away
+# statements sqlite3 keeps prepared, more than this store uses
+CACHED_STATEMENTS = 64
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS pending_tasks ("
+    "task_id TEXT PRIMARY KEY, dt_str TEXT NOT NULL, url TEXT NOT NULL"
+    ") WITHOUT ROWID",
+    # dt_str sorts in time order, so this is the due time index
+    "CREATE INDEX IF NOT EXISTS ix_pending_tasks_dt_str "
+    "ON pending_tasks (dt_str, task_id)",
+    # seq is the completion order. A task completed again gets a new seq
+    "CREATE TABLE IF NOT EXISTS finished_tasks ("
+    "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "task_id TEXT NOT NULL UNIQUE, "
+    "response BLOB NOT NULL, "
+    "completed_at REAL NOT NULL DEFAULT 0)",
+    # disruption_index keys of the finished tasks' responses
+    "CREATE TABLE IF NOT EXISTS response_keys ("
+    "field TEXT NOT NULL, value TEXT NOT NULL, task_id TEXT NOT NULL, "
+    "PRIMARY KEY (field, value, task_id)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS ix_response_keys_task_id "
+    "ON response_keys (task_id)",
+]
+
+_INSERT_PENDING = ("INSERT OR REPLACE INTO pending_tasks (task_id, dt_str, url) "
+                   "VALUES (?, ?, ?)")
+_DELETE_PENDING = "DELETE FROM pending_tasks WHERE task_id = ?"
+_IS_PENDING = "SELECT 1 FROM pending_tasks WHERE task_id = ?"
+_COUNT_PENDING = "SELECT COUNT(*) FROM pending_tasks"
+_PENDING_PAGE = ("SELECT task_id, dt_str, url FROM pending_tasks "
+                 "WHERE task_id > ? ORDER BY task_id LIMIT ?")
+_DUE = ("SELECT task_id, dt_str, url FROM pending_tasks WHERE dt_str <= ? "
+        "ORDER BY dt_str, task_id LIMIT ?")
+_INSERT_FINISHED = ("INSERT OR REPLACE INTO finished_tasks "
+                    "(task_id, response, completed_at) VALUES (?, ?, ?)")
+_DELETE_FINISHED = "DELETE FROM finished_tasks WHERE task_id = ?"
+_RESPONSE = "SELECT response FROM finished_tasks WHERE task_id = ?"
+_FINISHED_PAGE = ("SELECT seq, task_id, response FROM finished_tasks "
+                  "WHERE seq > ? ORDER BY seq LIMIT ?")
+_INSERT_KEY = ("INSERT OR IGNORE INTO response_keys (field, value, task_id) "
+               "VALUES (?, ?, ?)")
+_DELETE_KEYS = "DELETE FROM response_keys WHERE task_id = ?"
+_MATCHING_KEY = ("task_id IN (SELECT task_id FROM response_keys "
+                 "WHERE field = ? AND value = ?)")
+
+
+class SQLiteStore(AbstractMemoryStore):
+    """Store on an embedded sqlite file, so tasks survive restarts without a
+    database server.
+
+    The file is in WAL mode with synchronous=FULL, so each commit is an
+    append to the log and one fsync of it. Writes are grouped into one
+    transaction and committed at most `commit_interval` seconds later, or
+    once there are `max_uncommitted` of them, so there are few fsyncs. Until
+    then they are in an open transaction, so a crash of the process or the
+    machine loses up to the last commit_interval of writes. Completion
+    listeners are only called once the responses are committed.
+
+    One connection is shared by every thread, under a lock, so reads on the
+    store see its uncommitted writes, and wait while a write holds the lock.
+    Other processes reading the file do not wait for the writer. sqlite3
+    keeps its statements prepared.
+
+    Args:
+        path: the database file, created if needed
+        codec_name: codec responses are written with. Responses written with
+            any other codec can still be read
+        commit_interval: seconds a write may wait to be committed with
+            others, 0 commits every write on its own
+        max_uncommitted: writes after which they are committed straight away
+    """
+
+    def __init__(self,
+                 path: str,
+                 codec_name: str = codec.DEFAULT_CODEC,
+                 commit_interval: float = DEFAULT_COMMIT_INTERVAL,
+                 max_uncommitted: int = DEFAULT_MAX_UNCOMMITTED):
+        tlog.info("SQLite store init", path=path)
+        self.path = path
+        self.codec = codec.get_codec(codec_name)
+        self.commit_interval = commit_interval
+        self.max_uncommitted = max_uncommitted
+        # transactions are begun and committed by the store, not sqlite3
+        self._conn = sqlite3.connect(path,
+                                     timeout=SQLITE_BUSY_TIMEOUT,
+                                     isolation_level=None,
+                                     check_same_thread=False,
+                                     cached_statements=CACHED_STATEMENTS)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        for statement in _SCHEMA:
+            self._conn.execute(statement)
+        columns = {
+            row[1]
+            for row in self._conn.execute("PRAGMA table_info(finished_tasks)")
+        }
+        if "completed_at" not in columns:
+            # files from before completion times were kept
+            self._conn.execute("ALTER TABLE finished_tasks ADD COLUMN "
+                               "completed_at REAL NOT NULL DEFAULT 0")
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        # completed task ids, notified once committed
+        self._uncommitted_completed: ty.List[str] = []
+        self.commits = 0
+        self._closed = threading.Event()
+        self._dirty = threading.Event()
+        self._committer = None
+        if commit_interval > 0:
+            self._committer = threading.Thread(target=self._commit_periodically,
+                                               name="tfl-sqlite-commit",
+                                               daemon=True)
+            self._committer.start()
+
+    def _write(self, sql: str, rows: ty.List[tuple]):
+        """Run sql for every row, in the open transaction. Call with the
+        lock held"""
+        if not rows:
+            return
+        if not self._conn.in_transaction:
+            self._conn.execute("BEGIN")
+        self._conn.executemany(sql, rows)
+        self._uncommitted += len(rows)
+
+    def _written(self) -> ty.List[str]:
+        """Commit now, or soon, after _write. Call with the lock held
+
+        Returns: ids of the completed tasks that were committed
+        """
+        if self._uncommitted >= self.max_uncommitted or not self._committer:
+            return self._commit()
+        if self._uncommitted:
+            self._dirty.set()
+        return []
+
+    def _commit(self) -> ty.List[str]:
+        """Call with the lock held
+
+        Returns: ids of the completed tasks that were committed
+        """
+        if self._conn.in_transaction:
+            self._conn.commit()
+            self.commits += 1
+        self._uncommitted = 0
+        self._dirty.clear()
+        completed, self._uncommitted_completed = (
+            self._uncommitted_completed, [])
+        return completed
+
+    @contextlib.contextmanager
+    def _writing(self):
+        """Hold the lock for _write calls, then commit now or soon and notify
+        the listeners of completed tasks that were committed"""
+        with self._lock:
+            yield
+            completed = self._written()
+        if completed:
+            self._notify_completed(completed)
+
+    def _commit_periodically(self):
+        while self._dirty.wait():
+            # gives other writes time to join the transaction
+            if self._closed.wait(self.commit_interval):
+                return
+            self.flush()
+
+    def flush(self):
+        """Commit the writes waiting to be committed"""
+        completed = []
+        with self._lock:
+            if not self._closed.is_set():
+                completed = self._commit()
+        if completed:
+            self._notify_completed(completed)
+
+    def close(self):
+        with self._lock:
+            if self._closed.is_set():
+                return
+            completed = self._commit()
+            self._closed.set()
+            self._dirty.set()
+            self._conn.close()
+        if completed:
+            self._notify_completed(completed)
+        if self._committer is not None:
+            self._committer.join()
+
+    def _query(self, sql: str, params: tuple) -> ty.List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def add_response(self, task_id, response):
+        tlog.debug("adding response",
+                   task_id=task_id,
+                   response=tlog.capped(response))
+        self.add_responses_bulk([(task_id, response)])
+
+    def add_responses_bulk(self, items: ty.Iterable[ty.Tuple[str, ty.Any]]):
+        """Write the responses and delete the pending tasks, in one
+        transaction"""
+        rows, keys = [], []
+        completed_at = time.time()
+        last_response, encoded = None, None
+        for task_id, response in items:
+            # tasks sharing a fetch come one after the other with the same
+            # object, which only needs encoding once
+            if response is not last_response or encoded is None:
+                encoded = self.codec.encode(response)
+                response_keys = index_keys(response)
+                last_response = response
+            rows.append((task_id, encoded, completed_at))
+            keys.extend((field, value, task_id)
+                        for field, value in response_keys)
+        task_ids = [(row[0], ) for row in rows]
+        with self._writing():
+            # keys of responses the tasks had before
+            self._write(_DELETE_KEYS, task_ids)
+            self._write(_INSERT_FINISHED, rows)
+            self._write(_INSERT_KEY, keys)
+            self._write(_DELETE_PENDING, task_ids)
+            self._uncommitted_completed.extend(row[0] for row in rows)
+
+    def add_pending_task_id(self, task_id, dt_str: str, url: str):
+        self.add_pending_tasks_bulk([(task_id, dt_str, url)])
+
+    def add_pending_tasks_bulk(self,
+                               items: ty.Iterable[ty.Tuple[str, str, str]]):
+        with self._writing():
+            self._write(_INSERT_PENDING, list(items))
+
+    def is_pending_task_id(self, task_id):
+        return bool(self._query(_IS_PENDING, (task_id, )))
+
+    def remove_pending_task_id(self, task_id):
+        tlog.debug("removing pending task", task_id=task_id)
+        self.complete_tasks_bulk([task_id])
+
+    def complete_tasks_bulk(self, task_ids: ty.Iterable[str]):
+        with self._writing():
+            self._write(_DELETE_PENDING, [(task_id, ) for task_id in task_ids])
+
+    def remove_finished_task(self, task_id):
+        with self._writing():
+            self._write(_DELETE_FINISHED, [(task_id, )])
+            self._write(_DELETE_KEYS, [(task_id, )])
+
+    def get_task_id_response(self, task_id):
+        rows = self._query(_RESPONSE, (task_id, ))
+        if not rows:
+            raise ValueError(f"Store does not have {task_id}")
+        return codec.decode(rows[0][0])
+
+    def count_pending_tasks(self) -> int:
+        return self._query(_COUNT_PENDING, ())[0][0]
+
+    def get_all_pending_tasks(self) -> ty.List[str]:
+        return [
+            task_id for batch in self.iter_pending_tasks()
+            for task_id, _, _ in batch
+        ]
+
+    def get_all_finished_tasks(self) -> ty.Dict[str, ty.Any]:
+        return dict(self.iter_finished_tasks())
+
+    def iter_pending_tasks(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ty.Iterator[ty.List[ty.Tuple[str, str, str]]]:
+        # keyset pagination on the primary key, the lock is not held between
+        # batches
+        last_task_id = ""
+        while True:
+            batch = self._query(_PENDING_PAGE, (last_task_id, batch_size))
+            if not batch:
+                return
+            yield batch
+            last_task_id = batch[-1][0]
+
+    def get_due_tasks(
+            self,
+            until: datetime = None,
+            limit: int = DEFAULT_PAGE_SIZE
+    ) -> ty.List[ty.Tuple[str, str, str]]:
+        until_str = (until or datetime.now()).strftime(c.DT_STR)
+        return self._query(_DUE, (until_str, limit))
+
+    def get_finished_tasks_page(
+        self,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: str = None
+    ) -> ty.Tuple[ty.Dict[str, ty.Any], ty.Optional[str]]:
+        return self._page(_FINISHED_PAGE, (), limit, cursor)
+
+    def _page(
+        self, sql: str, params: tuple, limit: int, cursor: ty.Optional[str]
+    ) -> ty.Tuple[ty.Dict[str, ty.Any], ty.Optional[str]]:
+        """A page of the (seq, task_id, response) rows of sql, which takes
+        the seq to start after, params, and a limit"""
+        if limit < 1:
+            raise ValueError(f"limit must be at least 1, got {limit}")
+        after_seq = 0
+        if cursor is not None:
+            after_seq, _ = decode_cursor(cursor)
+            if not isinstance(after_seq, int):
+                raise ValueError(f"Invalid cursor {cursor}")
+        rows = self._query(sql, (after_seq, *params, limit + 1))
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1][0], rows[-1][1])
+        return {task_id: codec.decode(response)
+                for _, task_id, response in rows}, next_cursor
+
+    def find_finished_tasks(
+        self,
+        filters: ty.Dict[str, str],
+        since: datetime = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: str = None
+    ) -> ty.Tuple[ty.Dict[str, ty.Any], ty.Optional[str]]:
+        """Filters are lookups on the response_keys primary key"""
+        conditions, params = ["seq > ?"], []
+        for field, value in filters.items():
+            conditions.append(_MATCHING_KEY)
+            params.extend([field, value])
+        if since is not None:
+            conditions.append("completed_at >= ?")
+            params.append(since.timestamp())
+        # one statement per set of fields, each prepared once
+        sql = ("SELECT seq, task_id, response FROM finished_tasks WHERE " +
+               " AND ".join(conditions) + " ORDER BY seq LIMIT ?")
+        return self._page(sql, tuple(params), limit, cursor)
+
+    def iter_finished_tasks(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ty.Iterator[ty.Tuple[str, ty.Any]]:
+        after_seq = 0
+        while True:
+            rows = self._query(_FINISHED_PAGE, (after_seq, batch_size))
+            if not rows:
+                return
+            for _, task_id, response in rows:
+                yield task_id, codec.decode(response)
+            after_seq = rows[-1][0]
+
+    def stats(self) -> ty.Dict[str, ty.Any]:
+        return {
+            "pending": self.count_pending_tasks(),
+            "commits": self.commits,
+            "uncommitted": self._uncommitted,
+        }
@@ -0,0 +1,173 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+import sqlite_store as module
+import store as store_module
+from store import STORE_SQLITE, get_store
+from tfl_stub import make_disruption
+
+
+class SQLiteStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "store.db")
+        self.store = module.SQLiteStore(self.path)
+        self.dt_str = '2021-11-14T13:43:15'
+        self.url = "https://api.tfl.gov.uk/Line/bakerloo,jubilee/Disruption"
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp_dir.cleanup()
+
+    def test_wal_mode(self):
+        conn = sqlite3.connect(self.path)
+        self.assertEqual(
+            conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        conn.close()
+
+    def test_survives_reopen(self):
+        self.store.add_pending_task_id('a', self.dt_str, self.url)
+        self.store.add_pending_task_id('b', self.dt_str, self.url)
+        self.store.add_response('a', ['response a'])
+        self.store.close()
+        self.store = module.SQLiteStore(self.path)
+        self.assertEqual(self.store.get_task_id_response('a'), ['response a'])
+        self.assertEqual(self.store.get_all_pending_tasks(), ['b'])
+
+    def test_writes_are_committed_together(self):
+        self.store.close()
+        self.store = module.SQLiteStore(self.path, commit_interval=60)
+        for i in range(10):
+            self.store.add_pending_task_id(f'task_{i}', self.dt_str, self.url)
+        # uncommitted writes are read back, but not by other connections
+        self.assertEqual(self.store.count_pending_tasks(), 10)
+        conn = sqlite3.connect(self.path)
+        count = "SELECT COUNT(*) FROM pending_tasks"
+        self.assertEqual(conn.execute(count).fetchone()[0], 0)
+        self.store.flush()
+        self.assertEqual(conn.execute(count).fetchone()[0], 10)
+        self.assertEqual(self.store.commits, 1)
+        conn.close()
+
+    def test_commits_once_max_uncommitted(self):
+        self.store.close()
+        self.store = module.SQLiteStore(self.path,
+                                        commit_interval=60,
+                                        max_uncommitted=3)
+        for i in range(7):
+            self.store.add_pending_task_id(f'task_{i}', self.dt_str, self.url)
+        self.assertEqual(self.store.commits, 2)
+
+    def test_add_pending_tasks_bulk(self):
+        pending_tasks = [(f'task_{i}', self.dt_str, self.url)
+                         for i in range(2500)]
+        self.store.add_pending_tasks_bulk(pending_tasks)
+        self.assertCountEqual(self.store.get_all_pending_tasks(),
+                              [task_id for task_id, _, _ in pending_tasks])
+        self.assertEqual(self.store.count_pending_tasks(), 2500)
+        batches = list(self.store.iter_pending_tasks(batch_size=1000))
+        self.assertEqual([len(batch) for batch in batches], [1000, 1000, 500])
+
+    def test_add_responses_bulk(self):
+        self.store.close()
+        self.store = module.SQLiteStore(self.path, commit_interval=60)
+        completed = []
+        self.store.add_completion_listener(completed.extend)
+        self.store.add_pending_tasks_bulk([('a', self.dt_str, self.url),
+                                           ('b', self.dt_str, self.url),
+                                           ('c', self.dt_str, self.url)])
+        self.store.add_responses_bulk([('a', ['response a']),
+                                       ('b', ['response b'])])
+        self.assertEqual(self.store.get_task_id_response('b'), ['response b'])
+        self.assertEqual(self.store.get_all_pending_tasks(), ['c'])
+        # listeners are told once the responses are committed
+        self.assertEqual(completed, [])
+        self.store.flush()
+        self.assertEqual(completed, ['a', 'b'])
+
+    def test_unknown_task(self):
+        self.assertRaises(ValueError, self.store.get_task_id_response, 'a')
+        self.assertFalse(self.store.is_pending_task_id('a'))
+
+    def test_get_finished_tasks_page(self):
+        self.store.add_responses_bulk([(f'task_{i}', [i]) for i in range(5)])
+        # completing a task again moves it to the end
+        self.store.add_response('task_1', [1])
+        task_ids = []
+        cursor = None
+        while True:
+            page, cursor = self.store.get_finished_tasks_page(limit=2,
+                                                              cursor=cursor)
+            self.assertLessEqual(len(page), 2)
+            task_ids.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(task_ids,
+                         ['task_0', 'task_2', 'task_3', 'task_4', 'task_1'])
+        self.assertRaises(ValueError, self.store.get_finished_tasks_page,
+                          cursor='not a cursor')
+
+    def test_iter_finished_tasks(self):
+        self.store.add_responses_bulk([(f'task_{i}', [i]) for i in range(5)])
+        self.assertEqual(list(self.store.iter_finished_tasks(batch_size=2)),
+                         [(f'task_{i}', [i]) for i in range(5)])
+
+    def test_get_due_tasks(self):
+        self.store.add_pending_tasks_bulk([
+            ('c', '2021-11-14T13:00:03', self.url),
+            ('a', '2021-11-14T13:00:01', self.url),
+            ('b', '2021-11-14T13:00:02', self.url),
+        ])
+        self.assertEqual([
+            task_id for task_id, _, _ in self.store.get_due_tasks(
+                until=datetime(2021, 11, 14, 13, 0, 2))
+        ], ['a', 'b'])
+        self.assertEqual(len(self.store.get_due_tasks(limit=1)), 1)
+
+    def test_find_finished_tasks(self):
+        self.store.add_responses_bulk([
+            ('closed', [make_disruption('central', 0)]),
+            ('delays', [make_disruption('central', 1)]),
+            ('other', [make_disruption('victoria', 0)]),
+        ])
+        page, _ = self.store.find_finished_tasks({
+            'line': 'central',
+            'closureText': 'serviceClosed'
+        })
+        self.assertEqual(list(page), ['closed'])
+        # completing a task again replaces its keys
+        self.store.add_response('closed', [make_disruption('victoria', 1)])
+        page, cursor = self.store.find_finished_tasks({'line': 'victoria'},
+                                                      limit=1)
+        self.assertEqual(list(page), ['other'])
+        page, cursor = self.store.find_finished_tasks({'line': 'victoria'},
+                                                      cursor=cursor)
+        self.assertEqual((list(page), cursor), (['closed'], None))
+        self.store.remove_finished_task('delays')
+        page, _ = self.store.find_finished_tasks({'line': 'central'})
+        self.assertEqual(page, {})
+        page, _ = self.store.find_finished_tasks(
+            {}, since=datetime.now() - timedelta(minutes=1))
+        self.assertEqual(len(page), 2)
+
+    def test_get_store(self):
+        store = get_store(in_memory_store=True,
+                          backend=STORE_SQLITE,
+                          path=os.path.join(self.tmp_dir.name, "global.db"))
+        self.addCleanup(store_module._global_stores.pop, STORE_SQLITE)
+        self.addCleanup(store.close)
+        self.assertIsInstance(store, module.SQLiteStore)
+        self.assertIs(get_store(in_memory_store=True, backend=STORE_SQLITE),
+                      store)
+        self.assertRaises(ValueError,
+                          get_store,
+                          in_memory_store=True,
+                          backend="nope")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,40 +1,162 @@
-import ast
+import base64
+import bisect
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
 import typing as ty
 from abc import abstractmethod
+from collections import Counter, OrderedDict
 from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
 
 import sqlalchemy
-from sqlalchemy import Column, String, create_engine
+from sqlalchemy import (Column, DateTime, Index, Integer, LargeBinary, String,
+                        and_, create_engine, or_)
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.engine.url import URL
 from sqlalchemy.exc import ProgrammingError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
+import codec
+import constants as c
 import tlog
 import sql_config as config
-from misc_utils import retry_func
+from disruption_index import index_keys
+from metrics import get_metrics, timed
+from misc_utils import approx_size, retry_func
 
 Base = declarative_base()
 
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_LEASE = 60  # seconds a claimed task is kept from other workers
+SQLITE_BUSY_TIMEOUT = 30  # seconds, waiting for other processes' writes
+
+EVICT_LRU = "lru"
+EVICT_AGE = "age"
+
+STORE_MEMORY = "memory"
+STORE_CONCURRENT = "concurrent"
+STORE_SQLITE = "sqlite"
+
+DEFAULT_SHARDS = 16
+DEFAULT_MAX_SPILLED = 100000  # spilled responses kept on disk
+
 _global_mem_store = None
-_global_session = None
+_global_stores = dict()
+_global_sessions = dict()
+
+_timed_query = timed("store_query_seconds",
+                     help="Seconds SQLStore methods take, by method")
+_CHECKOUT = get_metrics().histogram(
+    "store_pool_checkout_seconds",
+    help="Seconds waited for a connection from the SQLStore pool")
+_COMMITS = get_metrics().counter("store_transactions_total",
+                                 help="SQLStore transactions, by outcome",
+                                 outcome="commit")
+_ROLLBACKS = get_metrics().counter("store_transactions_total",
+                                   help="SQLStore transactions, by outcome",
+                                   outcome="rollback")
 
 def get_global_session_maker(engine):
-    global _global_session
-    if not _global_session:
-        _global_session = sessionmaker(bind=engine)
-    return _global_session
+    if engine not in _global_sessions:
+        _global_sessions[engine] = sessionmaker(bind=engine)
+    return _global_sessions[engine]
+
+
+def chunks(items: ty.Iterable, size: int) -> ty.Iterator[list]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_dt_str(dt_str: str) -> ty.Optional[datetime]:
+    try:
+        return datetime.strptime(dt_str, c.DT_STR)
+    except (TypeError, ValueError):
+        return None
+
+
+def encode_cursor(position, task_id: str) -> str:
+    """Opaque cursor pointing just after the task completed at position"""
+    raw = json.dumps([position, task_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
 
 
-def get_store(in_memory_store: bool):
+def decode_cursor(cursor: str) -> ty.Tuple[ty.Any, str]:
+    try:
+        position, task_id = json.loads(base64.urlsafe_b64decode(cursor))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor {cursor}") from e
+    return position, task_id
+
+
+def _decode_seq_cursor(cursor: ty.Optional[str]) -> int:
+    """The completion seq an in memory store's cursor points after, -1 for
+    no cursor"""
+    if cursor is None:
+        return -1
+    seq, _ = decode_cursor(cursor)
+    if not isinstance(seq, int):
+        raise ValueError(f"Invalid cursor {cursor}")
+    return seq
+
+
+def _seq_page(
+    completed: ty.Iterable[ty.Tuple[int, str, ty.Any]], limit: int
+) -> ty.Tuple[ty.Dict[str, ty.Any], ty.Optional[str]]:
+    """A page of the first limit (seq, task_id, response), and the cursor of
+    the next one"""
+    completed = list(itertools.islice(completed, limit + 1))
+    next_cursor = None
+    if len(completed) > limit:
+        completed = completed[:limit]
+        next_cursor = encode_cursor(completed[-1][0], completed[-1][1])
+    return {task_id: response
+            for _, task_id, response in completed}, next_cursor
+
+
+def get_store(in_memory_store: bool, backend: str = STORE_MEMORY, **kwargs):
+    """
+    Args:
+        in_memory_store: only stores in this process are supported here, SQL
+            databases are opened with SQLStore
+        backend: STORE_MEMORY, STORE_CONCURRENT for an in memory store that
+            can be written from many threads at once, or STORE_SQLITE for a
+            store on an embedded sqlite file that survives restarts
+        kwargs: passed to the store the first time it is created
+    """
     if not in_memory_store:
         raise NotImplementedError("SQL not implemented yet")
+    if backend not in (STORE_MEMORY, STORE_CONCURRENT, STORE_SQLITE):
+        raise ValueError(f"Unknown store backend {backend}")
 
     global _global_mem_store
-    if in_memory_store:
-        if _global_mem_store is None:
-            _global_mem_store = InMemoryStore()
-        return _global_mem_store
+    if backend == STORE_SQLITE:
+        if backend not in _global_stores:
+            # imported here as sqlite_store builds on this module
+            from sqlite_store import SQLiteStore
+            _global_stores[backend] = SQLiteStore(**kwargs)
+        return _global_stores[backend]
+    if backend == STORE_CONCURRENT:
+        if backend not in _global_stores:
+            _global_stores[backend] = ConcurrentInMemoryStore(**kwargs)
+        return _global_stores[backend]
+    if _global_mem_store is None:
+        _global_mem_store = InMemoryStore(**kwargs)
+    return _global_mem_store
 
 
 class AbstractMemoryStore:
@@ -67,55 +189,857 @@ class AbstractMemoryStore:
     def get_all_finished_tasks(self):
         pass
 
+    @abstractmethod
+    def iter_pending_tasks(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ty.Iterator[ty.List[ty.Tuple[str, str, str]]]:
+        """Yield the pending tasks as batches of (task_id, dt_str, url)"""
+        pass
+
+    @abstractmethod
+    def get_finished_tasks_page(
+        self,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: str = None
+    ) -> ty.Tuple[ty.Dict[str, ty.Any], ty.Optional[str]]:
+        """Up to limit finished tasks, in the order they completed, starting
+        after cursor.
+
+        Returns: task_id -> response, and the cursor of the next page, None
+            if this is the last one
+        """
+        pass
+
+    @abstractmethod
+    def iter_finished_tasks(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ty.Iterator[ty.Tuple[str, ty.Any]]:
+        """Yield (task_id, response) for every finished task, without
+        loading them all in memory"""
+        pass
+
+    def find_finished_tasks(
+        self,
+        filters: ty.Dict[str, str],
+        since: datetime = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: str = None
+    ) -> ty.Tuple[ty.Dict[str, ty.Any], ty.Optional[str]]:
+        """A page of the finished tasks whose responses have every
+        (field, value) of filters among their disruption_index.index_keys,
+        and that completed at or after since, in the order they completed.
+
+        This decodes every finished task, and cannot tell when they
+        completed. Stores should override it with an index.
+
+        Returns: as get_finished_tasks_page
+        """
+        if since is not None:
+            raise ValueError(
+                f"{type(self).__name__} does not keep completion times")
+        if limit < 1:
+            raise ValueError(f"limit must be at least 1, got {limit}")
+        # the cursor is the number of matching tasks before it
+        skip = 0
+        if cursor is not None:
+            skip, _ = decode_cursor(cursor)
+            if not isinstance(skip, int):
+                raise ValueError(f"Invalid cursor {cursor}")
+        wanted = set(filters.items())
+        matching = ((task_id, response)
+                    for task_id, response in self.iter_finished_tasks()
+                    if wanted.issubset(index_keys(response)))
+        page = list(itertools.islice(matching, skip, skip + limit + 1))
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor(skip + limit, page[-1][0])
+        return dict(page), next_cursor
+
+    def get_due_tasks(
+            self,
+            until: datetime = None,
+            limit: int = DEFAULT_PAGE_SIZE
+    ) -> ty.List[ty.Tuple[str, str, str]]:
+        """Up to limit pending tasks due at or before until (now by default),
+        as (task_id, dt_str, url), the earliest due first.
+
+        This scans every pending task, stores with an index on due time should
+        override it.
+        """
+        until_str = (until or datetime.now()).strftime(c.DT_STR)
+        due = (task for batch in self.iter_pending_tasks() for task in batch
+               if task[1] <= until_str)
+        return heapq.nsmallest(limit, due, key=lambda task: (task[1], task[0]))
+
+    def count_pending_tasks(self) -> int:
+        """Number of pending tasks. Streams every pending task, stores that
+        can count them should override it"""
+        return sum(len(batch) for batch in self.iter_pending_tasks())
+
+    def add_completion_listener(self,
+                                listener: ty.Callable[[ty.List[str]], None]):
+        """Call listener with the ids of completed tasks, once their responses
+        can be read"""
+        self._completion_listeners = getattr(self, "_completion_listeners",
+                                             []) + [listener]
+
+    def _notify_completed(self, task_ids: ty.List[str]):
+        for listener in getattr(self, "_completion_listeners", ()):
+            try:
+                listener(task_ids)
+            except Exception as e:
+                tlog.error("completion listener failed", err=e)
+
+    # Bulk versions of the methods above. These fall back to one call per
+    # item, stores that can do better should override them.
+
+    def add_responses_bulk(self, items: ty.Iterable[ty.Tuple[str, ty.Any]]):
+        """add_response for every (task_id, response)"""
+        for task_id, response in items:
+            self.add_response(task_id, response)
+
+    def add_pending_tasks_bulk(self,
+                               items: ty.Iterable[ty.Tuple[str, str, str]]):
+        """add_pending_task_id for every (task_id, dt_str, url)"""
+        for task_id, dt_str, url in items:
+            self.add_pending_task_id(task_id, dt_str, url)
+
+    def complete_tasks_bulk(self, task_ids: ty.Iterable[str]):
+        """remove_pending_task_id for every task_id"""
+        for task_id in task_ids:
+            self.remove_pending_task_id(task_id)
+
 
 class InMemoryStore(AbstractMemoryStore):
 
-    def __init__(self):
+    def __init__(self,
+                 max_entries: int = None,
+                 max_bytes: int = None,
+                 ttl: float = None,
+                 eviction_policy: str = EVICT_LRU,
+                 spill_dir: str = None,
+                 max_spilled: int = DEFAULT_MAX_SPILLED):
+        """
+        By default every response is kept for the life of the process. The
+        retention arguments bound what is kept:
+
+        Args:
+            max_entries: max number of finished tasks kept
+            max_bytes: max approximate size of the kept responses, as json.
+                A response shared by several tasks is counted once. Sizing a
+                response costs a json.dumps, so it is only done when this is
+                set
+            ttl: seconds a finished task is kept after it completed
+            eviction_policy: which task goes when a max is hit, EVICT_LRU for
+                the least recently read or written, EVICT_AGE for the oldest
+            spill_dir: if given, responses evicted by max_entries or max_bytes
+                are written here and read back from disk when asked for.
+                Responses past their ttl are dropped either way, and a spilled
+                response's file is deleted when it expires or its task is
+                completed again. Files this store did not write are not read
+            max_spilled: max number of spilled responses kept, the oldest
+                spilled is deleted when it is hit. None keeps every one
+        """
         tlog.info("Store init")
+        if eviction_policy not in (EVICT_LRU, EVICT_AGE):
+            raise ValueError(f"Unknown eviction policy {eviction_policy}")
         self.task_id2response = dict()
         self.pending_task_ids = dict()
+        # (dt_str, task_id) of the pending tasks, earliest due first. Entries
+        # of tasks that are no longer pending, or were added again with
+        # another dt_str, are dropped lazily
+        self._due_heap: ty.List[ty.Tuple[str, str]] = []
+        # completion order, for pagination and ttl. A task that is completed
+        # again gets a new seq, and its old entry is skipped as stale
+        self._next_seq = 0
+        self.task_id2seq = dict()
+        self._completion_order: ty.List[ty.Tuple[int, str]] = []
+        self._completion_head = 0
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.eviction_policy = eviction_policy
+        self.spill_dir = spill_dir
+        self.max_spilled = max_spilled
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        self.task_id2completed_at = dict()
+        # eviction order, least recently used or oldest first
+        self._eviction_order: OrderedDict = OrderedDict()
+        # content addressed responses. Equal responses are kept once, as
+        # hash -> [response, number of tasks with it, size, index keys], and
+        # shared by their tasks
+        self.task_id2hash = dict()
+        self._hash2blob: ty.Dict[str, list] = dict()
+        # disruption_index keys -> their finished tasks, in completion order.
+        # A blob keeps the keys of its response, so they are only worked out
+        # once for tasks sharing it
+        self._key2task_ids: ty.Dict[ty.Tuple[str, str], dict] = dict()
+        # and -> (seq, task_id) of those tasks, to resume a listing from its
+        # cursor. Entries of tasks since dropped or completed again are stale
+        # and skipped, like those of _completion_order
+        self._key2seqs: ty.Dict[ty.Tuple[str, str], list] = dict()
+        self._last_blob: ty.Tuple[ty.Any, str] = (None, None)
+        # task_id -> completed_at of the spilled tasks, oldest spilled first,
+        # and (completed_at,
+        # task_id) of them soonest to expire first when there is a ttl.
+        # Entries of tasks that were unspilled or spilled again are dropped
+        # lazily
+        self._spilled: ty.Dict[str, float] = dict()
+        self._spill_expiry: ty.List[ty.Tuple[float, str]] = []
+        self.current_bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.spilled = 0
 
     def add_response(self, task_id, response):
-        tlog.info(f"adding response for {task_id}", response=response)
-        self.task_id2response[task_id] = response
-        tlog.info(f"added. task_id2response = {self.task_id2response}",
-                  store=self)
+        tlog.debug("adding response",
+                   task_id=task_id,
+                   response=tlog.capped(response))
+        if task_id in self.task_id2response:
+            self._drop(task_id)
+        elif task_id in self._spilled:
+            self._unspill(task_id)
+        self.task_id2response[task_id] = self._intern(task_id, response)
+        seq = self._take_seq()
+        for key in self._hash2blob[self.task_id2hash[task_id]][3]:
+            self._key2task_ids.setdefault(key, dict())[task_id] = None
+            self._key2seqs.setdefault(key, []).append((seq, task_id))
+        self.task_id2seq[task_id] = seq
+        self._completion_order.append((seq, task_id))
+        self.task_id2completed_at[task_id] = time.monotonic()
+        self._eviction_order[task_id] = None
+        self._enforce_retention()
+        tlog.sampled(1000, "store footprint", stats=tlog.lazy(self.stats))
         self.remove_pending_task_id(task_id=task_id)
+        self._notify_completed([task_id])
+
+    def _take_seq(self) -> int:
+        seq = self._next_seq
+        self._next_seq += 1
+        return seq
+
+    def _intern(self, task_id, response):
+        """The kept response equal to response, keeping response if there is
+        none"""
+        last_response, key = self._last_blob
+        # tasks sharing a fetch are added one after the other with the same
+        # object, which only needs hashing once
+        if response is not last_response:
+            key = codec.content_hash(response)
+            self._last_blob = (response, key)
+        blob = self._hash2blob.get(key)
+        if blob is None:
+            size = approx_size(response) if self.max_bytes is not None else 0
+            blob = self._hash2blob[key] = [
+                response, 0, size, index_keys(response)
+            ]
+            self.current_bytes += size
+        blob[1] += 1
+        self.task_id2hash[task_id] = key
+        return blob[0]
+
+    def _drop(self, task_id):
+        del self.task_id2response[task_id]
+        del self.task_id2seq[task_id]
+        del self.task_id2completed_at[task_id]
+        del self._eviction_order[task_id]
+        key = self.task_id2hash.pop(task_id)
+        blob = self._hash2blob[key]
+        for index_key in blob[3]:
+            task_ids = self._key2task_ids[index_key]
+            del task_ids[task_id]
+            if not task_ids:
+                del self._key2task_ids[index_key]
+                del self._key2seqs[index_key]
+                continue
+            seqs = self._key2seqs[index_key]
+            if len(seqs) > 2 * len(task_ids) + 64:
+                # in place, as a listing may be iterating it. The key's tasks
+                # are in completion order already
+                seqs[:] = [(self.task_id2seq[id], id) for id in task_ids]
+        blob[1] -= 1
+        if blob[1] == 0:
+            del self._hash2blob[key]
+            self.current_bytes -= blob[2]
+
+    def _expire(self):
+        if self.ttl is None:
+            return
+        expired_before = time.monotonic() - self.ttl
+        order = self._completion_order
+        while self._completion_head < len(order):
+            seq, task_id = order[self._completion_head]
+            if self.task_id2seq.get(task_id) == seq:
+                if self.task_id2completed_at[task_id] > expired_before:
+                    break
+                self._drop(task_id)
+                self.expirations += 1
+            self._completion_head += 1
+        while self._spill_expiry and self._spill_expiry[0][0] <= expired_before:
+            completed_at, task_id = heapq.heappop(self._spill_expiry)
+            if self._spilled.get(task_id) == completed_at:
+                self._unspill(task_id)
+                self.expirations += 1
+
+    def _compact_completion_order(self):
+        order = self._completion_order
+        head = self._completion_head
+        if len(order) - head > 2 * len(self.task_id2seq) + 1024:
+            # mostly entries of tasks since evicted or completed again. In
+            # place, as a listing may be iterating it
+            order[:] = [(seq, task_id)
+                        for seq, task_id in itertools.islice(order, head, None)
+                        if self.task_id2seq.get(task_id) == seq]
+            self._completion_head = 0
+        elif head > 1024 and head > len(order) // 2:
+            # drop the entries before the head, and stale entries with them
+            del order[:head]
+            self._completion_head = 0
+
+    def _enforce_retention(self):
+        self._expire()
+        while self._eviction_order and (
+            (self.max_entries is not None
+             and len(self.task_id2response) > self.max_entries) or
+            (self.max_bytes is not None
+             and self.current_bytes > self.max_bytes)):
+            task_id = next(iter(self._eviction_order))
+            if self.spill_dir is not None:
+                self._spill(task_id)
+            self._drop(task_id)
+            self.evictions += 1
+        self._compact_completion_order()
+
+    def _spill_path(self, task_id) -> str:
+        name = hashlib.sha256(str(task_id).encode()).hexdigest()
+        return os.path.join(self.spill_dir, name)
+
+    def _spill(self, task_id):
+        with open(self._spill_path(task_id), "wb") as f:
+            f.write(codec.get_codec().encode(self.task_id2response[task_id]))
+        completed_at = self.task_id2completed_at[task_id]
+        self._spilled[task_id] = completed_at
+        if self.ttl is not None:
+            heapq.heappush(self._spill_expiry, (completed_at, task_id))
+        self.spilled += 1
+        while (self.max_spilled is not None
+               and len(self._spilled) > self.max_spilled):
+            self._unspill(next(iter(self._spilled)))
+
+    def _unspill(self, task_id):
+        del self._spilled[task_id]
+        try:
+            os.remove(self._spill_path(task_id))
+        except FileNotFoundError:
+            pass
+
+    def _read_spilled(self, task_id):
+        if task_id not in self._spilled:
+            return None
+        try:
+            with open(self._spill_path(task_id), "rb") as f:
+                return codec.decode(f.read())
+        except FileNotFoundError:
+            return None
 
     def add_pending_task_id(self, task_id, dt_str: str, url: str):
-        tlog.info(f"adding pending task for {dt_str}")
+        tlog.debug("adding pending task", task_id=task_id, dt_str=dt_str)
         self.pending_task_ids[task_id] = (dt_str, url)
+        heapq.heappush(self._due_heap, (dt_str, task_id))
+
+    def is_pending_task_id(self, task_id):
+        return task_id in self.pending_task_ids
 
     def remove_pending_task_id(self, task_id):
         if task_id in self.pending_task_ids:
             del self.pending_task_ids[task_id]
+            self._compact_due_heap()
+
+    def _compact_due_heap(self):
+        # rebuilt once stale entries are the bulk of the heap, so it stays
+        # proportional to the number of pending tasks
+        if len(self._due_heap) > 2 * len(self.pending_task_ids) + 1024:
+            self._due_heap = [(dt_str, task_id) for task_id, (
+                dt_str, _) in self.pending_task_ids.items()]
+            heapq.heapify(self._due_heap)
+
+    def get_due_tasks(
+            self,
+            until: datetime = None,
+            limit: int = DEFAULT_PAGE_SIZE
+    ) -> ty.List[ty.Tuple[str, str, str]]:
+        until_str = (until or datetime.now()).strftime(c.DT_STR)
+        due = []
+        seen = set()
+        while self._due_heap and len(due) < limit:
+            dt_str, task_id = self._due_heap[0]
+            if dt_str > until_str:
+                break
+            heapq.heappop(self._due_heap)
+            pending = self.pending_task_ids.get(task_id)
+            if pending is None or pending[0] != dt_str or task_id in seen:
+                continue
+            seen.add(task_id)
+            due.append((task_id, dt_str, pending[1]))
+        # the tasks are still pending, so their entries go back
+        for task_id, dt_str, _ in due:
+            heapq.heappush(self._due_heap, (dt_str, task_id))
+        return due
 
     def get_task_id_response(self, task_id) -> dict:
-        tlog.info(f"getting response for {task_id}")
+        tlog.debug("getting response", task_id=task_id)
+        self._expire()
         if task_id in self.task_id2response:
+            if self.eviction_policy == EVICT_LRU:
+                self._eviction_order.move_to_end(task_id)
             return self.task_id2response[task_id]
+        spilled = self._read_spilled(task_id)
+        if spilled is not None:
+            return spilled
         else:
-            tlog.error(f"in store. task_id2response = {self.task_id2response}",
-                       store=self)
+            tlog.debug("task not found in store",
+                       task_id=task_id,
+                       entries=len(self.task_id2response))
             raise ValueError(f"Store does not have {task_id}")
 
     def get_all_pending_tasks(self) -> ty.List[str]:
         return list(self.pending_task_ids.keys())
 
+    def count_pending_tasks(self) -> int:
+        return len(self.pending_task_ids)
+
     def get_all_finished_tasks(self) -> ty.Dict[str, str]:
         return self.task_id2response
 
+    def iter_pending_tasks(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ty.Iterator[ty.List[ty.Tuple[str, str, str]]]:
+        pending = list(self.pending_task_ids.items())
+        for i in range(0, len(pending), batch_size):
+            yield [(task_id, dt_str, url)
+                   for task_id, (dt_str, url) in pending[i:i + batch_size]]
+
+    def stats(self) -> ty.Dict[str, int]:
+        return {
+            "entries": len(self.task_id2response),
+            "unique_responses": len(self._hash2blob),
+            "bytes": self.current_bytes,
+            "pending": len(self.pending_task_ids),
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "spilled": self.spilled,
+        }
+
+    def _iter_completed(self, after_seq: int = -1):
+        self._expire()
+        order = self._completion_order
+        i = bisect.bisect_left(order, (after_seq + 1, ))
+        while i < len(order):
+            seq, task_id = order[i]
+            i += 1
+            if self.task_id2seq.get(task_id) != seq:
+                continue
+            response = self.task_id2response.get(task_id)
+            if response is None:
+                continue
+            yield seq, task_id, response
+            if i > len(order) or order[i - 1][0] != seq:
+                # compacted while the caller had the task, e.g. by a write
+                # while a listing is streamed
+                i = bisect.bisect_left(order, (seq + 1, ))
+
+    def get_finished_tasks_page(
+        self,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: str = None
+    ) -> ty.Tuple[ty.Dict[str, ty.Any], ty.Optional[str]]:
+        if limit < 1:
+            raise ValueError(f"limit must be at least 1, got {limit}")
+        return _seq_page(self._iter_completed(_decode_seq_cursor(cursor)),
+                         limit)
+
+    def _iter_matching(self,
+                       after_seq: int,
+                       filters: ty.Dict[str, str],
+                       since: datetime = None):
+        """_iter_completed for the tasks find_finished_tasks asks for"""
+        if filters:
+            completed = self._iter_indexed(after_seq, filters)
+        else:
+            completed = self._iter_completed(after_seq)
+        if since is None:
+            yield from completed
+            return
+        # completion times are on the monotonic clock
+        since_at = time.monotonic() - (datetime.now() - since).total_seconds()
+        for seq, task_id, response in completed:
+            if self.task_id2completed_at[task_id] >= since_at:
+                yield seq, task_id, response
+
+    def _iter_indexed(self, after_seq: int, filters: ty.Dict[str, str]):
+        """_iter_completed for the tasks with every key of filters. Walks the
+        key with the fewest tasks from after_seq on"""
+        self._expire()
+        keys = sorted(filters.items(),
+                      key=lambda key: len(self._key2task_ids.get(key, ())))
+        if keys[0] not in self._key2seqs:
+            return
+        seqs = self._key2seqs[keys[0]]
+        others = [self._key2task_ids.get(key, dict()) for key in keys[1:]]
+        i = bisect.bisect_left(seqs, (after_seq + 1, ))
+        while i < len(seqs):
+            seq, task_id = seqs[i]
+            i += 1
+            if self.task_id2seq.get(task_id) != seq or not all(
+                    task_id in task_ids for task_ids in others):
+                continue
+            yield seq, task_id, self.task_id2response[task_id]
+            if i > len(seqs) or seqs[i - 1][0] != seq:
+                # compacted while the caller had the task
+                i = bisect.bisect_left(seqs, (seq + 1, ))
+
+    def find_finished_tasks(
+        self,
+        filters: ty.Dict[str, str],
+        since: datetime = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: str = None
+    ) -> ty.Tuple[ty.Dict[str, ty.Any], ty.Optional[str]]:
+        """Answered from the index of the tasks in memory, spilled tasks are
+        not found"""
+        if limit < 1:
+            raise ValueError(f"limit must be at least 1, got {limit}")
+        return _seq_page(
+            self._iter_matching(_decode_seq_cursor(cursor), filters, since),
+            limit)
+
+    def iter_finished_tasks(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ty.Iterator[ty.Tuple[str, ty.Any]]:
+        for _, task_id, response in self._iter_completed():
+            yield task_id, response
+
+
+class _StoreShard(InMemoryStore):
+    """InMemoryStore taking its completion order from a counter shared with
+    the other shards of a ConcurrentInMemoryStore"""
+
+    def __init__(self, seqs: ty.Iterator[int], **kwargs):
+        super().__init__(**kwargs)
+        self._seqs = seqs
+
+    def _take_seq(self) -> int:
+        # next() on an itertools.count is atomic, so shards need no lock to
+        # share it
+        return next(self._seqs)
+
+
+def _per_shard(limit: ty.Optional[int], shards: int) -> ty.Optional[int]:
+    return None if limit is None else -(-limit // shards)
+
+
+class ConcurrentInMemoryStore(AbstractMemoryStore):
+
+    def __init__(self,
+                 shards: int = DEFAULT_SHARDS,
+                 max_entries: int = None,
+                 max_bytes: int = None,
+                 max_spilled: int = DEFAULT_MAX_SPILLED,
+                 **kwargs):
+        """
+        InMemoryStore that can be used by many threads at once, e.g. the
+        scheduler's workers and the app's request threads.
+
+        Tasks are split over shards by the hash of their id, each shard an
+        InMemoryStore with its own lock. Writes take the lock of their task's
+        shard only, so writes of different tasks seldom wait for each other.
+        Listings take every shard's lock, always in the same order, while
+        they copy what they return. They are a consistent snapshot, and a
+        page never skips a task that completed before one it has.
+
+        Args:
+            shards: number of shards, and of locks
+            max_entries: as for InMemoryStore, split evenly over the shards,
+                so it is kept to approximately
+            max_bytes: as max_entries
+            max_spilled: as max_entries
+            kwargs: the other arguments of InMemoryStore, for every shard
+        """
+        if shards < 1:
+            raise ValueError(f"shards must be at least 1, got {shards}")
+        tlog.info("Concurrent store init", shards=shards)
+        seqs = itertools.count()
+        self._shards = [
+            _StoreShard(seqs,
+                        max_entries=_per_shard(max_entries, shards),
+                        max_bytes=_per_shard(max_bytes, shards),
+                        max_spilled=_per_shard(max_spilled, shards),
+                        **kwargs) for _ in range(shards)
+        ]
+        self._locks = [threading.Lock() for _ in range(shards)]
+
+    def _index(self, task_id) -> int:
+        return hash(task_id) % len(self._shards)
+
+    def _by_shard(self, items: ty.Iterable[tuple]) -> ty.Dict[int, list]:
+        """items grouped by the shard of their first element, the task id"""
+        by_shard = dict()
+        for item in items:
+            by_shard.setdefault(self._index(item[0]), []).append(item)
+        return by_shard
+
+    @contextmanager
+    def _all_locks(self):
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self._locks):
+                lock.release()
+
+    def add_response(self, task_id, response):
+        i = self._index(task_id)
+        with self._locks[i]:
+            self._shards[i].add_response(task_id, response)
+        # listeners run without the lock, they may read the store
+        self._notify_completed([task_id])
+
+    def add_responses_bulk(self, items: ty.Iterable[ty.Tuple[str, ty.Any]]):
+        items = list(items)
+        for i, shard_items in self._by_shard(items).items():
+            with self._locks[i]:
+                for task_id, response in shard_items:
+                    self._shards[i].add_response(task_id, response)
+        self._notify_completed([task_id for task_id, _ in items])
+
+    def add_pending_task_id(self, task_id, dt_str: str, url: str):
+        i = self._index(task_id)
+        with self._locks[i]:
+            self._shards[i].add_pending_task_id(task_id, dt_str, url)
+
+    def add_pending_tasks_bulk(self,
+                               items: ty.Iterable[ty.Tuple[str, str, str]]):
+        for i, shard_items in self._by_shard(items).items():
+            with self._locks[i]:
+                for task_id, dt_str, url in shard_items:
+                    self._shards[i].add_pending_task_id(task_id, dt_str, url)
+
+    def is_pending_task_id(self, task_id):
+        i = self._index(task_id)
+        with self._locks[i]:
+            return self._shards[i].is_pending_task_id(task_id)
+
+    def remove_pending_task_id(self, task_id):
+        i = self._index(task_id)
+        with self._locks[i]:
+            self._shards[i].remove_pending_task_id(task_id)
+
+    def complete_tasks_bulk(self, task_ids: ty.Iterable[str]):
+        by_shard = self._by_shard((task_id, ) for task_id in task_ids)
+        for i, shard_items in by_shard.items():
+            with self._locks[i]:
+                for item in shard_items:
+                    self._shards[i].remove_pending_task_id(item[0])
+
+    def get_task_id_response(self, task_id):
+        i = self._index(task_id)
+        # reads move the task in the shard's lru order
+        with self._locks[i]:
+            return self._shards[i].get_task_id_response(task_id)
+
+    def get_due_tasks(
+            self,
+            until: datetime = None,
+            limit: int = DEFAULT_PAGE_SIZE
+    ) -> ty.List[ty.Tuple[str, str, str]]:
+        due = []
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                due.extend(shard.get_due_tasks(until=until, limit=limit))
+        return heapq.nsmallest(limit, due, key=lambda task: (task[1], task[0]))
+
+    def count_pending_tasks(self) -> int:
+        # len of a dict is atomic, this is exact but for writes under way
+        return sum(len(shard.pending_task_ids) for shard in self._shards)
+
+    def get_all_pending_tasks(self) -> ty.List[str]:
+        with self._all_locks():
+            return [
+                task_id for shard in self._shards
+                for task_id in shard.pending_task_ids
+            ]
+
+    def get_all_finished_tasks(self) -> ty.Dict[str, ty.Any]:
+        """A copy of every finished task, in completion order"""
+        return {
+            task_id: response
+            for _, task_id, response in self._completed_after(-1)
+        }
+
+    def iter_pending_tasks(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ty.Iterator[ty.List[ty.Tuple[str, str, str]]]:
+        with self._all_locks():
+            pending = [(task_id, dt_str, url) for shard in self._shards
+                       for task_id, (dt_str,
+                                     url) in shard.pending_task_ids.items()]
+        for i in range(0, len(pending), batch_size):
+            yield pending[i:i + batch_size]
+
+    def _completed_after(
+            self,
+            after_seq: int,
+            limit: int = None,
+            filters: ty.Dict[str, str] = None,
+            since: datetime = None) -> ty.List[ty.Tuple[int, str, ty.Any]]:
+        """The first limit (seq, task_id, response) completed after
+        after_seq across the shards, every one by default, of the tasks
+        matching filters and since"""
+        with self._all_locks():
+            merged = heapq.merge(*(
+                shard._iter_matching(after_seq, filters or dict(), since)
+                for shard in self._shards))
+            return list(itertools.islice(merged, limit))
+
+    def get_finished_tasks_page(
+        self,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: str = None
+    ) -> ty.Tuple[ty.Dict[str, ty.Any], ty.Optional[str]]:
+        if limit < 1:
+            raise ValueError(f"limit must be at least 1, got {limit}")
+        return _seq_page(
+            self._completed_after(_decode_seq_cursor(cursor), limit + 1),
+            limit)
+
+    def find_finished_tasks(
+        self,
+        filters: ty.Dict[str, str],
+        since: datetime = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: str = None
+    ) -> ty.Tuple[ty.Dict[str, ty.Any], ty.Optional[str]]:
+        if limit < 1:
+            raise ValueError(f"limit must be at least 1, got {limit}")
+        return _seq_page(
+            self._completed_after(_decode_seq_cursor(cursor),
+                                  limit + 1,
+                                  filters=filters,
+                                  since=since), limit)
+
+    def iter_finished_tasks(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ty.Iterator[ty.Tuple[str, ty.Any]]:
+        # the locks are only held while a batch is copied
+        after_seq = -1
+        while True:
+            completed = self._completed_after(after_seq, batch_size)
+            if not completed:
+                return
+            for _, task_id, response in completed:
+                yield task_id, response
+            after_seq = completed[-1][0]
+
+    def stats(self) -> ty.Dict[str, int]:
+        totals = Counter()
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                totals.update(shard.stats())
+        return dict(totals, shards=len(self._shards))
+
 
 class TaskId2Response(Base):
     __tablename__ = 'taskid2response'
     task_id = Column(String, primary_key=True)
-    response = Column(String)
+    # the response's ResponseBlob
+    response_hash = Column(String)
+    # the response itself, only set on rows written before responses were
+    # kept as blobs. Encoded with one of the codecs in codec.py
+    response = Column(LargeBinary)
+    completed_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (Index('ix_taskid2response_completed_at_task_id',
+                            'completed_at', 'task_id'),
+                      Index('ix_taskid2response_response_hash',
+                            'response_hash'))
+
+class ResponseBlob(Base):
+    """A response, kept once however many tasks have it"""
+    __tablename__ = 'response_blobs'
+    # codec.content_hash of the response
+    hash = Column(String, primary_key=True)
+    # encoded with one of the codecs in codec.py
+    body = Column(LargeBinary)
+    # number of taskid2response rows with this response
+    refcount = Column(Integer, nullable=False, default=0)
+
+
+class ResponseKey(Base):
+    """A disruption_index key of a blob's response, e.g. (line, central), so
+    finished tasks can be found without decoding their responses"""
+    __tablename__ = 'response_keys'
+    # the primary key is the lookup index, by field and value
+    field = Column(String, primary_key=True)
+    value = Column(String, primary_key=True)
+    hash = Column(String, primary_key=True)
+    __table_args__ = (Index('ix_response_keys_hash', 'hash'), )
+
+
+# keys of a blob are written with the blob, and are the same each time.
+# Postgres and sqlite 3.24+ both have this syntax
+_INSERT_KEYS = sqlalchemy.text(
+    "INSERT INTO response_keys (field, value, hash) "
+    "VALUES (:field, :value, :hash) ON CONFLICT DO NOTHING")
+
+# adds to the refcount of blobs that are already there. Postgres and sqlite
+# 3.24+ both have this syntax
+_UPSERT_BLOB = sqlalchemy.text(
+    "INSERT INTO response_blobs (hash, body, refcount) "
+    "VALUES (:hash, :body, :refcount) "
+    "ON CONFLICT (hash) DO UPDATE "
+    "SET refcount = response_blobs.refcount + excluded.refcount")
+
+# the response of a taskid2response row, from its blob or the row itself
+_RESPONSE = sqlalchemy.func.coalesce(
+    ResponseBlob.body, TaskId2Response.response).label("response")
+
+_RESPONSE_BY_TASK_ID = sqlalchemy.select([_RESPONSE]).select_from(
+    TaskId2Response.__table__.outerjoin(
+        ResponseBlob.__table__,
+        ResponseBlob.hash == TaskId2Response.response_hash)).where(
+            TaskId2Response.task_id == sqlalchemy.bindparam("task_id"))
+
 
 class PendingTaskIds(Base):
     __tablename__ = 'pending_task_ids'
     task_id = Column(String, primary_key=True)
     dt_str = Column(String)
+    # dt_str parsed, for range queries on its index. Null if dt_str could not
+    # be parsed, such tasks are never due
+    due_at = Column(DateTime)
     url = Column(String)
+    # set while a worker runs the task, see SQLStore.claim_due_tasks
+    claimed_by = Column(String)
+    claimed_until = Column(DateTime)
+    # failed runs, see SQLStore.release_claimed_tasks
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    __table_args__ = (Index('ix_pending_task_ids_due_at', 'due_at'), )
+
+
+_PENDING_BY_TASK_ID = sqlalchemy.select([PendingTaskIds.task_id]).where(
+    PendingTaskIds.task_id == sqlalchemy.bindparam("task_id"))
+
+_COUNT_PENDING = sqlalchemy.select([sqlalchemy.func.count()
+                                    ]).select_from(PendingTaskIds.__table__)
 
 
 @contextmanager
@@ -137,8 +1061,51 @@ def session_scope(session_maker: sessionmaker):
 
 
 class SQLStore(AbstractMemoryStore):
-    def __init__(self):
+    def __init__(self,
+                 database_url: str = None,
+                 codec_name: str = codec.DEFAULT_CODEC,
+                 pool_size: int = c.SQL_POOL_SIZE,
+                 max_overflow: int = c.SQL_MAX_OVERFLOW,
+                 pool_timeout: float = c.SQL_POOL_TIMEOUT,
+                 pool_recycle: int = c.SQL_POOL_RECYCLE,
+                 pool_pre_ping: bool = c.SQL_POOL_PRE_PING):
+        """
+        Args:
+            database_url: if given, the store connects to this database as it
+                is. Otherwise it connects to the local postgres server and
+                creates the database if needed
+            codec_name: codec responses are written with. Responses written
+                with any other codec can still be read
+            pool_size: connections kept open. Sqlite pools its connections its
+                own way, and ignores this, max_overflow and pool_timeout
+            max_overflow: connections opened on top of pool_size under load,
+                and closed when returned
+            pool_timeout: seconds to wait for a connection before failing
+            pool_recycle: seconds before a connection is replaced, -1 for never
+            pool_pre_ping: check connections before handing them out, so ones
+                the server dropped are replaced rather than failing a query
+        """
         tlog.info("Sql store init")
+        self.codec = codec.get_codec(codec_name)
+        # compiled single row lookups, see _execute_one
+        self._compiled_cache = dict()
+        engine_args = dict(pool_recycle=pool_recycle,
+                           pool_pre_ping=pool_pre_ping)
+        if database_url is None or not database_url.startswith("sqlite"):
+            engine_args.update(pool_size=pool_size,
+                               max_overflow=max_overflow,
+                               pool_timeout=pool_timeout)
+        if database_url is not None:
+            connect_args = dict()
+            if database_url.startswith("sqlite"):
+                # several worker processes may share the file
+                connect_args["timeout"] = SQLITE_BUSY_TIMEOUT
+            self.engine = create_engine(database_url,
+                                        connect_args=connect_args,
+                                        **engine_args)
+            Base.metadata.create_all(self.engine)
+            self.session_maker = get_global_session_maker(self.engine)
+            return
 
         conn_options = dict(
             drivername="postgresql",
@@ -147,7 +1114,7 @@ class SQLStore(AbstractMemoryStore):
             port=5431
         )
         database_url = URL(**conn_options)
-        self.engine = create_engine(database_url)
+        self.engine = create_engine(database_url, **engine_args)
         conn, retries = retry_func(self.engine.connect,
                                    max_attempts=3,
                                    waiting_time=3)
@@ -162,37 +1129,344 @@ class SQLStore(AbstractMemoryStore):
         Base.metadata.create_all(self.engine)
         self.session_maker = get_global_session_maker(self.engine)
 
+    def _connect(self):
+        """A connection from the pool, timing the wait for it"""
+        with _CHECKOUT.time():
+            return self.engine.connect()
+
+    def _execute_one(self, statement, **params):
+        """First row of a core statement, without the orm's session. The
+        statement is compiled once per store"""
+        with self._connect() as conn:
+            conn = conn.execution_options(compiled_cache=self._compiled_cache)
+            return conn.execute(statement, **params).first()
+
     @contextmanager
     def session_scope(self):
         """Create a session context"""
-        session = self.session_maker()
+        conn = self._connect()
+        session = self.session_maker(bind=conn)
         try:
             yield session
             session.commit()
+            _COMMITS.inc()
         except Exception as e:
             tlog.error(f'Rolling back as exception occurred: {str(e)}')
             session.rollback()
+            _ROLLBACKS.inc()
             raise e
         finally:
             session.close()
+            conn.close()
+
+    def stats(self) -> ty.Dict[str, ty.Any]:
+        """State of the connection pool. Query latencies and transaction
+        counts are in metrics.get_metrics()"""
+        pool = self.engine.pool
+        stats = {"pool": type(pool).__name__, "status": pool.status()}
+        # only QueuePool, the default for servers, counts its connections
+        if isinstance(pool, QueuePool):
+            stats.update(size=pool.size(),
+                         checkedin=pool.checkedin(),
+                         checkedout=pool.checkedout(),
+                         overflow=pool.overflow())
+        return stats
+
+    def migrate(self):
+        """Bring tables created by older versions of the store up to date.
+        Postgres only.
+
+        The text response column is turned into a bytes one. Existing rows are
+        kept as they are, and are decoded as legacy str(response) values when
+        read. The completed_at column and its index are added, with old rows
+        set to the epoch so they come first, and the response_hash column.
+        Old rows keep their response inline. Pending tasks get their claim
+        and attempts columns, and a due_at column parsed from their dt_str. The
+        response_hash index is added. Blobs written before response_keys
+        existed are not indexed, so find_finished_tasks does not find them.
+        """
+        table = TaskId2Response.__tablename__
+        inspector = sqlalchemy.inspect(self.engine)
+        columns = {
+            column["name"]: column["type"]
+            for column in inspector.get_columns(table)
+        }
+        pending_table = PendingTaskIds.__tablename__
+        pending_columns = {
+            column["name"]
+            for column in inspector.get_columns(pending_table)
+        }
+        with self.engine.begin() as conn:
+            if isinstance(columns["response"], sqlalchemy.String):
+                tlog.info("migrating response column to bytea")
+                conn.execute(f"ALTER TABLE {table} "
+                             f"ALTER COLUMN response TYPE bytea "
+                             f"USING convert_to(response, 'UTF8')")
+            if "completed_at" not in columns:
+                tlog.info("adding completed_at column")
+                conn.execute(f"ALTER TABLE {table} "
+                             f"ADD COLUMN completed_at TIMESTAMP "
+                             f"NOT NULL DEFAULT '1970-01-01'")
+                conn.execute(f"CREATE INDEX IF NOT EXISTS "
+                             f"ix_taskid2response_completed_at_task_id "
+                             f"ON {table} (completed_at, task_id)")
+            if "response_hash" not in columns:
+                tlog.info("adding response_hash column")
+                conn.execute(f"ALTER TABLE {table} "
+                             f"ADD COLUMN response_hash VARCHAR")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS "
+                         f"ix_taskid2response_response_hash "
+                         f"ON {table} (response_hash)")
+            if "claimed_by" not in pending_columns:
+                tlog.info("adding task claim columns")
+                conn.execute(f"ALTER TABLE {pending_table} "
+                             f"ADD COLUMN claimed_by VARCHAR, "
+                             f"ADD COLUMN claimed_until TIMESTAMP")
+            if "attempts" not in pending_columns:
+                tlog.info("adding task attempts column")
+                conn.execute(f"ALTER TABLE {pending_table} "
+                             f"ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+            if "due_at" not in pending_columns:
+                tlog.info("adding due_at column")
+                conn.execute(f"ALTER TABLE {pending_table} "
+                             f"ADD COLUMN due_at TIMESTAMP")
+                conn.execute(f"UPDATE {pending_table} SET due_at = "
+                             f"to_timestamp(dt_str, "
+                             f"'YYYY-MM-DD\"T\"HH24:MI:SS')::timestamp "
+                             f"WHERE dt_str ~ "
+                             f"'^\\d{{4}}-\\d{{2}}-\\d{{2}}T"
+                             f"\\d{{2}}:\\d{{2}}:\\d{{2}}$'")
+                conn.execute(f"CREATE INDEX IF NOT EXISTS "
+                             f"ix_pending_task_ids_due_at "
+                             f"ON {pending_table} (due_at)")
 
     def add_response(self, task_id, response):
-        if task_id and not isinstance(task_id, str):
-            task_id = str(task_id)
-        if response and not isinstance(response, str):
-            response = str(response)
-        tlog.info(f"adding response for {task_id}", response=response)
+        tlog.debug("adding response",
+                   task_id=task_id,
+                   response=tlog.capped(response))
+        self.add_responses_bulk([(task_id, response)])
 
+    @_timed_query
+    def add_responses_bulk(self, items: ty.Iterable[ty.Tuple[str, ty.Any]]):
+        """Insert the responses and delete the pending rows of their tasks,
+        with multi-row statements in a single transaction"""
+        items = list(items)
         with self.session_scope() as s:
-            to_insert = TaskId2Response(task_id=task_id, response=response)
-            s.add(to_insert)
-            s.commit()
-        tlog.info("Done adding task_id to sql table")
-        self.remove_pending_task_id(task_id=task_id)
+            self._insert_responses(s, items)
+        self._notify_completed([task_id for task_id, _ in items])
+
+    def _insert_responses(self,
+                          s,
+                          items: ty.Iterable[ty.Tuple[str, ty.Any]],
+                          only_new: bool = False):
+        """Insert task rows pointing at the responses' blobs, add the blobs
+        or their refcounts, and delete the tasks' pending rows.
 
+        Args:
+            only_new: skip tasks that already have a response, rather than
+                failing
+        """
+        rows = []
+        hash2body = dict()
+        hash2keys = dict()
+        completed_at = datetime.utcnow()
+        last_response, key = None, None
+        for task_id, response in items:
+            if task_id and not isinstance(task_id, str):
+                task_id = str(task_id)
+            # tasks sharing a fetch come one after the other with the same
+            # object, which only needs hashing once
+            if response is not last_response or key is None:
+                key = codec.content_hash(response)
+                last_response = response
+                if key not in hash2body:
+                    hash2body[key] = self.codec.encode(response)
+                    hash2keys[key] = index_keys(response)
+            rows.append(
+                dict(task_id=task_id,
+                     response_hash=key,
+                     completed_at=completed_at))
+        if not rows:
+            return
 
+        insert = TaskId2Response.__table__.insert()
+        if only_new:
+            insert = self._insert_responses_once()
+            existing = set()
+            for chunk in chunks([row["task_id"] for row in rows],
+                                DEFAULT_BATCH_SIZE):
+                existing.update(task_id for task_id, in s.query(
+                    TaskId2Response.task_id).filter(
+                        TaskId2Response.task_id.in_(chunk)))
+            rows = [row for row in rows if row["task_id"] not in existing]
+        for chunk in chunks(rows, DEFAULT_BATCH_SIZE):
+            s.execute(insert.values(chunk))
+            s.execute(PendingTaskIds.__table__.delete().where(
+                PendingTaskIds.task_id.in_([row["task_id"] for row in chunk])))
+        refcounts = Counter(row["response_hash"] for row in rows)
+        if refcounts:
+            s.execute(_UPSERT_BLOB, [
+                dict(hash=key, body=hash2body[key], refcount=refcount)
+                for key, refcount in refcounts.items()
+            ])
+            keys = [
+                dict(field=field, value=value, hash=key) for key in refcounts
+                for field, value in hash2keys[key]
+            ]
+            if keys:
+                s.execute(_INSERT_KEYS, keys)
+
+    def _release_blobs(self, s, refcounts: ty.Dict[str, int]):
+        """Take refcounts off blobs, and delete the ones no task has"""
+        blobs = ResponseBlob.__table__
+        for key, refcount in refcounts.items():
+            s.execute(blobs.update().where(ResponseBlob.hash == key).values(
+                refcount=ResponseBlob.refcount - refcount))
+        for chunk in chunks(list(refcounts), DEFAULT_BATCH_SIZE):
+            s.execute(blobs.delete().where(
+                and_(ResponseBlob.hash.in_(chunk),
+                     ResponseBlob.refcount <= 0)))
+            s.execute(ResponseKey.__table__.delete().where(
+                and_(
+                    ResponseKey.hash.in_(chunk), ~sqlalchemy.exists().where(
+                        ResponseBlob.hash == ResponseKey.hash))))
+
+    def _insert_responses_once(self):
+        """Insert into taskid2response that skips tasks already there, in
+        case another worker inserted them since _insert_responses looked"""
+        table = TaskId2Response.__table__
+        if self.engine.dialect.name == "postgresql":
+            return postgresql.insert(table).on_conflict_do_nothing()
+        if self.engine.dialect.name == "sqlite":
+            return table.insert().prefix_with("OR IGNORE")
+        raise NotImplementedError(
+            f"claims are not supported on {self.engine.dialect.name}")
+
+    @_timed_query
+    def claim_due_tasks(
+        self,
+        worker_id: str,
+        limit: int = DEFAULT_PAGE_SIZE,
+        lease: float = DEFAULT_LEASE
+    ) -> ty.Tuple[str, ty.List[ty.Tuple[str, str, str]]]:
+        """Claim up to limit due tasks for worker_id, the earliest due first.
+
+        The tasks are hidden from other claims for `lease` seconds. Workers
+        should complete them with `complete_claimed_tasks` before that, or they
+        are handed to another worker, as if this one had died.
+
+        Tasks are claimed with one UPDATE, over a SELECT ... FOR UPDATE SKIP
+        LOCKED on postgres, so concurrent claims never wait for each other or
+        return the same task. Sqlite runs one write at a time, which gives the
+        same guarantee.
+
+        Returns: the claim id, and the claimed (task_id, dt_str, url)
+        """
+        claim_id = f"{worker_id}/{uuid4().hex}"
+        now = datetime.utcnow()
+        claimable = and_(
+            PendingTaskIds.due_at <= datetime.now(),
+            or_(PendingTaskIds.claimed_until.is_(None),
+                PendingTaskIds.claimed_until < now))
+        due = sqlalchemy.select([PendingTaskIds.task_id]).where(
+            claimable).order_by(PendingTaskIds.due_at).limit(limit)
+        if self.engine.dialect.name == "postgresql":
+            due = due.with_for_update(skip_locked=True)
+        table = PendingTaskIds.__table__
+        with self.session_scope() as s:
+            s.execute(table.update().where(
+                and_(PendingTaskIds.task_id.in_(due), claimable)).values(
+                    claimed_by=claim_id,
+                    claimed_until=now + timedelta(seconds=lease)))
+            rows = s.query(PendingTaskIds.task_id, PendingTaskIds.dt_str,
+                           PendingTaskIds.url).filter(
+                               PendingTaskIds.claimed_by == claim_id).all()
+        return claim_id, [tuple(row) for row in rows]
+
+    @_timed_query
+    def complete_claimed_tasks(self,
+                               items: ty.Iterable[ty.Tuple[str, ty.Any]]):
+        """add_responses_bulk for claimed tasks.
+
+        A task whose lease ran out may be run by a second worker. Only the
+        first response written for a task is kept, so the task still
+        completes exactly once.
+        """
+        items = list(items)
+        with self.session_scope() as s:
+            self._insert_responses(s, items, only_new=True)
+        self._notify_completed([task_id for task_id, _ in items])
+
+    @_timed_query
+    def release_claimed_tasks(self,
+                              claim_id: str,
+                              task_ids: ty.Iterable[str],
+                              delay: float = 0,
+                              max_attempts: int = None) -> ty.List[str]:
+        """Give up claimed tasks after a failed run, so they can be claimed
+        again in `delay` seconds.
+
+        Each release counts as an attempt. Tasks that have had max_attempts
+        are failed: they are kept as pending, with their attempts, but their
+        due_at is cleared so they are never claimed or due again.
+
+        Returns: ids of the tasks that failed
+        """
+        task_ids = list(task_ids)
+        if not task_ids:
+            return []
+        claimed_until = datetime.utcnow() + timedelta(seconds=delay)
+        table = PendingTaskIds.__table__
+        failed = []
+        with self.session_scope() as s:
+            for chunk in chunks(task_ids, DEFAULT_BATCH_SIZE):
+                released = and_(PendingTaskIds.task_id.in_(chunk),
+                                PendingTaskIds.claimed_by == claim_id)
+                if max_attempts is not None:
+                    out_of_attempts = and_(
+                        released,
+                        PendingTaskIds.attempts + 1 >= max_attempts)
+                    failed.extend(
+                        row[0] for row in s.execute(
+                            sqlalchemy.select([PendingTaskIds.task_id
+                                               ]).where(out_of_attempts)))
+                    s.execute(table.update().where(out_of_attempts).values(
+                        due_at=None))
+                s.execute(table.update().where(released).values(
+                    claimed_by=None,
+                    claimed_until=claimed_until,
+                    attempts=PendingTaskIds.attempts + 1))
+        return failed
+
+    @_timed_query
+    def add_pending_tasks_bulk(self,
+                               items: ty.Iterable[ty.Tuple[str, str, str]]):
+        rows = [
+            dict(task_id=task_id,
+                 dt_str=dt_str,
+                 due_at=parse_dt_str(dt_str),
+                 url=url) for task_id, dt_str, url in items
+        ]
+        if not rows:
+            return
+        with self.session_scope() as s:
+            for chunk in chunks(rows, DEFAULT_BATCH_SIZE):
+                s.execute(PendingTaskIds.__table__.insert().values(chunk))
+
+    @_timed_query
+    def complete_tasks_bulk(self, task_ids: ty.Iterable[str]):
+        task_ids = list(task_ids)
+        if not task_ids:
+            return
+        with self.session_scope() as s:
+            for chunk in chunks(task_ids, DEFAULT_BATCH_SIZE):
+                s.execute(PendingTaskIds.__table__.delete().where(
+                    PendingTaskIds.task_id.in_(chunk)))
+
+
+    @_timed_query
     def remove_pending_task_id(self, task_id):
-        tlog.info(f"Removing pending task_id {task_id}")
+        tlog.debug("removing pending task", task_id=task_id)
         with self.session_scope() as s:
             try:
                 to_del = s.query(PendingTaskIds).filter(
@@ -208,38 +1482,48 @@ class SQLStore(AbstractMemoryStore):
             except Exception as e:
                 tlog.error(f"could not delete {to_del.task_id}", err=e)
 
+    @_timed_query
     def add_pending_task_id(self, task_id, dt_str: str, url: str):
         with self.session_scope() as s:
             try:
-                s.add(PendingTaskIds(task_id=task_id, dt_str=dt_str, url=url))
+                s.add(
+                    PendingTaskIds(task_id=task_id,
+                                   dt_str=dt_str,
+                                   due_at=parse_dt_str(dt_str),
+                                   url=url))
             except Exception as e:
                 err_msg = (f"could not add task_id = {task_id} "
                            f"dt_str={dt_str} url = {url}")
                 tlog.error(err_msg, err=e)
 
 
+    @_timed_query
     def is_pending_task_id(self, task_id):
-        with self.session_scope() as s:
-            try:
-                to_find = s.query(PendingTaskIds).filter(
-                    PendingTaskIds.task_id == task_id).first()
-            except sqlalchemy.orm.exc.NoResultFound as e:
-                return False
-            return to_find is not None
+        return self._execute_one(_PENDING_BY_TASK_ID,
+                                 task_id=task_id) is not None
+
 
+    def _query_responses(self, s, *columns):
+        """Query of (task_id, response, *columns) for finished tasks, with
+        responses read from their blobs"""
+        return s.query(TaskId2Response.task_id, _RESPONSE,
+                       *columns).outerjoin(
+                           ResponseBlob,
+                           ResponseBlob.hash == TaskId2Response.response_hash)
 
+    @_timed_query
     def get_task_id_response(self, task_id: str):
-        with self.session_scope() as s:
-            try:
-                res = s.query(TaskId2Response.response).filter(
-                    TaskId2Response.task_id == task_id).one_or_none()
-            except sqlalchemy.orm.exc.NoResultFound as e:
-                tlog.error(f"task_id {task_id} is not in TaskId2Response table", err = e)
-                raise e
-            if res:
-                return ast.literal_eval(res.response)
+        row = self._execute_one(_RESPONSE_BY_TASK_ID, task_id=task_id)
+        if row is not None:
+            return codec.decode(row.response)
+
 
+    @_timed_query
+    def count_pending_tasks(self) -> int:
+        count, = self._execute_one(_COUNT_PENDING)
+        return count
 
+    @_timed_query
     def get_all_pending_tasks(self) -> list:
         with self.session_scope() as s:
             try:
@@ -251,7 +1535,45 @@ class SQLStore(AbstractMemoryStore):
                 raise e
             if res:
                 return [task_id for task_id, in res]
+            return []
+
+    def iter_pending_tasks(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ty.Iterator[ty.List[ty.Tuple[str, str, str]]]:
+        # keyset pagination on the primary key, so every batch is a cheap
+        # index range scan and no session stays open between batches
+        last_task_id = None
+        while True:
+            with self.session_scope() as s:
+                query = s.query(PendingTaskIds.task_id, PendingTaskIds.dt_str,
+                                PendingTaskIds.url)
+                if last_task_id is not None:
+                    query = query.filter(PendingTaskIds.task_id > last_task_id)
+                batch = query.order_by(
+                    PendingTaskIds.task_id).limit(batch_size).all()
+            if not batch:
+                return
+            yield [tuple(row) for row in batch]
+            last_task_id = batch[-1][0]
+
+    @_timed_query
+    def get_due_tasks(
+            self,
+            until: datetime = None,
+            limit: int = DEFAULT_PAGE_SIZE
+    ) -> ty.List[ty.Tuple[str, str, str]]:
+        # a range scan on the due_at index
+        with self.session_scope() as s:
+            rows = s.query(
+                PendingTaskIds.task_id, PendingTaskIds.dt_str,
+                PendingTaskIds.url).filter(
+                    PendingTaskIds.due_at <= (until or datetime.now())
+                ).order_by(PendingTaskIds.due_at,
+                           PendingTaskIds.task_id).limit(limit).all()
+        return [tuple(row) for row in rows]
 
+    @_timed_query
     def remove_finished_task(self, task_id):
         tlog.info(f"Removing finished task_id {task_id}")
         with self.session_scope() as s:
@@ -264,20 +1586,108 @@ class SQLStore(AbstractMemoryStore):
                 )
             if not to_del:
                 return
+            response_hash = to_del.response_hash
             try:
                 s.delete(to_del)
             except Exception as e:
                 tlog.error(f"could not delete {to_del.task_id}", err=e)
+                return
+            if response_hash is not None:
+                s.flush()
+                self._release_blobs(s, {response_hash: 1})
 
+    @_timed_query
     def get_all_finished_tasks(self) -> dict:
         with self.session_scope() as s:
             try:
-                res = s.query(TaskId2Response).all()
+                res = self._query_responses(s).all()
             except Exception as e:
                 tlog.error("Could not find TaskId2Response", err=e)
                 raise e
             if res:
                 return {
-                    row.task_id: ast.literal_eval(row.response)
+                    row.task_id: codec.decode(row.response)
                     for row in res
                 }
+
+    @_timed_query
+    def get_finished_tasks_page(
+        self,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: str = None
+    ) -> ty.Tuple[ty.Dict[str, ty.Any], ty.Optional[str]]:
+        if limit < 1:
+            raise ValueError(f"limit must be at least 1, got {limit}")
+        with self.session_scope() as s:
+            return self._completed_page(
+                self._query_responses(s, TaskId2Response.completed_at), limit,
+                cursor)
+
+    def _completed_page(
+        self, query, limit: int, cursor: ty.Optional[str]
+    ) -> ty.Tuple[ty.Dict[str, ty.Any], ty.Optional[str]]:
+        """A page of query's (task_id, response, completed_at) rows, keyset
+        paginated on (completed_at, task_id) using its index"""
+        if cursor is not None:
+            completed_at, task_id = decode_cursor(cursor)
+            try:
+                completed_at = datetime.fromisoformat(completed_at)
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"Invalid cursor {cursor}") from e
+            query = query.filter(
+                or_(
+                    TaskId2Response.completed_at > completed_at,
+                    and_(TaskId2Response.completed_at == completed_at,
+                         TaskId2Response.task_id > task_id)))
+        rows = query.order_by(TaskId2Response.completed_at,
+                              TaskId2Response.task_id).limit(limit + 1).all()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = encode_cursor(last.completed_at.isoformat(),
+                                        last.task_id)
+        return {row.task_id: codec.decode(row.response) for row in rows}, \
+            next_cursor
+
+    @_timed_query
+    def find_finished_tasks(
+        self,
+        filters: ty.Dict[str, str],
+        since: datetime = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: str = None
+    ) -> ty.Tuple[ty.Dict[str, ty.Any], ty.Optional[str]]:
+        """Filters are lookups on the response_keys primary key, joined on
+        the response_hash index. Responses written inline, before blobs, are
+        not indexed"""
+        if limit < 1:
+            raise ValueError(f"limit must be at least 1, got {limit}")
+        with self.session_scope() as s:
+            query = self._query_responses(s, TaskId2Response.completed_at)
+            for field, value in filters.items():
+                query = query.filter(
+                    TaskId2Response.response_hash.in_(
+                        s.query(ResponseKey.hash).filter(
+                            ResponseKey.field == field,
+                            ResponseKey.value == value)))
+            if since is not None:
+                # since is local time, completed_at utc
+                since_utc = since.astimezone(timezone.utc).replace(tzinfo=None)
+                query = query.filter(TaskId2Response.completed_at >= since_utc)
+            return self._completed_page(query, limit, cursor)
+
+    def iter_finished_tasks(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ty.Iterator[ty.Tuple[str, ty.Any]]:
+        # stream_results makes postgres use a server side cursor, so only
+        # batch_size rows are held in memory at once
+        with self.session_scope() as s:
+            query = self._query_responses(s).order_by(
+                TaskId2Response.completed_at,
+                TaskId2Response.task_id).execution_options(
+                    stream_results=True).yield_per(batch_size)
+            for task_id, response in query:
+                yield task_id, codec.decode(response)
@@ -0,0 +1,90 @@
+"""Throughput of the in memory stores written and read by many threads at
+once, as the scheduler's workers and the app's request threads do.
+
+    python store_bench.py --workers 1 2 4 8 16 --tasks 5000
+
+Each worker thread adds its tasks as pending, completes them with a tfl
+shaped response, reads each response back, and reads a page of finished
+tasks every --page-every tasks. For every number of workers this prints the
+store operations per second of ConcurrentInMemoryStore with one shard, i.e.
+one lock for every task, and with --shards shards.
+
+Only one thread runs python at a time under CPython's GIL, so neither scales
+much with workers. The shards keep threads from queueing on one lock held by
+a thread that was switched out, and keep listings from blocking every write.
+"""
+import argparse
+import threading
+import time
+import typing as ty
+
+import tlog
+from store import DEFAULT_SHARDS, AbstractMemoryStore, ConcurrentInMemoryStore
+from tfl_stub import make_disruption
+
+DT_STR = "2021-11-14T13:00:00"
+URL = "https://api.tfl.gov.uk/Line/central/Disruption"
+
+
+def work(store: AbstractMemoryStore, worker: int, tasks: int,
+         page_every: int, start: threading.Barrier):
+    start.wait()
+    for i in range(tasks):
+        task_id = f"worker-{worker}-{i}"
+        store.add_pending_task_id(task_id, DT_STR, URL)
+        # a new response each time, as from a fetch
+        store.add_response(task_id, [make_disruption("central", i % 10)])
+        store.get_task_id_response(task_id)
+        if i % page_every == 0:
+            store.get_finished_tasks_page(limit=10)
+
+
+def bench(store: AbstractMemoryStore, workers: int, tasks: int,
+          page_every: int) -> float:
+    """Store operations per second"""
+    start = threading.Barrier(workers + 1)
+    threads = [
+        threading.Thread(target=work,
+                         args=(store, worker, tasks, page_every, start))
+        for worker in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    began = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - began
+    ops_per_task = 3 + 1 / page_every
+    return workers * tasks * ops_per_task / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=[1, 2, 4, 8, 16])
+    parser.add_argument("--tasks", type=int, default=5000,
+                        help="tasks per worker")
+    parser.add_argument("--shards", type=int, default=DEFAULT_SHARDS)
+    parser.add_argument("--page-every", type=int, default=100)
+    args = parser.parse_args()
+    tlog.configure("error")
+
+    stores: ty.Dict[str, ty.Callable[[], AbstractMemoryStore]] = {
+        "1 shard": lambda: ConcurrentInMemoryStore(shards=1),
+        f"{args.shards} shards": lambda: ConcurrentInMemoryStore(
+            shards=args.shards),
+    }
+    print(f"{'workers':>7} " + " ".join(f"{name + ' ops/s':>18}"
+                                        for name in stores))
+    for workers in args.workers:
+        ops = [
+            bench(make_store(), workers, args.tasks, args.page_every)
+            for make_store in stores.values()
+        ]
+        print(f"{workers:>7} " + " ".join(f"{o:>18.0f}" for o in ops))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,18 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
 import unittest
 import subprocess
 import tlog
 
-from store import SQLStore
+import codec
+from metrics import get_metrics
+from store import (EVICT_AGE, ConcurrentInMemoryStore, InMemoryStore,
+                   ResponseBlob, ResponseKey, SQLStore, TaskId2Response)
+from tfl_stub import make_disruption
 import sql_config as config
 
 
@@ -88,6 +98,18 @@ class SQLTest(unittest.TestCase):
             self.store.remove_finished_task(task_id=task_id)
 
 
+    def test_add_responses_bulk(self):
+        pending_tasks = [(f'bulk_{i}', '2021-11-14T13:43:15', 'url')
+                         for i in range(3)]
+        self.store.add_pending_tasks_bulk(pending_tasks)
+        self.store.add_responses_bulk([(task_id, [task_id])
+                                       for task_id, _, _ in pending_tasks])
+        for task_id, _, _ in pending_tasks:
+            self.assertFalse(self.store.is_pending_task_id(task_id))
+            self.assertEqual(self.store.get_task_id_response(task_id),
+                             [task_id])
+            self.store.remove_finished_task(task_id=task_id)
+
     @classmethod
     def stop_containers(cls):
         # shut down any running containers
@@ -126,5 +148,510 @@ class SQLTest(unittest.TestCase):
         cls.stop_containers()
 
 
+class InMemoryStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = InMemoryStore()
+
+    def test_get_finished_tasks_page(self):
+        for i in range(5):
+            self.store.add_response(f'task_{i}', [i])
+        # completing a task again moves it to the end
+        self.store.add_response('task_1', ['again'])
+
+        pages = []
+        cursor = None
+        while True:
+            page, cursor = self.store.get_finished_tasks_page(limit=2,
+                                                              cursor=cursor)
+            pages.append(list(page))
+            if cursor is None:
+                break
+        self.assertEqual(pages, [['task_0', 'task_2'], ['task_3', 'task_4'],
+                                 ['task_1']])
+
+    def test_bad_cursor(self):
+        with self.assertRaises(ValueError):
+            self.store.get_finished_tasks_page(cursor='not a cursor')
+
+    def test_iter_finished_tasks(self):
+        for i in range(3):
+            self.store.add_response(f'task_{i}', [i])
+        self.assertEqual(list(self.store.iter_finished_tasks()),
+                         [('task_0', [0]), ('task_1', [1]), ('task_2', [2])])
+
+    def test_max_entries_evicts_least_recently_used(self):
+        store = InMemoryStore(max_entries=2)
+        store.add_response('a', [1])
+        store.add_response('b', [2])
+        store.get_task_id_response('a')
+        store.add_response('c', [3])
+        self.assertEqual(list(store.get_all_finished_tasks()), ['a', 'c'])
+        self.assertEqual(store.stats()['evictions'], 1)
+
+    def test_max_entries_evicts_oldest(self):
+        store = InMemoryStore(max_entries=2, eviction_policy=EVICT_AGE)
+        store.add_response('a', [1])
+        store.add_response('b', [2])
+        store.get_task_id_response('a')
+        store.add_response('c', [3])
+        self.assertEqual(list(store.get_all_finished_tasks()), ['b', 'c'])
+
+    def test_max_bytes(self):
+        store = InMemoryStore(max_bytes=100)
+        for i in range(10):
+            store.add_response(f'task_{i}', [f'{i}' + 'x' * 19])
+        self.assertLessEqual(store.stats()['bytes'], 100)
+        self.assertEqual(store.stats()['entries'], 4)
+        self.assertIn('task_9', store.get_all_finished_tasks())
+
+    def test_equal_responses_are_kept_once(self):
+        store = InMemoryStore(max_bytes=100)
+        for i in range(10):
+            # equal, but not the same object
+            store.add_response(f'task_{i}', [{'description': 'x' * 20}])
+        store.add_response('other', ['other'])
+        stats = store.stats()
+        self.assertEqual(stats['entries'], 11)
+        self.assertEqual(stats['unique_responses'], 2)
+        self.assertLessEqual(stats['bytes'], 100)
+        self.assertIs(store.get_task_id_response('task_0'),
+                      store.get_task_id_response('task_9'))
+
+        # the shared response goes once no task has it
+        for i in range(10):
+            store.add_response(f'task_{i}', ['other'])
+        self.assertEqual(store.stats()['unique_responses'], 1)
+
+    def test_ttl(self):
+        store = InMemoryStore(ttl=0.05)
+        store.add_response('old', [1])
+        time.sleep(0.1)
+        store.add_response('new', [2])
+        with self.assertRaises(ValueError):
+            store.get_task_id_response('old')
+        self.assertEqual(store.get_task_id_response('new'), [2])
+        self.assertEqual(store.stats()['expirations'], 1)
+        page, _ = store.get_finished_tasks_page()
+        self.assertEqual(list(page), ['new'])
+
+    def test_iter_finished_tasks_while_compacted(self):
+        store = InMemoryStore(ttl=0.3)
+        for i in range(2000):
+            store.add_response(f'old_{i}', [i])
+        time.sleep(0.2)
+        for i in range(3):
+            store.add_response(f'new_{i}', [i])
+        time.sleep(0.2)
+        finished = store.iter_finished_tasks()
+        # expires the old tasks
+        self.assertEqual(next(finished), ('new_0', [0]))
+        # compacts them out of the completion order
+        store.add_response('newest', [3])
+        self.assertEqual(list(finished), [('new_1', [1]), ('new_2', [2]),
+                                          ('newest', [3])])
+
+    def test_completion_order_is_bounded_without_ttl(self):
+        store = InMemoryStore(max_entries=10)
+        for i in range(5000):
+            store.add_response(f'task_{i}', [i])
+        for i in range(5000):
+            store.add_response('again', [i])
+        self.assertLess(len(store._completion_order), 2 * 10 + 1024 + 2)
+        page, _ = store.get_finished_tasks_page()
+        self.assertEqual(len(page), 10)
+        self.assertEqual(list(page)[-1], 'again')
+
+    def test_spill_is_bounded(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            store = InMemoryStore(max_entries=1,
+                                  spill_dir=spill_dir,
+                                  max_spilled=3)
+            for i in range(10):
+                store.add_response(f'task_{i}', [i])
+            self.assertEqual(len(os.listdir(spill_dir)), 3)
+            self.assertEqual(store.get_task_id_response('task_6'), [6])
+            self.assertRaises(ValueError, store.get_task_id_response,
+                              'task_5')
+
+    def test_spill_to_disk(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            store = InMemoryStore(max_entries=1, spill_dir=spill_dir)
+            store.add_response('a', [{'a': 1}])
+            store.add_response('b', [{'b': 2}])
+            self.assertNotIn('a', store.get_all_finished_tasks())
+            self.assertEqual(store.get_task_id_response('a'), [{'a': 1}])
+            self.assertEqual(store.stats()['spilled'], 1)
+
+    def test_spilled_tasks_expire_and_are_replaced(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            store = InMemoryStore(max_entries=1, ttl=0.2, spill_dir=spill_dir)
+            store.add_response('x', ['old'])
+            store.add_response('y', ['y'])
+            # completing x again spills y, and deletes x's spilled response
+            store.add_response('x', ['new'])
+            self.assertEqual(len(os.listdir(spill_dir)), 1)
+            self.assertEqual(store.get_task_id_response('y'), ['y'])
+            time.sleep(0.3)
+            self.assertRaises(ValueError, store.get_task_id_response, 'x')
+            self.assertRaises(ValueError, store.get_task_id_response, 'y')
+            self.assertEqual(os.listdir(spill_dir), [])
+            self.assertEqual(store.stats()['expirations'], 2)
+
+    def test_find_finished_tasks(self):
+        store = InMemoryStore(max_entries=3)
+        store.add_response('closed', [make_disruption('central', 0)])
+        store.add_response('delays', [make_disruption('central', 1)])
+        store.add_response('other', [make_disruption('victoria', 0)])
+        page, _ = store.find_finished_tasks({'line': 'central'})
+        self.assertEqual(list(page), ['closed', 'delays'])
+        page, _ = store.find_finished_tasks({
+            'line': 'central',
+            'closureText': 'serviceClosed'
+        })
+        self.assertEqual(list(page), ['closed'])
+
+        # keys go with the response they came from, or its eviction
+        store.add_response('closed', [make_disruption('victoria', 1)])
+        store.add_response('new', [make_disruption('victoria', 0)])
+        page, cursor = store.find_finished_tasks({'line': 'victoria'},
+                                                 limit=2)
+        self.assertEqual(list(page), ['other', 'closed'])
+        page, cursor = store.find_finished_tasks({'line': 'victoria'},
+                                                 cursor=cursor)
+        self.assertEqual((list(page), cursor), (['new'], None))
+        page, _ = store.find_finished_tasks({'line': 'central'})
+        self.assertEqual(list(page), [])
+
+        page, _ = store.find_finished_tasks(
+            {}, since=datetime.now() + timedelta(minutes=1))
+        self.assertEqual(page, {})
+        page, _ = store.find_finished_tasks(
+            {'closureText': 'serviceClosed'},
+            since=datetime.now() - timedelta(minutes=1))
+        self.assertEqual(list(page), ['other', 'new'])
+
+    def test_find_finished_tasks_pages_after_recompletions(self):
+        store = InMemoryStore()
+        for i in range(300):
+            store.add_response(f'task_{i}', [make_disruption('central', i)])
+        # stale index entries, and compaction of them
+        for _ in range(3):
+            for i in range(0, 300, 2):
+                store.add_response(f'task_{i}',
+                                   [make_disruption('central', i)])
+        for i in range(0, 300, 3):
+            store.add_response(f'task_{i}', [make_disruption('victoria', i)])
+        expected = [
+            task_id for task_id, response in store.iter_finished_tasks()
+            if response[0]['category'] == 'RealTime'
+            and 'central' in response[0]['description'].lower()
+        ]
+        task_ids = []
+        cursor = None
+        while True:
+            page, cursor = store.find_finished_tasks(
+                {'line': 'central', 'category': 'RealTime'},
+                limit=7,
+                cursor=cursor)
+            task_ids.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(task_ids, expected)
+        self.assertTrue(expected)
+
+    def test_get_due_tasks(self):
+        url = 'url'
+        self.store.add_pending_task_id('c', '2021-11-14T13:00:03', url)
+        self.store.add_pending_task_id('a', '2021-11-14T13:00:01', url)
+        self.store.add_pending_task_id('later', '2021-11-15T00:00:00', url)
+        self.store.add_pending_task_id('b', '2021-11-14T12:00:00', url)
+        # added again, due later
+        self.store.add_pending_task_id('b', '2021-11-14T13:00:02', url)
+        self.store.add_pending_task_id('done', '2021-11-14T11:00:00', url)
+        self.store.add_response('done', ['response'])
+
+        until = datetime(2021, 11, 14, 14)
+        for _ in range(2):  # reading does not consume the queue
+            self.assertEqual(
+                self.store.get_due_tasks(until=until),
+                [('a', '2021-11-14T13:00:01', url),
+                 ('b', '2021-11-14T13:00:02', url),
+                 ('c', '2021-11-14T13:00:03', url)])
+        self.assertEqual(
+            [task[0] for task in self.store.get_due_tasks(until=until,
+                                                          limit=1)], ['a'])
+        self.assertEqual(len(self.store.get_due_tasks()), 4)
+
+
+class ConcurrentInMemoryStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ConcurrentInMemoryStore(shards=4)
+
+    def test_get_finished_tasks_page(self):
+        for i in range(10):
+            self.store.add_response(f'task_{i}', [i])
+        # completing a task again moves it to the end
+        self.store.add_response('task_1', ['again'])
+
+        task_ids = []
+        cursor = None
+        while True:
+            page, cursor = self.store.get_finished_tasks_page(limit=3,
+                                                              cursor=cursor)
+            self.assertLessEqual(len(page), 3)
+            task_ids.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(task_ids, [f'task_{i}' for i in range(10)
+                                    if i != 1] + ['task_1'])
+        self.assertEqual(list(self.store.get_all_finished_tasks()), task_ids)
+        self.assertEqual(
+            [task_id for task_id, _ in self.store.iter_finished_tasks(2)],
+            task_ids)
+
+    def test_bulk(self):
+        completed = []
+        self.store.add_completion_listener(completed.extend)
+        self.store.add_pending_tasks_bulk([(f'task_{i}', '2021-11-14T13:00:00',
+                                            'url') for i in range(10)])
+        self.store.add_responses_bulk([(f'task_{i}', [i]) for i in range(5)])
+        self.store.complete_tasks_bulk(['task_5', 'task_6'])
+        self.assertEqual(completed, [f'task_{i}' for i in range(5)])
+        self.assertCountEqual(self.store.get_all_pending_tasks(),
+                              ['task_7', 'task_8', 'task_9'])
+        self.assertEqual(self.store.count_pending_tasks(), 3)
+        self.assertEqual(self.store.get_task_id_response('task_4'), [4])
+        with self.assertRaises(ValueError):
+            self.store.get_task_id_response('task_5')
+
+    def test_get_due_tasks(self):
+        for i in range(10):
+            self.store.add_pending_task_id(f'task_{i}',
+                                           f'2021-11-14T13:00:0{9 - i}', 'url')
+        self.assertEqual(
+            [task[0] for task in self.store.get_due_tasks(
+                until=datetime(2021, 11, 14, 13, 0, 5), limit=3)],
+            ['task_9', 'task_8', 'task_7'])
+
+    def test_find_finished_tasks(self):
+        for i in range(10):
+            self.store.add_response(f'task_{i}',
+                                    [make_disruption('central', i % 2)])
+        task_ids = []
+        cursor = None
+        while True:
+            page, cursor = self.store.find_finished_tasks(
+                {'category': 'PlannedWork'}, limit=2, cursor=cursor)
+            task_ids.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(task_ids, [f'task_{i}' for i in range(1, 10, 2)])
+        page, _ = self.store.find_finished_tasks(
+            {'line': 'central'}, since=datetime.now() + timedelta(minutes=1))
+        self.assertEqual(page, {})
+
+    def test_listings_are_copies(self):
+        self.store.add_response('a', [1])
+        finished = self.store.get_all_finished_tasks()
+        self.store.add_response('b', [2])
+        self.assertEqual(finished, {'a': [1]})
+
+    def test_retention_is_split_over_shards(self):
+        store = ConcurrentInMemoryStore(shards=4, max_entries=8)
+        for i in range(100):
+            store.add_response(f'task_{i}', [i])
+        stats = store.stats()
+        self.assertLessEqual(stats['entries'], 8)
+        self.assertEqual(stats['entries'] + stats['evictions'], 100)
+        self.assertEqual(stats['shards'], 4)
+
+    def test_threads(self):
+        errors = []
+
+        def work(worker):
+            try:
+                for i in range(500):
+                    task_id = f'task_{worker}_{i}'
+                    self.store.add_pending_task_id(task_id,
+                                                   '2021-11-14T13:00:00', 'url')
+                    self.store.add_response(task_id, [i])
+                    self.store.get_task_id_response(task_id)
+                    self.store.get_finished_tasks_page(limit=10)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(worker, ))
+                   for worker in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.store.count_pending_tasks(), 0)
+        self.assertEqual(len(self.store.get_all_finished_tasks()), 4000)
+
+
+class SQLiteTest(unittest.TestCase):
+    """Runs the parts of SQLStore that are not postgres specific against an
+    in-memory sqlite database, so they can be tested without docker"""
+
+    def setUp(self):
+        self.store = SQLStore(database_url="sqlite://")
+        self.dt_str = '2021-11-14T13:43:15'
+        self.url = "https://api.tfl.gov.uk/Line/bakerloo,jubilee/Disruption"
+
+    def test_add_pending_tasks_bulk(self):
+        pending_tasks = [(f'task_{i}', self.dt_str, self.url)
+                         for i in range(2500)]
+        self.store.add_pending_tasks_bulk(pending_tasks)
+        self.assertCountEqual(self.store.get_all_pending_tasks(),
+                              [task_id for task_id, _, _ in pending_tasks])
+        self.assertEqual(self.store.count_pending_tasks(), 2500)
+        batches = list(self.store.iter_pending_tasks(batch_size=1000))
+        self.assertEqual([len(batch) for batch in batches], [1000, 1000, 500])
+
+    def test_add_responses_bulk(self):
+        self.store.add_pending_tasks_bulk([('a', self.dt_str, self.url),
+                                           ('b', self.dt_str, self.url),
+                                           ('c', self.dt_str, self.url)])
+        self.store.add_responses_bulk([('a', ['response a']),
+                                       ('b', ['response b'])])
+        self.assertEqual(self.store.get_task_id_response('a'),
+                         ['response a'])
+        self.assertEqual(self.store.get_all_pending_tasks(), ['c'])
+
+    def test_responses_can_be_read_with_any_codec(self):
+        for codec_name in ['json', 'json+zlib', 'msgpack']:
+            self.store.codec = codec.get_codec(codec_name)
+            self.store.add_response(codec_name, [{'codec': codec_name}])
+        self.assertDictEqual(
+            self.store.get_all_finished_tasks(), {
+                codec_name: [{'codec': codec_name}]
+                for codec_name in ['json', 'json+zlib', 'msgpack']
+            })
+
+    def test_get_finished_tasks_page(self):
+        self.store.add_responses_bulk([(f'task_{i}', [i]) for i in range(5)])
+        task_ids = []
+        cursor = None
+        while True:
+            page, cursor = self.store.get_finished_tasks_page(limit=2,
+                                                              cursor=cursor)
+            self.assertLessEqual(len(page), 2)
+            task_ids.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(task_ids, [f'task_{i}' for i in range(5)])
+
+    def test_iter_finished_tasks(self):
+        self.store.add_responses_bulk([(f'task_{i}', [i]) for i in range(5)])
+        self.assertEqual(list(self.store.iter_finished_tasks(batch_size=2)),
+                         [(f'task_{i}', [i]) for i in range(5)])
+
+    def test_get_due_tasks(self):
+        self.store.add_pending_tasks_bulk([
+            ('c', '2021-11-14T13:00:03', self.url),
+            ('a', '2021-11-14T13:00:01', self.url),
+            ('later', '2021-11-15T00:00:00', self.url),
+            ('unparsable', 'garbage', self.url),
+        ])
+        self.store.add_pending_task_id('b', '2021-11-14T13:00:02', self.url)
+        due = self.store.get_due_tasks(until=datetime(2021, 11, 14, 14))
+        self.assertEqual([task[0] for task in due], ['a', 'b', 'c'])
+        self.assertEqual(due[0], ('a', '2021-11-14T13:00:01', self.url))
+        self.assertEqual(
+            len(self.store.get_due_tasks(until=datetime(2021, 11, 14, 14),
+                                         limit=2)), 2)
+
+    def test_equal_responses_are_stored_once(self):
+        response = [make_disruption('bakerloo', i, stops=5) for i in range(3)]
+        # a line polled every minute, getting the same disruptions back
+        for poll in range(10):
+            self.store.add_responses_bulk([
+                (f'poll_{poll}_{i}', json.loads(json.dumps(response)))
+                for i in range(100)
+            ])
+        self.store.add_response('other', ['other'])
+        with self.store.session_scope() as s:
+            blobs = s.query(ResponseBlob.hash, ResponseBlob.refcount).all()
+            inline = s.query(TaskId2Response).filter(
+                TaskId2Response.response.isnot(None)).count()
+        self.assertEqual(sorted(refcount for _, refcount in blobs), [1, 1000])
+        self.assertEqual(inline, 0)
+        self.assertEqual(self.store.get_task_id_response('poll_9_99'),
+                         response)
+        self.assertEqual(len(self.store.get_all_finished_tasks()), 1001)
+
+        for poll in range(10):
+            for i in range(100):
+                self.store.remove_finished_task(f'poll_{poll}_{i}')
+        with self.store.session_scope() as s:
+            self.assertEqual(s.query(ResponseBlob).count(), 1)
+
+    def test_legacy_rows_are_read(self):
+        with self.store.session_scope() as s:
+            s.add(
+                TaskId2Response(task_id='legacy',
+                                response=str(['legacy']).encode()))
+        self.assertEqual(self.store.get_task_id_response('legacy'),
+                         ['legacy'])
+        self.store.remove_finished_task('legacy')
+        self.assertIsNone(self.store.get_task_id_response('legacy'))
+
+    def test_find_finished_tasks(self):
+        self.store.add_responses_bulk([
+            ('closed', [make_disruption('central', 0)]),
+            ('delays', [make_disruption('central', 1)]),
+            ('also_closed', [make_disruption('central', 0)]),
+        ])
+        page, _ = self.store.find_finished_tasks({
+            'line': 'central',
+            'closureText': 'serviceClosed'
+        })
+        self.assertCountEqual(page, ['closed', 'also_closed'])
+        page, cursor = self.store.find_finished_tasks({'line': 'central'},
+                                                      limit=2)
+        self.assertEqual(len(page), 2)
+        page, cursor = self.store.find_finished_tasks({'line': 'central'},
+                                                      cursor=cursor)
+        self.assertEqual((len(page), cursor), (1, None))
+        page, _ = self.store.find_finished_tasks(
+            {'line': 'central'}, since=datetime.now() + timedelta(minutes=1))
+        self.assertEqual(page, {})
+
+        # the keys of a blob go with it
+        self.store.remove_finished_task('delays')
+        with self.store.session_scope() as s:
+            self.assertEqual(
+                s.query(ResponseKey).filter(
+                    ResponseKey.value == 'PlannedWork').count(), 0)
+
+    def test_complete_tasks_bulk(self):
+        self.store.add_pending_tasks_bulk([('a', self.dt_str, self.url),
+                                           ('b', self.dt_str, self.url)])
+        self.store.complete_tasks_bulk(['a', 'b', 'not pending'])
+        self.assertEqual(self.store.get_all_pending_tasks(), [])
+
+    def test_metrics(self):
+        metrics = get_metrics()
+        lookups = metrics.histogram("store_query_seconds",
+                                    method="get_task_id_response")
+        commits = metrics.counter("store_transactions_total",
+                                  outcome="commit")
+        checkouts = metrics.histogram("store_pool_checkout_seconds")
+        lookups_before, commits_before, checkouts_before = (
+            lookups.count, commits.value, checkouts.count)
+
+        self.store.add_responses_bulk([('a', ['response a'])])
+        self.assertEqual(self.store.get_task_id_response('a'), ['response a'])
+        self.assertFalse(self.store.is_pending_task_id('a'))
+        self.assertEqual(lookups.count, lookups_before + 1)
+        self.assertEqual(commits.value, commits_before + 1)
+        self.assertEqual(checkouts.count, checkouts_before + 3)
+        self.assertIn("status", self.store.stats())
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
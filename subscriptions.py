@@ -0,0 +1,158 @@
+import threading
+import time
+import typing as ty
+from collections import deque
+from uuid import uuid4
+
+from apscheduler.schedulers.base import BaseScheduler
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+import tlog
+from url_helper import url_from_lines
+
+DEFAULT_WINDOW = 10  # results kept per subscription
+MAX_WINDOW = 1000
+DEFAULT_MIN_INTERVAL = 10  # seconds, so subscriptions cannot hammer tfl
+
+
+class Subscription(ty.NamedTuple):
+    id: str
+    lines: ty.List[str]
+    interval: ty.Optional[float]  # seconds
+    cron: ty.Optional[str]  # crontab expression
+    window: int
+
+    @property
+    def feed_key(self) -> ty.Tuple[str, ty.Optional[float], ty.Optional[str]]:
+        return url_from_lines(self.lines), self.interval, self.cron
+
+
+class Feed:
+    """One periodic fetch, shared by the subscriptions to the same lines on
+    the same schedule"""
+
+    def __init__(self, url: str, job_id: str):
+        self.url = url
+        self.job_id = job_id
+        self.subscription_ids: ty.Set[str] = set()
+
+
+class SubscriptionManager:
+    """Recurring fetches of a set of lines, on an interval or cron schedule.
+
+    Subscriptions to the same lines on the same schedule share one scheduler
+    job and one fetch per run, however many there are. Each subscription keeps
+    the last `window` results, as (fetched_at, response). A response is shared
+    by every subscription it was fetched for, not copied.
+
+    Args:
+        scheduler: started apscheduler scheduler the feed jobs are added to
+        fetch: returns the response for a url, fresh on every call, e.g.
+            not from the response cache, so each run records a new result
+        min_interval: shortest interval allowed, in seconds
+    """
+
+    def __init__(self,
+                 scheduler: BaseScheduler,
+                 fetch: ty.Callable[[str], ty.Any],
+                 min_interval: float = DEFAULT_MIN_INTERVAL):
+        self.scheduler = scheduler
+        self.fetch = fetch
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self.subscriptions: ty.Dict[str, Subscription] = dict()
+        self.feeds: ty.Dict[tuple, Feed] = dict()
+        self._results: ty.Dict[str, ty.Deque[ty.Tuple[float, ty.Any]]] = dict()
+        self.fetches = 0
+        self.failed_fetches = 0
+
+    def _trigger(self, interval: ty.Optional[float], cron: ty.Optional[str]):
+        if (interval is None) == (cron is None):
+            raise ValueError("Give exactly one of interval and cron")
+        if cron is not None:
+            return CronTrigger.from_crontab(cron)
+        if interval < self.min_interval:
+            raise ValueError(
+                f"interval must be at least {self.min_interval} seconds")
+        return IntervalTrigger(seconds=interval)
+
+    def subscribe(self,
+                  lines: ty.List[str],
+                  interval: float = None,
+                  cron: str = None,
+                  window: int = DEFAULT_WINDOW) -> str:
+        """Subscribe to lines, which should already be validated.
+
+        Returns: the subscription id
+        """
+        if not 1 <= window <= MAX_WINDOW:
+            raise ValueError(f"window must be between 1 and {MAX_WINDOW}")
+        trigger = self._trigger(interval, cron)
+        subscription = Subscription(id=uuid4().hex,
+                                    lines=sorted(set(lines)),
+                                    interval=interval,
+                                    cron=cron,
+                                    window=window)
+        key = subscription.feed_key
+        with self._lock:
+            self.subscriptions[subscription.id] = subscription
+            self._results[subscription.id] = deque(maxlen=window)
+            feed = self.feeds.get(key)
+            if feed is None:
+                feed = Feed(url=key[0], job_id=f"feed-{uuid4().hex}")
+                self.feeds[key] = feed
+                self.scheduler.add_job(func=self.run_feed,
+                                       trigger=trigger,
+                                       args=[key],
+                                       id=feed.job_id,
+                                       replace_existing=True)
+                tlog.info("started feed", url=feed.url, job_id=feed.job_id)
+            feed.subscription_ids.add(subscription.id)
+        return subscription.id
+
+    def unsubscribe(self, subscription_id: str):
+        with self._lock:
+            subscription = self.subscriptions.pop(subscription_id, None)
+            if subscription is None:
+                raise ValueError(f"No subscription {subscription_id}")
+            del self._results[subscription_id]
+            key = subscription.feed_key
+            feed = self.feeds[key]
+            feed.subscription_ids.discard(subscription_id)
+            if not feed.subscription_ids:
+                del self.feeds[key]
+                self.scheduler.remove_job(feed.job_id)
+                tlog.info("stopped feed", url=feed.url, job_id=feed.job_id)
+
+    def run_feed(self, key: tuple):
+        feed = self.feeds.get(key)
+        if feed is None:
+            return
+        try:
+            response = self.fetch(feed.url)
+        except Exception as e:
+            self.failed_fetches += 1
+            tlog.error("could not run feed", url=feed.url, err=e)
+            return
+        fetched_at = time.time()
+        with self._lock:
+            self.fetches += 1
+            for subscription_id in feed.subscription_ids:
+                self._results[subscription_id].append((fetched_at, response))
+
+    def get_results(self,
+                    subscription_id: str) -> ty.List[ty.Tuple[float, ty.Any]]:
+        """The subscription's results, oldest first"""
+        with self._lock:
+            if subscription_id not in self._results:
+                raise ValueError(f"No subscription {subscription_id}")
+            return list(self._results[subscription_id])
+
+    def stats(self) -> ty.Dict[str, int]:
+        return {
+            "subscriptions": len(self.subscriptions),
+            "feeds": len(self.feeds),
+            "fetches": self.fetches,
+            "failed_fetches": self.failed_fetches,
+        }
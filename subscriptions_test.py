@@ -0,0 +1,83 @@
+import threading
+import time
+import unittest
+
+from apscheduler.schedulers.background import BackgroundScheduler
+
+import subscriptions as module
+
+
+class SubscriptionManagerTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.scheduler = BackgroundScheduler()
+        self.scheduler.start()
+        self.fetched = []
+        self.fetched_event = threading.Event()
+        self.manager = module.SubscriptionManager(self.scheduler,
+                                                  fetch=self.fetch,
+                                                  min_interval=0)
+
+    def tearDown(self) -> None:
+        self.scheduler.shutdown()
+
+    def fetch(self, url):
+        self.fetched.append(url)
+        self.fetched_event.set()
+        return [url, len(self.fetched)]
+
+    def test_subscriptions_share_a_feed(self):
+        a = self.manager.subscribe(['jubilee', 'bakerloo'], interval=60)
+        b = self.manager.subscribe(['bakerloo', 'jubilee'], interval=60)
+        c = self.manager.subscribe(['bakerloo', 'jubilee'], interval=30)
+        self.assertEqual(self.manager.stats()['feeds'], 2)
+        self.assertEqual(len(self.scheduler.get_jobs()), 2)
+
+        key = self.manager.subscriptions[a].feed_key
+        self.manager.run_feed(key)
+        self.assertEqual(len(self.fetched), 1)
+        self.assertEqual(self.manager.get_results(a),
+                         self.manager.get_results(b))
+        self.assertEqual(self.manager.get_results(c), [])
+
+        self.manager.unsubscribe(a)
+        self.assertEqual(len(self.scheduler.get_jobs()), 2)
+        self.manager.unsubscribe(b)
+        self.assertEqual(len(self.scheduler.get_jobs()), 1)
+        with self.assertRaises(ValueError):
+            self.manager.get_results(a)
+
+    def test_rolling_window(self):
+        id = self.manager.subscribe(['victoria'], interval=60, window=3)
+        key = self.manager.subscriptions[id].feed_key
+        for _ in range(5):
+            self.manager.run_feed(key)
+        self.assertEqual(
+            [response[1] for _, response in self.manager.get_results(id)],
+            [3, 4, 5])
+
+    def test_runs_on_schedule(self):
+        self.manager.subscribe(['victoria'], interval=0.05)
+        self.assertTrue(self.fetched_event.wait(5))
+        deadline = time.time() + 5
+        while len(self.fetched) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertGreaterEqual(len(self.fetched), 2)
+
+    def test_bad_schedules(self):
+        manager = module.SubscriptionManager(self.scheduler, fetch=self.fetch)
+        with self.assertRaises(ValueError):
+            manager.subscribe(['victoria'])
+        with self.assertRaises(ValueError):
+            manager.subscribe(['victoria'], interval=60, cron='* * * * *')
+        with self.assertRaises(ValueError):
+            manager.subscribe(['victoria'], interval=1)
+        with self.assertRaises(ValueError):
+            manager.subscribe(['victoria'], cron='not a crontab')
+        with self.assertRaises(ValueError):
+            manager.subscribe(['victoria'], interval=60, window=0)
+        manager.subscribe(['victoria'], cron='*/5 * * * *')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""Metrics of a task's life, from the request that posts it to the write of
+its response. Exported with everything else in metrics.get_metrics(), and
+served by the app at /metrics.
+
+Each stage is timed in the tfl_task_stage_seconds histogram:
+    validation: checking a posted task's lines and time
+    enqueue: adding the task to the store and the scheduler
+    schedule_lag: from the time the task was due to when its job started
+    fetch: the upstream request to tfl
+    store_write: writing the response, and completing the task
+"""
+import typing as ty
+from datetime import datetime
+
+from metrics import DEFAULT_BUCKETS, Histogram, get_metrics
+
+VALIDATION = "validation"
+ENQUEUE = "enqueue"
+SCHEDULE_LAG = "schedule_lag"
+FETCH = "fetch"
+STORE_WRITE = "store_write"
+
+_STAGE_HELP = "Seconds each stage of a task's life takes, by stage"
+
+# schedule lag is mostly nothing, but runs to minutes behind a busy pool
+_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+_stages = {
+    stage: get_metrics().histogram(
+        "tfl_task_stage_seconds",
+        help=_STAGE_HELP,
+        buckets=_LAG_BUCKETS if stage == SCHEDULE_LAG else DEFAULT_BUCKETS,
+        stage=stage)
+    for stage in [VALIDATION, ENQUEUE, SCHEDULE_LAG, FETCH, STORE_WRITE]
+}
+
+SCHEDULED = get_metrics().counter("tfl_tasks_scheduled_total",
+                                  help="Tasks scheduled by this process")
+FINISHED = get_metrics().counter(
+    "tfl_tasks_finished_total",
+    help="Tasks whose response was written by this process")
+FAILED = get_metrics().counter(
+    "tfl_tasks_failed_total",
+    help="Task runs whose fetch failed, the tasks stay pending")
+
+
+def stage(name: str) -> Histogram:
+    return _stages[name]
+
+
+def observe_lag(due: datetime):
+    """Observe the schedule lag of a job due at `due` that just started"""
+    _stages[SCHEDULE_LAG].observe(
+        max(0.0, (datetime.now() - due).total_seconds()))
+
+
+def on_completed(task_ids: ty.List[str]):
+    """Completion listener counting finished tasks"""
+    FINISHED.inc(len(task_ids))
+
+
+def watch_store(store):
+    """Count the store's completed tasks, and export its pending tasks"""
+    store.add_completion_listener(on_completed)
+    get_metrics().gauge("tfl_tasks_pending",
+                        help="Tasks pending in the store",
+                        func=store.count_pending_tasks)
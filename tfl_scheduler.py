@@ -1,54 +1,342 @@
+import threading
+import time
+import typing as ty
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor as RecoveryPool
 from datetime import datetime
+from functools import partial
 from uuid import uuid4
+import task_metrics
 import tlog
 
-import requests
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.base import BaseScheduler
 from apscheduler.triggers.date import DateTrigger
 
 import constants as c
-from store import AbstractMemoryStore
+from async_engine import DEFAULT_CONCURRENCY, AsyncFetchEngine
+from coalescer import RequestCoalescer, get_coalescer
+from http_client import DEFAULT_POOL_SIZE, TflHttpClient, get_http_client
+from response_cache import LineResponseCache
+from store import DEFAULT_BATCH_SIZE, AbstractMemoryStore
 
 
-def get_from_tfl(url, id: str, store: AbstractMemoryStore):
-    tlog.info("running get_from_tfl")
-    resp = requests.get(url)
-    store.add_response(id, resp.json())
-    store.remove_pending_task_id(task_id=id)
+DEFAULT_MAX_WORKERS = DEFAULT_POOL_SIZE
+
+EXECUTOR_THREAD = "thread"
+EXECUTOR_ASYNCIO = "asyncio"
+EXECUTOR_QUEUE = "queue"
+
+DEFAULT_RECOVERY_WORKERS = DEFAULT_MAX_WORKERS
+
+
+class RecoveryReport(ty.NamedTuple):
+    overdue: int  # tasks run straight away
+    scheduled: int  # tasks registered to run later
+    jobs: int  # scheduler jobs registered for the scheduled tasks
+    skipped: int  # tasks with a dt_str that could not be parsed
+    seconds: float
+
+
+def fetch_from_tfl(url: str, client: TflHttpClient = None):
+    client = client or get_http_client()
+    with task_metrics.stage(task_metrics.FETCH).time():
+        return client.get_json(url)
+
+
+def get_from_tfl(url,
+                 id: str,
+                 store: AbstractMemoryStore,
+                 coalescer: RequestCoalescer = None,
+                 fetch: ty.Callable[[str], ty.Any] = fetch_from_tfl,
+                 due: datetime = None):
+    """Run a task. due is when it was scheduled for, to measure its lag"""
+    tlog.debug("running get_from_tfl", task_id=id, url=url)
+    if due is not None:
+        task_metrics.observe_lag(due)
+    if coalescer is not None:
+        coalescer.submit(url=url, task_id=id, store=store, fetch=fetch)
+        return
+    try:
+        response = fetch(url)
+    except Exception:
+        task_metrics.FAILED.inc()
+        raise
+    with task_metrics.stage(task_metrics.STORE_WRITE).time():
+        store.add_response(id, response)
+        store.remove_pending_task_id(task_id=id)
+
+
+def run_recovered_tasks(tfl_scheduler: "TflScheduler",
+                        tasks: ty.List[ty.Tuple[str, str]],
+                        due: datetime = None):
+    """Run a batch of recovered or bulk scheduled (task_id, url) tasks, one
+    fetch per url, one url after the other. Callers batch by url, so fetches
+    of different urls run in parallel on the scheduler's or recovery pool.
+    due is when the batch was scheduled for, to measure its lag, overdue
+    recovered tasks have none.
+
+    Tasks that have completed, or have been rescheduled with their own job,
+    since they were batched are skipped.
+    """
+    if due is not None:
+        task_metrics.observe_lag(due)
+    store = tfl_scheduler.store
+    url2ids = defaultdict(list)
+    for id, url in tasks:
+        if tfl_scheduler.scheduler.get_job(id) is not None:
+            continue
+        if not store.is_pending_task_id(id):
+            continue
+        url2ids[url].append(id)
+
+    for url, ids in url2ids.items():
+        try:
+            response = tfl_scheduler.fetch(url)
+        except Exception as e:
+            task_metrics.FAILED.inc(len(ids))
+            tlog.error(f"could not run {len(ids)} recovered tasks",
+                       url=url, err=e)
+            continue
+        with task_metrics.stage(task_metrics.STORE_WRITE).time():
+            store.add_responses_bulk([(id, response) for id in ids])
 
 
 class TflScheduler:
     def __init__(self,
                  store: AbstractMemoryStore,
-                 scheduler: BackgroundScheduler = None):
-        tlog.info("Initialising scheduler wrapper")
+                 scheduler: BaseScheduler = None,
+                 coalesce_window: float = None,
+                 response_cache: LineResponseCache = None,
+                 max_workers: int = DEFAULT_MAX_WORKERS,
+                 executor: str = EXECUTOR_THREAD,
+                 concurrency: int = DEFAULT_CONCURRENCY,
+                 recover_pending: bool = True):
+        """
+        Args:
+            store: where responses and pending tasks are kept
+            scheduler: apscheduler scheduler, a BackgroundScheduler by default,
+                or an AsyncIOScheduler in the asyncio executor mode
+            coalesce_window: if given, tasks for the same url that fire within
+                this many seconds of each other share one upstream fetch
+            response_cache: if given, disruption responses are served per
+                line from this cache and only missing lines are fetched
+            max_workers: size of the scheduler's thread pool, the shared http
+                connection pool is sized to match
+            executor: EXECUTOR_THREAD runs each fetch in a scheduler thread,
+                EXECUTOR_ASYNCIO runs them as coroutines on one event loop,
+                EXECUTOR_QUEUE only writes them to the store, which must be a
+                SQLStore, for worker processes to run (see worker.py)
+            concurrency: max fetches in flight in the asyncio executor mode.
+                Coalescing and the response cache are not used in that mode,
+                the async engine shares in-flight fetches for a url itself
+            recover_pending: recover the store's pending tasks in a background
+                thread. The app builds one scheduler per store, other callers
+                sharing a store should only recover it with one of them
+        """
+        tlog.info(f"Initialising scheduler wrapper, executor = {executor}")
+        if executor not in (EXECUTOR_THREAD, EXECUTOR_ASYNCIO, EXECUTOR_QUEUE):
+            raise ValueError(f"Unknown executor {executor}")
+        self.executor = executor
+        self.store = store
+        self.last_recovery: ty.Optional[RecoveryReport] = None
+        self.coalescer = None
+        if executor == EXECUTOR_QUEUE:
+            if not hasattr(store, "claim_due_tasks"):
+                raise ValueError(
+                    f"The queue executor needs a store with claims, "
+                    f"got {type(store).__name__}")
+            # the workers run every due task, including overdue ones
+            self.scheduler = None
+            self.async_engine = None
+            return
+        self.async_engine = None
+        if executor == EXECUTOR_ASYNCIO:
+            self.async_engine = AsyncFetchEngine(
+                concurrency=concurrency).start()
+            if not scheduler:
+                scheduler = AsyncIOScheduler(
+                    event_loop=self.async_engine.loop)
         if not scheduler:
-            scheduler = BackgroundScheduler()
+            scheduler = BackgroundScheduler(
+                executors={"default": ThreadPoolExecutor(max_workers)})
         self.scheduler = scheduler
-        self.store = store
-        if len(store.get_all_pending_tasks()) > 0:
-            self.schedule_all_pending_tasks()
+        if coalesce_window is not None:
+            self.coalescer = get_coalescer(window=coalesce_window,
+                                           max_workers=max_workers)
+        self.http_client = get_http_client(pool_size=max_workers)
+        self.fetch = partial(fetch_from_tfl, client=self.http_client)
+        if response_cache is not None:
+            self.fetch = partial(response_cache.fetch, fetch=self.fetch)
         self.scheduler.start()
+        if recover_pending:
+            threading.Thread(target=self.schedule_all_pending_tasks,
+                             name="tfl-recovery",
+                             daemon=True).start()
+
+    def schedule_all_pending_tasks(
+            self,
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            max_workers: int = DEFAULT_RECOVERY_WORKERS) -> RecoveryReport:
+        """Recover the pending tasks in the store, e.g. after a restart.
+
+        Pending tasks are streamed from the store in batches. Overdue ones are
+        run straight away on a pool of max_workers threads, one fetch per url
+        per batch, the urls in parallel. Future ones are grouped by due time
+        and url, and registered as one scheduler job per group, rather than
+        one job per task. Blocks until the overdue tasks have run.
+        """
+        start = time.monotonic()
+        now_str = datetime.now().strftime(c.DT_STR)
+        dt_str2url2tasks = defaultdict(lambda: defaultdict(list))
+        overdue = 0
+        skipped = 0
+        # at most 2 batches per worker are queued, so memory stays bounded
+        # however many overdue tasks there are
+        slots = threading.BoundedSemaphore(2 * max_workers)
+
+        def run_batch(tasks):
+            try:
+                run_recovered_tasks(self, tasks)
+            finally:
+                slots.release()
 
+        with RecoveryPool(max_workers=max_workers) as pool:
+            for batch in self.store.iter_pending_tasks(batch_size=batch_size):
+                url2overdue = defaultdict(list)
+                for task_id, dt_str, url in batch:
+                    if dt_str <= now_str:
+                        url2overdue[url].append((task_id, url))
+                    else:
+                        dt_str2url2tasks[dt_str][url].append((task_id, url))
+                for overdue_tasks in url2overdue.values():
+                    overdue += len(overdue_tasks)
+                    slots.acquire()
+                    pool.submit(run_batch, overdue_tasks)
 
-    def schedule_all_pending_tasks(self):
-        pass
+            scheduled = 0
+            jobs = 0
+            for dt_str, url2tasks in dt_str2url2tasks.items():
+                try:
+                    dt = datetime.strptime(dt_str, c.DT_STR)
+                except ValueError as e:
+                    count = sum(len(tasks) for tasks in url2tasks.values())
+                    tlog.error(f"skipping {count} tasks due at {dt_str}",
+                               err=e)
+                    skipped += count
+                    continue
+                for url, tasks in url2tasks.items():
+                    self.scheduler.add_job(func=run_recovered_tasks,
+                                           trigger=DateTrigger(run_date=dt),
+                                           args=[self, tasks],
+                                           kwargs=dict(due=dt),
+                                           id=f"recovery-{dt_str}-{url}",
+                                           replace_existing=True,
+                                           misfire_grace_time=None)
+                    scheduled += len(tasks)
+                    jobs += 1
+
+        report = RecoveryReport(overdue=overdue,
+                                scheduled=scheduled,
+                                jobs=jobs,
+                                skipped=skipped,
+                                seconds=time.monotonic() - start)
+        tlog.info("recovered pending tasks", **report._asdict())
+        self.last_recovery = report
+        return report
 
     def schedule_tfl_call(self, url: str, dt: datetime, id: str = None) -> str:
-        tlog.info("Scheduling tfl call")
+        with task_metrics.stage(task_metrics.ENQUEUE).time():
+            id = self._schedule_tfl_call(url, dt, id)
+        task_metrics.SCHEDULED.inc()
+        return id
+
+    def _schedule_tfl_call(self, url: str, dt: datetime, id: str) -> str:
         dt = datetime.now() if not dt else dt
         trigger = DateTrigger(run_date=dt)
         dt_str = dt.strftime(c.DT_STR)
         id = id or uuid4().hex
-        args = [url, id, self.store]
+        if self.executor == EXECUTOR_QUEUE:
+            self.store.add_pending_task_id(id, dt_str, url)
+            return id
+        if self.async_engine is not None:
+            func = self.async_engine.get_from_tfl
+            args = [url, id, self.store]
+        else:
+            func = get_from_tfl
+            args = [url, id, self.store, self.coalescer, self.fetch]
 
         if not self.store.is_pending_task_id(task_id=dt_str):
             self.store.add_pending_task_id(id, dt_str, url)
 
-        tlog.info(f"scheduling job, dt = {dt}, id = {id}")
-        self.scheduler.add_job(func=get_from_tfl,
+        tlog.debug("scheduling job", dt=dt, task_id=id)
+        self.scheduler.add_job(func=func,
                                trigger=trigger,
                                args=args,
+                               kwargs=dict(due=dt),
                                id=id,
-                               replace_existing=True)
+                               replace_existing=True,
+                               # run however late, e.g. behind a busy thread
+                               # pool, rather than drop the task
+                               misfire_grace_time=None)
         return id
+
+    def schedule_tfl_calls_bulk(
+            self, calls: ty.List[ty.Tuple[str, ty.Optional[datetime]]]
+    ) -> ty.List[str]:
+        """schedule_tfl_call for every (url, dt), with one store write for all
+        of them, and one scheduler job per due time and url rather than per
+        task, so the fetches of different urls run in parallel.
+
+        Returns: the task ids, in the order of calls
+        """
+        with task_metrics.stage(task_metrics.ENQUEUE).time():
+            ids = self._schedule_tfl_calls_bulk(calls)
+        task_metrics.SCHEDULED.inc(len(ids))
+        return ids
+
+    def _schedule_tfl_calls_bulk(
+            self, calls: ty.List[ty.Tuple[str, ty.Optional[datetime]]]
+    ) -> ty.List[str]:
+        now = datetime.now()
+        batch_id = uuid4().hex
+        ids = []
+        pending = []
+        job2tasks = defaultdict(list)
+        for url, dt in calls:
+            dt = dt or now
+            id = uuid4().hex
+            dt_str = dt.strftime(c.DT_STR)
+            ids.append(id)
+            pending.append((id, dt_str, url))
+            job2tasks[dt_str, url].append((id, url))
+        self.store.add_pending_tasks_bulk(pending)
+        if self.executor == EXECUTOR_QUEUE:
+            return ids
+
+        for job, ((dt_str, _), tasks) in enumerate(job2tasks.items()):
+            run_date = datetime.strptime(dt_str, c.DT_STR)
+            self.scheduler.add_job(
+                func=run_recovered_tasks,
+                trigger=DateTrigger(run_date=run_date),
+                args=[self, tasks],
+                # tasks for now were due now, not at the start of the second
+                kwargs=dict(due=max(run_date, now)),
+                id=f"batch-{batch_id}-{job}",
+                misfire_grace_time=None)
+        tlog.debug("scheduled batch",
+                   batch_id=batch_id,
+                   tasks=len(ids),
+                   jobs=len(job2tasks))
+        return ids
+
+    def shutdown(self, wait: bool = True):
+        if self.scheduler is not None:
+            self.scheduler.shutdown(wait=wait)
+        if self.coalescer is not None and wait:
+            # open batches still write to the store
+            self.coalescer.join()
+        if self.async_engine is not None:
+            self.async_engine.shutdown()
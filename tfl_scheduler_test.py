@@ -2,7 +2,8 @@ import time
 import unittest
 
 from datetime import datetime, timedelta
-from store import get_memory_store
+from store import InMemoryStore, get_store
+from tfl_stub import TflStubServer
 import tfl_scheduler as module
 import constants as c
 
@@ -14,12 +15,12 @@ class SchedulerTest(unittest.TestCase):
         self.dt_str = self.test_dt.strftime(c.DT_STR)
 
     def test_get_from_tfl(self):
-        store = get_memory_store(in_memory_store=True)
+        store = get_store(in_memory_store=True)
         module.get_from_tfl(url=self.url, id='Test', store=store)
         self.assertIsNotNone(store.get_task_id_response('Test'))
 
     def test_schedule_tfl_call(self):
-        store = get_memory_store(in_memory_store=True)
+        store = get_store(in_memory_store=True)
         tfl_scheduler = module.TflScheduler(store=store)
         tfl_scheduler.schedule_tfl_call(url=self.url,
                                         dt=self.test_dt,
@@ -30,7 +31,7 @@ class SchedulerTest(unittest.TestCase):
     def test_change_job(self):
         url_new = "https://api.tfl.gov.uk/Line/victoria/"
         id = 'Test'
-        store = get_memory_store(in_memory_store=True)
+        store = get_store(in_memory_store=True)
         tfl_scheduler = module.TflScheduler(store=store)
         test_dt = datetime.now() + timedelta(seconds=3)
         tfl_scheduler.schedule_tfl_call(url=self.url, dt=test_dt, id=id)
@@ -42,7 +43,7 @@ class SchedulerTest(unittest.TestCase):
     def test_schedule_now(self):
         url = "https://api.tfl.gov.uk/Line/victoria/"
         id = 'Test'
-        store = get_memory_store(in_memory_store=True)
+        store = get_store(in_memory_store=True)
         tfl_scheduler = module.TflScheduler(store=store)
         tfl_scheduler.schedule_tfl_call(url=url, dt=None, id=id)
         time.sleep(1)  # takes a second for api to return
@@ -50,6 +51,84 @@ class SchedulerTest(unittest.TestCase):
         self.assertEqual(response[0]['id'], 'victoria')
 
 
+class RecoveryTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.stub = TflStubServer().start()
+        self.url = f"{self.stub.url}/Line/bakerloo/Disruption"
+        self.store = InMemoryStore()
+        self.tfl_scheduler = module.TflScheduler(store=self.store,
+                                                 recover_pending=False)
+
+    def tearDown(self) -> None:
+        self.tfl_scheduler.shutdown()
+        self.stub.stop()
+
+    def add_pending(self, task_id, dt):
+        self.store.add_pending_task_id(task_id, dt.strftime(c.DT_STR),
+                                       self.url)
+
+    def test_schedule_all_pending_tasks(self):
+        past = datetime.now() - timedelta(minutes=5)
+        future = datetime.now() + timedelta(seconds=1)
+        self.add_pending('overdue_1', past)
+        self.add_pending('overdue_2', past)
+        self.add_pending('future_1', future)
+        self.add_pending('future_2', future)
+        self.store.add_pending_task_id('bad', 'dt_str_1', self.url)
+
+        report = self.tfl_scheduler.schedule_all_pending_tasks(batch_size=2)
+
+        self.assertEqual((report.overdue, report.scheduled, report.jobs,
+                          report.skipped), (2, 2, 1, 1))
+        self.assertIsNotNone(self.store.get_task_id_response('overdue_1'))
+        self.assertIsNotNone(self.store.get_task_id_response('overdue_2'))
+        self.assertEqual(self.stub.requests, 1)
+        self.assertTrue(self.store.is_pending_task_id('future_1'))
+
+        time.sleep(2)
+        self.assertIsNotNone(self.store.get_task_id_response('future_1'))
+        self.assertIsNotNone(self.store.get_task_id_response('future_2'))
+        self.assertEqual(self.stub.requests, 2)
+
+    def test_rescheduled_tasks_are_not_run_twice(self):
+        self.add_pending('future_1', datetime.now() + timedelta(seconds=1))
+        self.tfl_scheduler.schedule_all_pending_tasks()
+        self.tfl_scheduler.schedule_tfl_call(
+            url=self.url, dt=datetime.now() + timedelta(minutes=5),
+            id='future_1')
+
+        time.sleep(2)
+        self.assertEqual(self.stub.requests, 0)
+        self.assertTrue(self.store.is_pending_task_id('future_1'))
+
+    def test_schedule_tfl_calls_bulk(self):
+        soon = datetime.now() + timedelta(seconds=1)
+        other_url = f"{self.stub.url}/Line/victoria/Disruption"
+        calls = [(self.url, None)] * 50 + [(other_url, soon)] * 50
+        ids = self.tfl_scheduler.schedule_tfl_calls_bulk(calls)
+
+        self.assertEqual(len(set(ids)), 100)
+        self.assertLessEqual(len(self.tfl_scheduler.scheduler.get_jobs()), 2)
+        time.sleep(2.5)
+        for id in ids:
+            self.assertIsNotNone(self.store.get_task_id_response(id))
+        self.assertEqual(self.store.get_all_pending_tasks(), [])
+        self.assertEqual(self.stub.requests, 2)
+
+    def test_bulk_fetches_urls_in_parallel(self):
+        self.stub.latency = 0.2
+        calls = [(f"{self.stub.url}/Line/line-{i}/Disruption", None)
+                 for i in range(20)]
+        began = time.monotonic()
+        ids = self.tfl_scheduler.schedule_tfl_calls_bulk(calls)
+        while self.store.count_pending_tasks() and (time.monotonic() - began
+                                                    < 10):
+            time.sleep(0.05)
+        self.assertEqual(self.store.get_all_pending_tasks(), [])
+        # 20 fetches one after the other would take 4 seconds
+        self.assertLess(time.monotonic() - began, 2)
+        self.assertEqual(len(ids), 20)
+        self.assertEqual(self.stub.requests, 20)
 
 
 if __name__ == '__main__':
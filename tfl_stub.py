@@ -0,0 +1,192 @@
+"""Local stand-in for the parts of api.tfl.gov.uk the app uses.
+
+Serves `/Line/Mode/<modes>` and `/Line/<ids>/Disruption` from a thread per
+connection, with HTTP/1.1 keep-alive and gzip, so tests and benchmarks can run
+without the network.
+"""
+import gzip
+import json
+import random
+import threading
+import time
+import typing as ty
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MODE2LINES = {
+    "tube": [
+        "bakerloo", "central", "circle", "district", "hammersmith-city",
+        "jubilee", "metropolitan", "northern", "piccadilly", "victoria",
+        "waterloo-city"
+    ],
+    "dlr": ["dlr"],
+    "overground": ["london-overground"],
+    "bus": ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10"],
+}
+
+
+def line_name(line_id: str) -> str:
+    return line_id.replace('-', ' ').title()
+
+
+def make_stop(line_id: str, i: int) -> dict:
+    return {
+        "$type": ("Tfl.Api.Presentation.Entities.StopPoint, "
+                  "Tfl.Api.Presentation.Entities"),
+        "naptanId": f"940GZZLU{line_id[:3].upper()}{i:03d}",
+        "commonName": f"{line_name(line_id)} Stop {i} Underground Station",
+        "stopType": "NaptanMetroStation",
+        "lat": 51.5 + i / 1000,
+        "lon": -0.1 - i / 1000,
+        "lines": [{"id": line_id, "name": line_name(line_id)}],
+    }
+
+
+def make_disruption(line_id: str,
+                    i: int = 0,
+                    padding: int = 0,
+                    stops: int = 0) -> dict:
+    """A disruption shaped like the ones tfl returns"""
+    name = line_name(line_id)
+    description = f"{name} Line: Service will resume later this morning. "
+    if padding:
+        description += "x" * padding
+    return {
+        "$type": ("Tfl.Api.Presentation.Entities.Disruption, "
+                  "Tfl.Api.Presentation.Entities"),
+        "category": "RealTime" if i % 2 == 0 else "PlannedWork",
+        "type": "lineInfo",
+        "categoryDescription": "RealTime" if i % 2 == 0 else "PlannedWork",
+        "description": description,
+        "affectedRoutes": [],
+        "affectedStops": [make_stop(line_id, j) for j in range(stops)],
+        "closureText": "serviceClosed" if i % 3 == 0 else "minorDelays",
+    }
+
+
+def make_line(line_id: str, mode: str) -> dict:
+    return {
+        "$type": ("Tfl.Api.Presentation.Entities.Line, "
+                  "Tfl.Api.Presentation.Entities"),
+        "id": line_id,
+        "name": line_name(line_id),
+        "modeName": mode,
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.stub.on_connection()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        status, body = self.server.stub.handle(self.path)
+        data = json.dumps(body).encode()
+        headers = {"Content-Type": "application/json; charset=utf-8"}
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = gzip.compress(data)
+            headers["Content-Encoding"] = "gzip"
+        headers["Content-Length"] = str(len(data))
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class TflStubServer:
+    """
+    Args:
+        latency: seconds to wait before answering each request
+        error_rate: fraction of requests answered with a 503
+        disruptions_per_line: number of disruptions returned per line
+        padding: extra characters added to every disruption description, to
+            make payloads bigger
+        seed: seed for the error rate's random number generator
+    """
+
+    def __init__(self,
+                 latency: float = 0.0,
+                 error_rate: float = 0.0,
+                 disruptions_per_line: int = 1,
+                 padding: int = 0,
+                 seed: int = 0,
+                 host: str = "127.0.0.1",
+                 port: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.disruptions_per_line = disruptions_per_line
+        self.padding = padding
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._fail_next = 0
+        self.requests = 0
+        self.connections = 0
+        self.paths: ty.List[str] = []
+
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def fail_next(self, n: int):
+        """Answer the next n requests with a 503"""
+        with self._lock:
+            self._fail_next = n
+
+    def on_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def handle(self, path: str) -> ty.Tuple[int, ty.Any]:
+        with self._lock:
+            self.requests += 1
+            self.paths.append(path)
+            fail = self._fail_next > 0 or (
+                self.error_rate and self._random.random() < self.error_rate)
+            if self._fail_next > 0:
+                self._fail_next -= 1
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            return 503, {"httpStatusCode": 503, "message": "stub error"}
+
+        parts = path.split('?')[0].strip('/').split('/')
+        if len(parts) == 3 and parts[:2] == ["Line", "Mode"]:
+            return 200, [
+                make_line(line_id, mode)
+                for mode in parts[2].split(',')
+                for line_id in MODE2LINES.get(mode, [])
+            ]
+        if len(parts) == 3 and parts[0] == "Line" and parts[2] == "Disruption":
+            return 200, [
+                make_disruption(line_id, i, self.padding)
+                for line_id in parts[1].split(',')
+                for i in range(self.disruptions_per_line)
+            ]
+        return 404, {"httpStatusCode": 404, "message": f"no route {path}"}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -1,9 +1,101 @@
+import itertools
+import logging
+import os
+import reprlib
+import typing as ty
+
 import structlog
 from structlog.stdlib import BoundLogger
 
 # tfl app logger - tlog
+#
+# Calls below the configured level (TFL_LOG_LEVEL, info by default) are
+# no-ops. To keep calls that are emitted cheap on hot paths, pass a constant
+# event and put variable parts in keyword arguments rather than an f-string,
+# wrap big payloads in `capped`, and expensive values in `lazy`. Both are only
+# formatted when the line is actually rendered.
+
+DEFAULT_LEVEL = "info"
+DEFAULT_MAX_REPR = 200  # characters
+
+LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    "critical": logging.CRITICAL,
+}
+
+
+class lazy:
+    """A value computed only if the log line it is part of is emitted"""
+
+    def __init__(self, f: ty.Callable, *args, **kwargs):
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self):
+        return self.f(*self.args, **self.kwargs)
+
+
+_repr = reprlib.Repr()
+_repr.maxlevel = 3
+_repr.maxlist = _repr.maxtuple = _repr.maxset = 5
+_repr.maxdict = 5
+_repr.maxstring = _repr.maxother = 80
+
+
+class capped:
+    """A value whose repr is bounded in size, and so in the time to build it,
+    however big the value is"""
+
+    def __init__(self, value, max_len: int = DEFAULT_MAX_REPR):
+        self.value = value
+        self.max_len = max_len
+
+    def __repr__(self):
+        value_repr = _repr.repr(self.value)
+        if len(value_repr) > self.max_len:
+            value_repr = value_repr[:self.max_len - 3] + "..."
+        return value_repr
+
+    __str__ = __repr__
 
-_global_logger: BoundLogger = structlog.get_logger('root_tlog')
+
+def _resolve_lazy(logger, method_name, event_dict):
+    for key, value in event_dict.items():
+        if isinstance(value, lazy):
+            event_dict[key] = value()
+    return event_dict
+
+
+def configure(level: str = None):
+    """(Re)configure the level below which calls are no-ops"""
+    global _level, _global_logger
+    level = (level or os.getenv("TFL_LOG_LEVEL", DEFAULT_LEVEL)).lower()
+    _level = LEVELS[level]
+    processors = [
+        p for p in structlog.get_config()["processors"] if p is not
+        _resolve_lazy
+    ]
+    structlog.configure(
+        processors=[_resolve_lazy] + processors,
+        wrapper_class=structlog.make_filtering_bound_logger(_level))
+    # bound straight away, so calls skip the lazy proxy's per call bind
+    _global_logger = structlog.get_logger('root_tlog').bind()
+
+
+_level: int = LEVELS[DEFAULT_LEVEL]
+_global_logger: BoundLogger = None
+configure()
+
+# event -> count of calls, for sampling
+_sample_counters: ty.Dict[str, ty.Iterator[int]] = dict()
+
+
+def is_enabled_for(level: str) -> bool:
+    return LEVELS[level] >= _level
 
 
 def info(*args, **kwargs):
@@ -24,3 +116,23 @@ def warn(*args, **kwargs):
 def error(*args, **kwargs):
     """Log message with level ERROR."""
     return _global_logger.error(*args, **kwargs)
+
+
+def exception(*args, **kwargs):
+    """Log message with level ERROR, and the current exception."""
+    return _global_logger.exception(*args, **kwargs)
+
+
+def sampled(every: int, event: str, level: str = "info", **kwargs):
+    """Log only the first of every `every` calls for this event.
+
+    For events that fire on every task, where a trickle is enough to see
+    what is going on.
+    """
+    if not is_enabled_for(level):
+        return
+    counter = _sample_counters.get(event)
+    if counter is None:
+        counter = _sample_counters.setdefault(event, itertools.count())
+    if next(counter) % every == 0:
+        getattr(_global_logger, level)(event, sampled_every=every, **kwargs)
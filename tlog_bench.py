@@ -0,0 +1,70 @@
+"""Shows that the cost of a store write stays flat as the store grows.
+
+    python tlog_bench.py
+
+Fills an InMemoryStore with 1k, 10k and 100k responses and times
+`add_response` on each, once at the default log level and once at debug, with
+logs written to /dev/null. For comparison it also times formatting the whole
+store into the log line, which is what every write used to do.
+"""
+import os
+import time
+import timeit
+
+import structlog
+
+import tlog
+from store import InMemoryStore
+from tfl_stub import make_disruption
+
+SIZES = [1_000, 10_000, 100_000]
+WRITES = 1_000
+
+
+def make_store(size: int) -> InMemoryStore:
+    store = InMemoryStore()
+    response = [make_disruption("central")]
+    for i in range(size):
+        store.add_response(f"task-{i}", response)
+    return store
+
+
+def time_writes(store: InMemoryStore) -> float:
+    """Microseconds per add_response, best of 3"""
+    response = [make_disruption("victoria")]
+    best = float("inf")
+    for run in range(3):
+        start = time.perf_counter()
+        for i in range(WRITES):
+            store.add_response(f"bench-{run}-{i}", response)
+        best = min(best, time.perf_counter() - start)
+    return best / WRITES * 1e6
+
+
+def time_old_format(store: InMemoryStore) -> float:
+    """Microseconds to build the log line every write used to build"""
+    timer = timeit.Timer(
+        lambda: f"added. task_id2response = {store.task_id2response}")
+    return min(timer.repeat(repeat=3, number=1)) * 1e6
+
+
+def main():
+    with open(os.devnull, "w") as devnull:
+        structlog.configure(
+            logger_factory=structlog.PrintLoggerFactory(devnull))
+        print(f"{'entries':>8} {'info us':>9} {'debug us':>9} "
+              f"{'old format us':>14}")
+        for size in SIZES:
+            tlog.configure("info")
+            store = make_store(size)
+            info_us = time_writes(store)
+            tlog.configure("debug")
+            debug_us = time_writes(store)
+            old_us = time_old_format(store)
+            print(f"{size:>8} {info_us:>9.1f} {debug_us:>9.1f} "
+                  f"{old_us:>14.1f}")
+        tlog.configure()
+
+
+if __name__ == "__main__":
+    main()
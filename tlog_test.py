@@ -0,0 +1,48 @@
+import unittest
+
+from structlog.testing import capture_logs
+
+import tlog
+
+
+class TlogTest(unittest.TestCase):
+    def tearDown(self):
+        tlog.configure()
+
+    def test_capped_repr_is_bounded(self):
+        value = {f"task-{i}": ["x" * 1000] * 100 for i in range(10_000)}
+        self.assertLessEqual(len(repr(tlog.capped(value))),
+                             tlog.DEFAULT_MAX_REPR)
+        self.assertLessEqual(len(str(tlog.capped(value, max_len=20))), 20)
+        self.assertEqual(repr(tlog.capped([1, 2])), "[1, 2]")
+
+    def test_lazy_not_evaluated_below_level(self):
+        calls = []
+
+        def expensive():
+            calls.append(1)
+            return "value"
+
+        tlog.configure("info")
+        tlog.debug("event", value=tlog.lazy(expensive))
+        self.assertEqual(calls, [])
+        self.assertFalse(tlog.is_enabled_for("debug"))
+
+        with capture_logs() as logs:
+            # rebind, so the global logger picks up the capturing processors
+            tlog.configure("debug")
+            tlog.debug("event", value=tlog.lazy(expensive))
+        self.assertEqual(calls, [1])
+        self.assertEqual(logs[0]["value"], "value")
+
+    def test_sampled(self):
+        with capture_logs() as logs:
+            tlog.configure("info")
+            for i in range(25):
+                tlog.sampled(10, "sampled test event", i=i)
+        self.assertEqual([log["i"] for log in logs], [0, 10, 20])
+        self.assertEqual(logs[0]["sampled_every"], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,32 +1,54 @@
-import requests
+import typing as ty
+
+import constants as c
+from line_index import LineIndex, get_line_index
+
+
+def url_from_lines(lines: ty.List[str]) -> str:
+    fmt_lines = ','.join(lines)
+    return f"{c.TFL_API_URL}/Line/{fmt_lines}/Disruption"
+
+
+def lines_from_url(url: str) -> ty.Optional[ty.List[str]]:
+    """Inverse of url_from_lines. None if url is not a disruption url"""
+    prefix = f"{c.TFL_API_URL}/Line/"
+    suffix = "/Disruption"
+    if not (url.startswith(prefix) and url.endswith(suffix)):
+        return None
+    fmt_lines = url[len(prefix):-len(suffix)]
+    if not fmt_lines or '/' in fmt_lines:
+        return None
+    return fmt_lines.split(',')
 
 
 class TflUrlHelper:
 
-    def __init__(self):
-        self.valid_ids = self.get_valid_ids()
+    def __init__(self, line_index: LineIndex = None):
+        # cheap, the index is loaded once per process and shared
+        if line_index is None:
+            line_index = get_line_index()
+        self.line_index = line_index
+
+    @property
+    def valid_ids(self) -> ty.KeysView:
+        return self.line_index.valid_ids()
 
     def get_valid_ids(self) -> set:
-        url = f"https://api.tfl.gov.uk/Line/Mode/tube"
-        resp = requests.get(url)
-        valid_ids = set()
-        for r in resp.json():
-            valid_ids.add(r['id'])
-        return valid_ids
+        return set(self.line_index.valid_ids())
 
     def is_valid_lines(self, lines: list) -> bool:
         if lines:
-            return set(lines) <= self.valid_ids
+            return all(line in self.line_index for line in lines)
         return False
 
     def construct_lines_from_raw_lines(self, raw_lines: str) -> list:
-        return raw_lines.split(',')
-        
+        # de-duplicated and sorted, so that the same set of lines always maps
+        # to the same url and concurrent tasks can share a fetch
+        return sorted(set(raw_lines.split(',')))
 
     def construct_url_from_lines(self, raw_lines: list) -> str:
         lines = self.construct_lines_from_raw_lines(raw_lines)
         if self.is_valid_lines(lines):
-            fmt_lines = ','.join(lines)
-            return f"https://api.tfl.gov.uk/Line/{fmt_lines}/Disruption"
+            return url_from_lines(lines)
         else:
             raise ValueError("Lines are invalid")
@@ -0,0 +1,187 @@
+"""Runs the tasks queued in a shared SQL store.
+
+With the queue executor the app only writes tasks to the store, and any number
+of these workers, in any number of processes or machines, claim and run them
+once they are due:
+
+    python worker.py --database-url sqlite:///tfl_tasks.db --processes 4
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import threading
+import typing as ty
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import task_metrics
+import tlog
+from http_client import DEFAULT_POOL_SIZE
+from store import DEFAULT_LEASE, DEFAULT_PAGE_SIZE, SQLStore, parse_dt_str
+from tfl_scheduler import fetch_from_tfl
+
+DEFAULT_POLL_INTERVAL = 0.5  # seconds between claims when the queue is empty
+DEFAULT_RETRY_DELAY = 5  # seconds before a failed task can be claimed again
+DEFAULT_MAX_ATTEMPTS = 5  # failed runs before a task is given up on
+
+
+class QueueWorker:
+    """Claims due tasks from the store in batches and runs them, one fetch per
+    url per batch.
+
+    Args:
+        store: the store the app queues tasks in
+        worker_id: name of this worker in claims, host and pid by default
+        batch_size: max tasks claimed at once
+        lease: seconds this worker has to run a batch before its tasks can be
+            claimed by another worker
+        max_workers: urls of a batch fetched in parallel
+        poll_interval: seconds to wait when there is nothing due
+        retry_delay: seconds before a task whose fetch failed is retried
+        max_attempts: failed fetches after which a task is not retried. It is
+            left in the pending table, never due, with its attempts
+        fetch: returns the response for a url
+    """
+
+    def __init__(self,
+                 store: SQLStore,
+                 worker_id: str = None,
+                 batch_size: int = DEFAULT_PAGE_SIZE,
+                 lease: float = DEFAULT_LEASE,
+                 max_workers: int = DEFAULT_POOL_SIZE,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 retry_delay: float = DEFAULT_RETRY_DELAY,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 fetch: ty.Callable[[str], ty.Any] = fetch_from_tfl):
+        self.store = store
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.batch_size = batch_size
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.fetch = fetch
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._stopped = threading.Event()
+        self.completed = 0
+        self.failed = 0
+        self.given_up = 0
+
+    def run_once(self) -> int:
+        """Claim and run one batch. Returns the number of tasks claimed"""
+        claim_id, tasks = self.store.claim_due_tasks(self.worker_id,
+                                                     limit=self.batch_size,
+                                                     lease=self.lease)
+        if not tasks:
+            return 0
+        # the lag of the batch is the lag of its earliest task
+        due = parse_dt_str(min(dt_str for _, dt_str, _ in tasks))
+        if due is not None:
+            task_metrics.observe_lag(due)
+        url2ids = defaultdict(list)
+        for task_id, _, url in tasks:
+            url2ids[url].append(task_id)
+        url2future = {url: self.pool.submit(self.fetch, url) for url in url2ids}
+
+        items = []
+        failed_ids = []
+        for url, future in url2future.items():
+            try:
+                response = future.result()
+            except Exception as e:
+                tlog.error("could not run claimed tasks",
+                           url=url,
+                           tasks=len(url2ids[url]),
+                           err=e)
+                failed_ids.extend(url2ids[url])
+                continue
+            items.extend((task_id, response) for task_id in url2ids[url])
+
+        with task_metrics.stage(task_metrics.STORE_WRITE).time():
+            self.store.complete_claimed_tasks(items)
+        task_metrics.FAILED.inc(len(failed_ids))
+        given_up = self.store.release_claimed_tasks(
+            claim_id,
+            failed_ids,
+            delay=self.retry_delay,
+            max_attempts=self.max_attempts)
+        if given_up:
+            tlog.error(f"giving up on {len(given_up)} tasks after "
+                       f"{self.max_attempts} attempts",
+                       task_ids=given_up)
+        self.completed += len(items)
+        self.failed += len(failed_ids)
+        self.given_up += len(given_up)
+        tlog.debug("ran claimed tasks",
+                   worker_id=self.worker_id,
+                   completed=len(items),
+                   failed=len(failed_ids))
+        return len(tasks)
+
+    def run(self, exit_when_idle: bool = False):
+        """Run batches until stopped, or until nothing is due if
+        exit_when_idle"""
+        tlog.info("queue worker started", worker_id=self.worker_id)
+        while not self._stopped.is_set():
+            if self.run_once() == 0:
+                if exit_when_idle:
+                    break
+                self._stopped.wait(self.poll_interval)
+        self.pool.shutdown()
+        tlog.info("queue worker stopped", **self.stats())
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self) -> ty.Dict[str, ty.Any]:
+        return {
+            "worker_id": self.worker_id,
+            "completed": self.completed,
+            "failed": self.failed,
+            "given_up": self.given_up,
+        }
+
+
+def run_worker(database_url: str,
+               exit_when_idle: bool = False,
+               **kwargs) -> ty.Dict[str, ty.Any]:
+    """Entry point of a worker process"""
+    worker = QueueWorker(SQLStore(database_url=database_url), **kwargs)
+    worker.run(exit_when_idle=exit_when_idle)
+    return worker.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--database-url", required=True)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument("--lease", type=float, default=DEFAULT_LEASE)
+    parser.add_argument("--max-attempts", type=int,
+                        default=DEFAULT_MAX_ATTEMPTS)
+    parser.add_argument("--exit-when-idle", action="store_true")
+    args = parser.parse_args()
+
+    run = partial(run_worker,
+                  args.database_url,
+                  exit_when_idle=args.exit_when_idle,
+                  batch_size=args.batch_size,
+                  lease=args.lease,
+                  max_attempts=args.max_attempts)
+    if args.processes == 1:
+        run()
+        return
+    processes = [
+        multiprocessing.Process(target=run, name=f"tfl-worker-{i}")
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
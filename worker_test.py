@@ -0,0 +1,144 @@
+import collections
+import multiprocessing
+import os
+import tempfile
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+
+import constants as c
+import worker as module
+from store import InMemoryStore, SQLStore
+from tfl_scheduler import EXECUTOR_QUEUE, TflScheduler
+from tfl_stub import TflStubServer
+
+
+class QueueTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.tmp_dir.name, 'tasks.db')
+        self.database_url = f"sqlite:///{db_path}"
+        self.store = SQLStore(database_url=self.database_url)
+        self.due = '2021-11-14T13:43:15'
+        self.url = "https://api.tfl.gov.uk/Line/bakerloo/Disruption"
+
+    def tearDown(self) -> None:
+        self.store.engine.dispose()
+        self.tmp_dir.cleanup()
+
+    def add_due_tasks(self, n: int, url=None):
+        self.store.add_pending_tasks_bulk([
+            (f'task_{i}', self.due, url(i) if url else self.url)
+            for i in range(n)
+        ])
+
+    def test_claims_do_not_overlap(self):
+        self.add_due_tasks(25)
+        future = (datetime.now() + timedelta(days=1)).strftime(c.DT_STR)
+        self.store.add_pending_task_id('later', future, self.url)
+
+        claimed = []
+        for _ in range(3):
+            _, tasks = self.store.claim_due_tasks('w', limit=10)
+            claimed.append([task_id for task_id, _, _ in tasks])
+        self.assertEqual([len(ids) for ids in claimed], [10, 10, 5])
+        self.assertEqual(len(set(sum(claimed, []))), 25)
+        self.assertNotIn('later', sum(claimed, []))
+
+    def test_expired_and_released_claims_are_claimed_again(self):
+        self.add_due_tasks(2)
+        self.store.claim_due_tasks('dead', limit=1, lease=0)
+        claim_id, tasks = self.store.claim_due_tasks('alive', limit=2)
+        self.assertEqual(len(tasks), 2)
+
+        self.store.release_claimed_tasks('someone else', ['task_0'])
+        self.assertEqual(self.store.claim_due_tasks('w')[1], [])
+        self.store.release_claimed_tasks(claim_id, ['task_0'], delay=60)
+        self.assertEqual(self.store.claim_due_tasks('w')[1], [])
+        self.store.release_claimed_tasks(claim_id, ['task_1'])
+        self.assertEqual(
+            [task_id for task_id, _, _ in self.store.claim_due_tasks('w')[1]],
+            ['task_1'])
+
+    def test_tasks_complete_once(self):
+        self.add_due_tasks(1)
+        self.store.complete_claimed_tasks([('task_0', ['first'])])
+        self.store.complete_claimed_tasks([('task_0', ['second'])])
+        self.assertEqual(self.store.get_task_id_response('task_0'), ['first'])
+        self.assertEqual(self.store.get_all_pending_tasks(), [])
+
+    def test_worker_retries_failed_fetches(self):
+        self.add_due_tasks(3, url=lambda i: f"{self.url}?{i % 2}")
+
+        def fetch(url):
+            if url.endswith('1'):
+                raise ValueError('tfl is down')
+            return [url]
+
+        worker = module.QueueWorker(self.store, fetch=fetch, retry_delay=60)
+        worker.run(exit_when_idle=True)
+        self.assertEqual(worker.stats()['completed'], 2)
+        self.assertEqual(worker.stats()['failed'], 1)
+        self.assertEqual(self.store.get_task_id_response('task_2'),
+                         [f"{self.url}?0"])
+        self.assertEqual(self.store.get_all_pending_tasks(), ['task_1'])
+
+    def test_task_that_keeps_failing_is_given_up(self):
+        self.store.add_pending_tasks_bulk([('bad', self.due, f"{self.url}?bad"),
+                                           ('good', self.due, self.url)])
+
+        def fetch(url):
+            if url.endswith('bad'):
+                raise ValueError('no such line')
+            return [url]
+
+        worker = module.QueueWorker(self.store,
+                                    fetch=fetch,
+                                    retry_delay=0,
+                                    max_attempts=3)
+        worker.run(exit_when_idle=True)
+        self.assertEqual(worker.stats()['failed'], 3)
+        self.assertEqual(worker.stats()['given_up'], 1)
+        self.assertEqual(self.store.claim_due_tasks('w'), (mock.ANY, []))
+        self.assertEqual(self.store.get_task_id_response('good'), [self.url])
+        # kept, to be looked into
+        self.assertEqual(self.store.get_all_pending_tasks(), ['bad'])
+
+    def test_processes_run_every_task_exactly_once(self):
+        n_tasks = 400
+        with TflStubServer(latency=0.005) as stub:
+            self.add_due_tasks(
+                n_tasks, url=lambda i: f"{stub.url}/Line/line{i}/Disruption")
+            ctx = multiprocessing.get_context('spawn')
+            processes = [
+                ctx.Process(target=module.run_worker,
+                            args=(self.database_url, True),
+                            kwargs=dict(batch_size=20))
+                for _ in range(4)
+            ]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join(timeout=120)
+                self.assertEqual(process.exitcode, 0)
+
+            path_counts = collections.Counter(stub.paths)
+        self.assertEqual(len(path_counts), n_tasks)
+        self.assertEqual(set(path_counts.values()), {1})
+        self.assertEqual(self.store.get_all_pending_tasks(), [])
+        self.assertEqual(len(self.store.get_all_finished_tasks()), n_tasks)
+
+    def test_scheduler_queues_tasks(self):
+        tfl_scheduler = TflScheduler(self.store, executor=EXECUTOR_QUEUE)
+        self.assertIsNone(tfl_scheduler.scheduler)
+        id = tfl_scheduler.schedule_tfl_call(url=self.url, dt=None)
+        self.assertTrue(self.store.is_pending_task_id(id))
+        tfl_scheduler.shutdown()
+
+        with self.assertRaises(ValueError):
+            TflScheduler(InMemoryStore(), executor=EXECUTOR_QUEUE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+import threading
+import typing as ty
+from datetime import datetime
+
+import tlog
+from store import DEFAULT_BATCH_SIZE, DEFAULT_PAGE_SIZE, AbstractMemoryStore
+
+DEFAULT_MAX_DELAY = 0.5  # seconds
+DEFAULT_MAX_ATTEMPTS = 5
+
+
+class WriteBehindStore(AbstractMemoryStore):
+    """Buffers responses in memory and writes them to `store` in bulk.
+
+    The buffer is flushed with one `add_responses_bulk` call when it holds
+    `max_items` responses, or `max_delay` seconds after the last flush,
+    whichever comes first. Buffered responses are already visible to reads
+    through this store. Everything else is passed straight to `store`.
+
+    If a flush fails the responses are kept and retried on the next flush, but
+    they are lost if the process dies before then. Once a response has been
+    in `max_attempts` failed flushes it is written on its own, so one bad
+    response cannot hold back the rest of its batch, and dropped if that
+    fails too.
+    """
+
+    def __init__(self,
+                 store: AbstractMemoryStore,
+                 max_items: int = DEFAULT_BATCH_SIZE,
+                 max_delay: float = DEFAULT_MAX_DELAY,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        tlog.info(f"Write behind store init, max_items = {max_items}, "
+                  f"max_delay = {max_delay}")
+        self.store = store
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._buffer: ty.Dict[str, ty.Any] = dict()
+        # task_id -> failed flushes its buffered response was in
+        self._attempts: ty.Dict[str, int] = dict()
+        self._closed = threading.Event()
+        self.flushes = 0
+        self.flushed_items = 0
+        self.failed_flushes = 0
+        self.dropped_items = 0
+        self._thread = threading.Thread(target=self._flush_periodically,
+                                        name="tfl-write-behind",
+                                        daemon=True)
+        self._thread.start()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.max_delay):
+            self.flush()
+
+    def flush(self):
+        # only one flush at a time, so a failed batch is put back before the
+        # next flush could write newer responses for the same tasks
+        with self._flush_lock:
+            with self._lock:
+                if not self._buffer:
+                    return
+                items = self._buffer
+                self._buffer = dict()
+            try:
+                self.store.add_responses_bulk(list(items.items()))
+            except Exception as e:
+                tlog.error(f"could not flush {len(items)} responses", err=e)
+                self._failed(items)
+                return
+            with self._lock:
+                self.flushes += 1
+                self.flushed_items += len(items)
+                for task_id in items:
+                    self._attempts.pop(task_id, None)
+
+    def _failed(self, items: ty.Dict[str, ty.Any]):
+        """Put the responses of a failed flush back in the buffer, or write
+        the ones that have failed too often on their own"""
+        last_tries = []
+        with self._lock:
+            self.failed_flushes += 1
+            for task_id, response in items.items():
+                if task_id in self._buffer:
+                    # a newer response was buffered, and replaces this one
+                    continue
+                attempts = self._attempts.get(task_id, 0) + 1
+                if attempts >= self.max_attempts:
+                    last_tries.append((task_id, response))
+                    continue
+                self._attempts[task_id] = attempts
+                self._buffer[task_id] = response
+        for task_id, response in last_tries:
+            try:
+                self.store.add_responses_bulk([(task_id, response)])
+            except Exception as e:
+                tlog.error("dropping response that could not be written",
+                           task_id=task_id,
+                           err=e)
+                with self._lock:
+                    self.dropped_items += 1
+                    self._attempts.pop(task_id, None)
+                continue
+            with self._lock:
+                self.flushed_items += 1
+                self._attempts.pop(task_id, None)
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.flush()
+
+    def add_response(self, task_id, response):
+        self.add_responses_bulk([(task_id, response)])
+
+    def add_responses_bulk(self, items: ty.Iterable[ty.Tuple[str, ty.Any]]):
+        items = list(items)
+        with self._lock:
+            self._buffer.update(items)
+            for task_id, _ in items:
+                self._attempts.pop(task_id, None)
+            full = len(self._buffer) >= self.max_items
+        # readable from the buffer already, so waiters need not wait for the
+        # flush
+        self._notify_completed([task_id for task_id, _ in items])
+        if full:
+            self.flush()
+
+    def add_pending_task_id(self, task_id, dt_str: str, url: str):
+        self.store.add_pending_task_id(task_id, dt_str, url)
+
+    def add_pending_tasks_bulk(self,
+                               items: ty.Iterable[ty.Tuple[str, str, str]]):
+        self.store.add_pending_tasks_bulk(items)
+
+    def is_pending_task_id(self, task_id):
+        if task_id in self._buffer:
+            return False
+        return self.store.is_pending_task_id(task_id)
+
+    def remove_pending_task_id(self, task_id):
+        # buffered tasks have their pending row removed when they are flushed
+        if task_id not in self._buffer:
+            self.store.remove_pending_task_id(task_id)
+
+    def complete_tasks_bulk(self, task_ids: ty.Iterable[str]):
+        self.store.complete_tasks_bulk(
+            [task_id for task_id in task_ids if task_id not in self._buffer])
+
+    def get_task_id_response(self, task_id):
+        with self._lock:
+            if task_id in self._buffer:
+                return self._buffer[task_id]
+        return self.store.get_task_id_response(task_id)
+
+    def get_all_pending_tasks(self):
+        return self.store.get_all_pending_tasks()
+
+    def count_pending_tasks(self):
+        # buffered tasks are done, their pending rows just have not been
+        # removed yet
+        return max(0, self.store.count_pending_tasks() - len(self._buffer))
+
+    def get_all_finished_tasks(self):
+        self.flush()
+        return self.store.get_all_finished_tasks()
+
+    def iter_pending_tasks(self, batch_size: int = DEFAULT_BATCH_SIZE):
+        return self.store.iter_pending_tasks(batch_size=batch_size)
+
+    def get_due_tasks(self,
+                      until: datetime = None,
+                      limit: int = DEFAULT_PAGE_SIZE):
+        # buffered tasks are done, their pending rows just have not been
+        # removed yet
+        due = self.store.get_due_tasks(until=until,
+                                       limit=limit + len(self._buffer))
+        return [task for task in due if task[0] not in self._buffer][:limit]
+
+    def get_finished_tasks_page(self,
+                                limit: int = DEFAULT_PAGE_SIZE,
+                                cursor: str = None):
+        self.flush()
+        return self.store.get_finished_tasks_page(limit=limit, cursor=cursor)
+
+    def iter_finished_tasks(self, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.flush()
+        return self.store.iter_finished_tasks(batch_size=batch_size)
+
+    def find_finished_tasks(self,
+                            filters: ty.Dict[str, str],
+                            since: datetime = None,
+                            limit: int = DEFAULT_PAGE_SIZE,
+                            cursor: str = None):
+        self.flush()
+        return self.store.find_finished_tasks(filters,
+                                              since=since,
+                                              limit=limit,
+                                              cursor=cursor)
+
+    def stats(self) -> ty.Dict[str, int]:
+        return {
+            "buffered": len(self._buffer),
+            "flushes": self.flushes,
+            "flushed_items": self.flushed_items,
+            "failed_flushes": self.failed_flushes,
+            "dropped_items": self.dropped_items,
+        }
@@ -0,0 +1,102 @@
+import time
+import unittest
+
+import write_buffer as module
+from store import InMemoryStore
+
+
+class RecordingStore(InMemoryStore):
+    def __init__(self):
+        super().__init__()
+        self.bulk_writes = []
+
+    def add_responses_bulk(self, items):
+        self.bulk_writes.append(items)
+        super().add_responses_bulk(items)
+
+
+class WriteBehindStoreTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.inner = RecordingStore()
+        self.url = "https://api.tfl.gov.uk/Line/bakerloo/Disruption"
+
+    def test_flushes_when_full(self):
+        store = module.WriteBehindStore(self.inner, max_items=3, max_delay=60)
+        for i in range(7):
+            store.add_pending_task_id(f'task_{i}', '2021-11-14T13:43:15',
+                                      self.url)
+            store.add_response(f'task_{i}', [i])
+        self.assertEqual([len(items) for items in self.inner.bulk_writes],
+                         [3, 3])
+        self.assertTrue(self.inner.is_pending_task_id('task_6'))
+        self.assertEqual(self.inner.count_pending_tasks(), 1)
+        self.assertEqual(store.count_pending_tasks(), 0)
+        store.close()
+        self.assertEqual(len(self.inner.bulk_writes), 3)
+        self.assertEqual(self.inner.get_task_id_response('task_6'), [6])
+        self.assertEqual(self.inner.get_all_pending_tasks(), [])
+
+    def test_flushes_after_delay(self):
+        store = module.WriteBehindStore(self.inner,
+                                        max_items=100,
+                                        max_delay=0.05)
+        store.add_response('task', ['response'])
+        time.sleep(0.2)
+        self.assertEqual(self.inner.get_task_id_response('task'),
+                         ['response'])
+        store.close()
+
+    def test_buffered_responses_are_readable(self):
+        store = module.WriteBehindStore(self.inner, max_items=100, max_delay=60)
+        store.add_pending_task_id('task', '2021-11-14T13:43:15', self.url)
+        store.add_response('task', ['response'])
+        self.assertEqual(store.get_task_id_response('task'), ['response'])
+        self.assertFalse(store.is_pending_task_id('task'))
+        with self.assertRaises(ValueError):
+            self.inner.get_task_id_response('task')
+        store.close()
+
+    def test_failed_flush_is_retried(self):
+        store = module.WriteBehindStore(self.inner, max_items=100, max_delay=60)
+        store.add_response('task', ['response'])
+        add_responses_bulk = self.inner.add_responses_bulk
+        self.inner.add_responses_bulk = lambda items: 1 / 0
+        store.flush()
+        self.assertEqual(store.stats()['failed_flushes'], 1)
+        self.inner.add_responses_bulk = add_responses_bulk
+        store.close()
+        self.assertEqual(self.inner.get_task_id_response('task'),
+                         ['response'])
+
+    def test_response_that_keeps_failing_is_dropped(self):
+        store = module.WriteBehindStore(self.inner,
+                                        max_items=100,
+                                        max_delay=60,
+                                        max_attempts=3)
+        add_responses_bulk = self.inner.add_responses_bulk
+
+        def reject_bad(items):
+            if any(task_id == 'bad' for task_id, _ in items):
+                raise ValueError("bad row")
+            add_responses_bulk(items)
+
+        self.inner.add_responses_bulk = reject_bad
+        store.add_response('bad', ['bad'])
+        store.add_response('a', ['a'])
+        store.flush()
+        store.flush()
+        self.assertEqual(store.stats()['buffered'], 2)
+        # the third failure writes them one at a time
+        store.flush()
+        self.assertEqual(self.inner.get_task_id_response('a'), ['a'])
+        self.assertEqual(store.stats()['dropped_items'], 1)
+        self.assertEqual(store.stats()['buffered'], 0)
+        store.add_response('b', ['b'])
+        store.flush()
+        self.assertEqual(self.inner.get_task_id_response('b'), ['b'])
+        self.assertEqual(store.stats()['failed_flushes'], 3)
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()